@@ -0,0 +1,137 @@
+import numpy as np
+
+DAYS_PER_YEAR = 365
+
+
+def daily_returns(values, flows):
+    """Time-weighted daily returns. values[t] is the end-of-day total, flows[t] the external cash moved in on day t.
+
+    Flows are assumed to land at the end of the day, so r[t] = (values[t] - flows[t]) / values[t - 1] - 1.
+    Days starting from a non-positive balance have no meaningful return and count as 0.
+    """
+    values = np.asarray(values, dtype=float)
+    flows = np.asarray(flows, dtype=float)
+    previous = values[:-1]
+    gains = values[1:] - flows[1:]
+    returns = np.zeros_like(previous)
+    np.divide(gains, previous, out=returns, where=previous > 0)
+    returns[previous > 0] -= 1
+    return returns
+
+
+def time_weighted_return(returns):
+    if returns.size == 0:
+        return 0.0
+    return float(np.prod(1 + returns) - 1)
+
+
+def annualize(total_return, days):
+    if days <= 0 or total_return <= -1:
+        return None
+    return float((1 + total_return) ** (DAYS_PER_YEAR / days) - 1)
+
+
+def money_weighted_return(values, flows, tolerance=1e-7, max_iterations=200):
+    """Annualized internal rate of return (XIRR) of the daily series, or None if it has no solution.
+
+    From the investor's side the opening balance and every inflow are payments, the closing balance a receipt.
+    """
+    values = np.asarray(values, dtype=float)
+    flows = np.asarray(flows, dtype=float)
+    if values.size < 2:
+        return None
+    cash_flows = -flows.copy()
+    cash_flows[0] = -values[0]
+    cash_flows[-1] += values[-1]
+    years = np.arange(values.size) / DAYS_PER_YEAR
+
+    def npv(rate):
+        return float(np.sum(cash_flows / (1 + rate) ** years))
+
+    low, high = -0.9999, 10.0
+    npv_low, npv_high = npv(low), npv(high)
+    if np.isnan(npv_low) or np.isnan(npv_high) or npv_low * npv_high > 0:
+        return None
+    for _ in range(max_iterations):
+        mid = (low + high) / 2
+        npv_mid = npv(mid)
+        if abs(npv_mid) < tolerance or high - low < tolerance:
+            return mid
+        if npv_low * npv_mid < 0:
+            high = mid
+        else:
+            low, npv_low = mid, npv_mid
+    return (low + high) / 2
+
+
+def max_drawdown(returns):
+    """Largest peak-to-trough fall of the time-weighted wealth index, as (drawdown, peak index, trough index)."""
+    if returns.size == 0:
+        return 0.0, 0, 0
+    wealth = np.concatenate(([1.0], np.cumprod(1 + returns)))
+    peaks = np.maximum.accumulate(wealth)
+    drawdowns = wealth / peaks - 1
+    trough = int(np.argmin(drawdowns))
+    peak = int(np.argmax(wealth[:trough + 1]))
+    return float(drawdowns[trough]), peak, trough
+
+
+def rolling_volatility(returns, window):
+    """Annualized standard deviation of daily returns over each trailing `window` days."""
+    if returns.size < window or window < 2:
+        return np.array([])
+    windows = np.lib.stride_tricks.sliding_window_view(returns, window)
+    return windows.std(axis=1, ddof=1) * np.sqrt(DAYS_PER_YEAR)
+
+
+def allocation_weights(type_totals):
+    types = sorted(type_totals)
+    totals = np.array([type_totals[type_] for type_ in types], dtype=float)
+    total = totals.sum()
+    weights = totals / total if total > 0 else np.zeros_like(totals)
+    return dict(zip(types, weights))
+
+
+def allocation_drift(start_totals, end_totals):
+    """Per-type change in portfolio weight between two {type: total} allocations."""
+    start_weights = allocation_weights(start_totals)
+    end_weights = allocation_weights(end_totals)
+    return {
+        type_: {
+            'startWeight': round(float(start_weights.get(type_, 0)), 6),
+            'endWeight': round(float(end_weights.get(type_, 0)), 6),
+            'drift': round(float(end_weights.get(type_, 0) - start_weights.get(type_, 0)), 6)
+        }
+        for type_ in sorted(set(start_weights) | set(end_weights))
+    }
+
+
+def portfolio_analytics(dates, values, flows, volatility_window=30):
+    """Summary analytics for a daily series: dates[0] is the base day the returns are measured from."""
+    returns = daily_returns(values, flows)
+    days = len(dates) - 1
+    twr = time_weighted_return(returns)
+    annualized_twr = annualize(twr, days)
+    mwr = money_weighted_return(values, flows)
+    drawdown, peak, trough = max_drawdown(returns)
+    volatility = rolling_volatility(returns, volatility_window)
+    return {
+        'start': dates[0],
+        'end': dates[-1],
+        'timeWeightedReturn': round(twr, 6),
+        'annualizedTimeWeightedReturn': round(annualized_twr, 6) if annualized_twr is not None else None,
+        'moneyWeightedReturn': round(mwr, 6) if mwr is not None else None,
+        'maxDrawdown': {
+            'drawdown': round(drawdown, 6),
+            'peak': dates[peak],
+            'trough': dates[trough]
+        },
+        'volatility': {
+            'window': volatility_window,
+            'latest': round(float(volatility[-1]), 6) if volatility.size else None,
+            'series': [
+                {'date': date, 'volatility': round(float(value), 6)}
+                for date, value in zip(dates[volatility_window:], volatility)
+            ]
+        }
+    }
@@ -1,132 +1,556 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash, session
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import DECIMAL, func
-from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, AnonymousUserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.exc import IntegrityError
+from flask import Flask, Blueprint, request, jsonify, make_response, render_template, redirect, url_for, flash, session, Response, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import DECIMAL, event, func, insert, select, update, delete, and_, or_
+from flask_login import LoginManager, login_user, logout_user, login_required, current_user, AnonymousUserMixin
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from datetime import datetime, timezone, date, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
-from flask_migrate import Migrate
-import requests
-import platform
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from apscheduler.triggers.cron import CronTrigger
+from quotes import QuoteFetcher, with_retries
+from price_cache import build_cache, MemoryCache, TieredCache
+from analytics import portfolio_analytics, allocation_drift
+from fx_rates import FxRateTable, parse_currency
+from events import build_broker
+from passwords import PasswordHasher, HasherBusy
+from rate_limits import build_rate_limits
+from ledger_tiers import LedgerFiles, encode_row, next_month, partition_definitions, partition_month
+from price_store import PriceStore, FixtureProvider, backfill_prices
+from query_plans import find_full_scans
+from sql_helpers import upsert, period_key, insert_returning_ids
+from bulk_io import FORMATS, resolve_format, read_rows, chunked, write_rows
+from serializers import Projection
+from db_engine import engine_options, configure_engine, is_transient_error, RoutingSession
+from models import (db, User, Account, AccountTypeBalance, MonthlyMarketValue, MonthlyTypeMarketValue, BalanceCheckpoint,
+                    DailyBalance, FxRate, RevaluationJob, JobLease, JobRun, RefreshCursor, RefreshDeadLetter, IdempotencyKey,
+                    Transaction, ArchivedLedgerMonth)
+from metrics import (Registry, Counter, Histogram, SlowRequestProfiler, begin_request, end_request, current_stats, timed,
+                     COUNT_BUCKETS, JOB_BUCKETS, UPSTREAM_BUCKETS)
+import click
+import hashlib
+import io
+import itertools
+import json
+import math
 import re
 import os
+import socket
+import threading
+import time
 import logging
+import numpy as np
 
-app = Flask(__name__)
-app.config.from_object('config.Config')
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)  # 设置 session 有效期为 30 分钟
+bp = Blueprint('main', __name__, cli_group=None)
 
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
-
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
 login_manager.session_protection = 'strong'  # 启用 session 保护
 
-logging.basicConfig(level=logging.INFO)
-
-class User(UserMixin, db.Model):
-    __tablename__ = 'Users'
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(255), unique=True, nullable=False)
-    password = db.Column(db.String(255), nullable=False)
-    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
-    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S')
-        }
-
-class Account(db.Model):
-    __tablename__ = 'Accounts'
-    id = db.Column(db.Integer, primary_key=True)
-    type = db.Column(db.String(50), nullable=False)
-    details = db.Column(db.String(100), nullable=False)
-    stockSymbol = db.Column(db.String(10), nullable=True)
-    shares = db.Column(db.Integer, nullable=True)
-    marketValue = db.Column(db.DECIMAL(12, 2), nullable=True)
-    createdAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
-    updatedAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), nullable=False)
-    user = db.relationship('User', backref=db.backref('accounts', lazy=True))
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'type': self.type,
-            'details': self.details,
-            'stockSymbol': self.stockSymbol,
-            'shares': self.shares,
-            'marketValue': float(self.marketValue) if self.marketValue is not None else 0,
-            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'user_id': self.user_id
-        }
-
-class MonthlyMarketValue(db.Model):
-    __tablename__ = 'MonthlyMarketValues'
-    id = db.Column(db.Integer, primary_key=True)
-    totalMarketValue = db.Column(db.DECIMAL(12, 2), nullable=False)
-    month = db.Column(db.Date, nullable=False)
-    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
-    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'totalMarketValue': float(self.totalMarketValue),
-            'month': self.month.strftime('%Y-%m-%d'),
-            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S')
-        }
-
-class Transaction(db.Model):
-    __tablename__ = 'Transactions'
-    id = db.Column(db.Integer, primary_key=True)
-    accountId = db.Column(db.Integer, nullable=False)
-    change = db.Column(db.DECIMAL(12, 2), nullable=False)
-    previousBalance = db.Column(db.DECIMAL(12, 2), nullable=False)
-    newBalance = db.Column(db.DECIMAL(12, 2), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    createdAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
-    updatedAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
-    reason = db.Column(db.String(255), nullable=True)
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'accountId': self.accountId,
-            'change': float(self.change),
-            'previousBalance': float(self.previousBalance),
-            'newBalance': float(self.newBalance),
-            'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'reason': self.reason
-        }
+metrics_registry = Registry()
+REQUEST_DURATION = metrics_registry.register(Histogram(
+    'http_request_duration_seconds', 'Request latency.', ['endpoint', 'method', 'status']))
+REQUEST_PHASE_DURATION = metrics_registry.register(Histogram(
+    'http_request_phase_seconds', 'Request time spent in db, upstream, serialization and other.', ['endpoint', 'phase']))
+REQUEST_STATEMENTS = metrics_registry.register(Histogram(
+    'http_request_sql_statements', 'SQL statements executed per request.', ['endpoint'], COUNT_BUCKETS))
+REPEATED_STATEMENT_REQUESTS = metrics_registry.register(Counter(
+    'http_request_repeated_sql', 'Requests that ran one SQL statement N_PLUS_ONE_THRESHOLD or more times.', ['endpoint']))
+UPSTREAM_DURATION = metrics_registry.register(Histogram(
+    'upstream_request_duration_seconds', 'Polygon and exchange-rate API call latency.', ['call', 'outcome'], UPSTREAM_BUCKETS))
+JOB_DURATION = metrics_registry.register(Histogram(
+    'scheduler_job_duration_seconds', 'Scheduled job run time.', ['job', 'status'], JOB_BUCKETS))
+PASSWORD_HASH_DURATION = metrics_registry.register(Histogram(
+    'password_hash_duration_seconds', 'Password hashing time including the wait for a hashing process.', ['operation', 'outcome']))
+LOGIN_THROTTLED = metrics_registry.register(Counter(
+    'login_throttled_total', 'Login and register attempts refused by the rate limits.', ['scope']))
+
+# 以下对象由 create_app() 按配置创建：导入本模块不会创建应用、数据库连接、线程或数据目录。
+# 后台线程和定时任务通过 app 进入应用上下文
+app = None
+price_cache = None
+price_store = None
+ledger_files = None
+analytics_cache = None
+response_cache = None
+fx_rate_cache = None
+event_broker = None
+slow_request_profiler = None
+revaluation_executor = None
+quote_fetcher = None
+password_hasher = None
+login_rate_limits = None
+lan_user_cache = None
+scheduler = None
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with timed('serialization'):
+            return super().dumps(obj, **kwargs)
+
+def create_app(role=None, forked=False):
+    """Build the application and the services it uses.
+
+    `role` (default PROCESS_ROLE) is 'web' or 'scheduler'; only a 'scheduler' process runs the scheduled jobs.
+    With `forked` set, the server starts the workers' password hashing pools itself (gunicorn.conf.py), so a
+    preloading master starts no processes or threads before it forks.
+    """
+    global app, price_cache, price_store, ledger_files, analytics_cache, response_cache, fx_rate_cache, event_broker
+    global slow_request_profiler, revaluation_executor, quote_fetcher, password_hasher, login_rate_limits, lan_user_cache
+    flask_app = Flask(__name__)
+    flask_app.config.from_object('config.Config')
+    flask_app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=30)  # 设置 session 有效期为 30 分钟
+    if role:
+        flask_app.config['PROCESS_ROLE'] = role
+
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(flask_app.config['SQLALCHEMY_DATABASE_URI'], flask_app.config)
+    if flask_app.config['DB_READ_REPLICA_URL']:
+        flask_app.config['SQLALCHEMY_BINDS'] = {'replica': {
+            'url': flask_app.config['DB_READ_REPLICA_URL'],
+            **engine_options(flask_app.config['DB_READ_REPLICA_URL'], flask_app.config)
+        }}
+
+    db.init_app(flask_app)
+    with flask_app.app_context():
+        for engine in db.engines.values():
+            configure_engine(engine, flask_app.config)
+    if click.get_current_context(silent=True) is not None:
+        # 只有 flask 命令行需要 flask db 子命令，web worker 不导入 alembic
+        from flask_migrate import Migrate
+        Migrate(flask_app, db)
+    login_manager.init_app(flask_app)
+    flask_app.json = TimedJSONProvider(flask_app)
+    flask_app.register_blueprint(bp)
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = flask_app.config
+    price_cache = build_cache(config)
+    price_store = PriceStore(config['PRICE_STORE_PATH'])
+    ledger_files = LedgerFiles(config['LEDGER_ARCHIVE_PATH'])
+    analytics_cache = TieredCache([MemoryCache(config['ANALYTICS_CACHE_MAXSIZE'])])
+    response_cache = TieredCache([MemoryCache(config['RESPONSE_CACHE_MAXSIZE'])])
+    fx_rate_cache = TieredCache([MemoryCache(64)])
+    event_broker = build_broker(config)
+    if config['EVENTS_BACKEND'] == 'memory' and config['WEB_CONCURRENCY'] > 1:
+        logging.warning("EVENTS_BACKEND=memory with several workers: pages miss the changes made through other workers")
+    slow_request_profiler = SlowRequestProfiler(
+        config['SLOW_REQUEST_PROFILE_SECONDS'], config['PROFILE_SAMPLE_INTERVAL'], config['SLOW_REQUEST_PROFILES_KEPT']
+    ) if config['METRICS_ENABLED'] and config['SLOW_REQUEST_PROFILE_SECONDS'] > 0 else None
+
+    revaluation_executor = ThreadPoolExecutor(max_workers=config['REVALUATION_WORKERS'], thread_name_prefix='revaluation')
+    quote_fetcher = QuoteFetcher(
+        config['POLYGON_API_KEY'],
+        config['EXCHANGE_RATE_API_URL'],
+        max_workers=config['QUOTE_FETCH_WORKERS'],
+        polygon_rate=config['POLYGON_RATE_LIMIT'],
+        fx_rate=config['EXCHANGE_RATE_RATE_LIMIT'],
+        timeout=config['HTTP_TIMEOUT'],
+        cache=price_cache,
+        quote_ttls={'open': config['QUOTE_TTL_MARKET_OPEN'], 'closed': config['QUOTE_TTL_MARKET_CLOSED']},
+        polygon_url=config['POLYGON_API_URL'],
+        on_call=lambda call, seconds, outcome: UPSTREAM_DURATION.observe(seconds, call=call, outcome=outcome)
+    )
+    password_hasher = PasswordHasher(
+        config['PASSWORD_HASH_METHOD'],
+        workers=config['PASSWORD_HASH_WORKERS'],
+        queue_size=config['PASSWORD_HASH_QUEUE'],
+        timeout=config['PASSWORD_HASH_TIMEOUT'],
+        nice=config['PASSWORD_HASH_NICE'],
+        on_hash=lambda operation, seconds, outcome: PASSWORD_HASH_DURATION.observe(seconds, operation=operation, outcome=outcome)
+    )
+    login_rate_limits = build_rate_limits(config)
+    lan_user_cache = TieredCache([MemoryCache(4)])
+    app = flask_app
+
+    if config['PROCESS_ROLE'] == 'web' and not forked and click.get_current_context(silent=True) is None:
+        password_hasher.start()
+    if config['PROCESS_ROLE'] == 'scheduler':
+        start_scheduler()
+    return flask_app
+
+# 列表接口直接按列查询并序列化，跳过 ORM 对象；字段与 to_dict() 一致
+ACCOUNT_LIST = Projection([
+    ('id', Account.id, None),
+    ('type', Account.type, None),
+    ('details', Account.details, None),
+    ('stockSymbol', Account.stockSymbol, None),
+    ('shares', Account.shares, None),
+    ('currency', Account.currency, None),
+    ('marketValue', Account.marketValue, 'money'),
+    ('createdAt', Account.createdAt, 'datetime'),
+    ('updatedAt', Account.updatedAt, 'datetime'),
+    ('user_id', Account.user_id, None),
+])
+MONTHLY_MARKET_VALUE_LIST = Projection([
+    ('id', MonthlyMarketValue.id, None),
+    ('totalMarketValue', MonthlyMarketValue.totalMarketValue, 'money'),
+    ('month', MonthlyMarketValue.month, 'date'),
+    ('createdAt', MonthlyMarketValue.createdAt, 'datetime'),
+    ('updatedAt', MonthlyMarketValue.updatedAt, 'datetime'),
+])
 
 @login_manager.user_loader
 def load_user(user_id):
     return db.session.get(User, int(user_id))
 
-def get_stock_price(symbol):
-    url = f'https://api.polygon.io/v2/aggs/ticker/{symbol}/prev?adjusted=true&apiKey={app.config["POLYGON_API_KEY"]}'
-    response = requests.get(url)
-    data = response.json()
-    if 'results' not in data:
-        logging.error(f"Error fetching stock price for {symbol}: {data}")
-        raise ValueError(f"Error fetching stock price for {symbol}: {data}")
-    return data['results'][0]['c']
+def get_stock_prices(symbols, retries=0, backoff=1.0, on_progress=None):
+    with timed('upstream'):
+        return quote_fetcher.get_stock_prices(symbols, retries, backoff, on_progress)
+
+def load_fx_rate_table(day):
+    base = app.config['FX_BASE_CURRENCY']
+    latest = db.session.query(func.max(FxRate.day)).filter(FxRate.base == base, FxRate.day <= day).scalar()
+    if latest is not None:
+        rates = db.session.query(FxRate.quote, FxRate.rate).filter(FxRate.base == base, FxRate.day == latest).all()
+        return FxRateTable(base, latest, dict(rates))
+    # 汇率表中还没有数据时，退回到本地价格库中的美元兑人民币收盘价
+    close = price_store.get_close(app.config['PRICE_HISTORY_FX_SYMBOL'], day)
+    return FxRateTable('USD', None, {'CNY': close}) if close is not None else None
+
+def fx_rate_table(day=None):
+    """Rates of the latest stored day on or before `day` (default today), or None; never calls upstream."""
+    day = day or date.today()
+    return fx_rate_cache.get_or_fetch(f'fx:{day}', app.config['FX_RATE_TTL'], lambda: load_fx_rate_table(day))
+
+def refresh_fx_rates():
+    """Store today's rates from one bulk fetch of the whole table, unless a process already stored them."""
+    today = date.today()
+    base = app.config['FX_BASE_CURRENCY']
+    stored = db.session.query(FxRate.day).filter(FxRate.base == base, FxRate.day == today).first()
+    db.session.commit()
+    if stored is None:
+        with timed('upstream'):
+            fetched_base, rates = quote_fetcher.get_exchange_rates()
+        if fetched_base != base:
+            raise ValueError(f"Exchange rates are against {fetched_base}, FX_BASE_CURRENCY is {base}")
+        now = datetime.now(timezone.utc)
+        upsert(db.session, FxRate.__table__, [
+            {'base': base, 'quote': quote, 'day': today, 'rate': Decimal(str(rate)), 'createdAt': now}
+            for quote, rate in rates.items()
+        ], ['base', 'quote', 'day'], set_columns=['rate'])
+        db.session.commit()
+        logging.info(f"Stored {len(rates)} exchange rates against {base} for {today}")
+    table = load_fx_rate_table(today)
+    db.session.commit()
+    fx_rate_cache.set(f'fx:{today}', table, app.config['FX_RATE_TTL'])
+    return table
+
+def revaluation_fx_rates(retries=0, backoff=1.0):
+    """Today's rates for a revaluation; if they cannot be fetched, the latest stored ones."""
+    table = fx_rate_table()
+    if table is not None and table.day == date.today():
+        return table
+    try:
+        return with_retries(refresh_fx_rates, retries, backoff)
+    except Exception:
+        db.session.rollback()
+        if table is None:
+            raise
+        logging.exception(f"Exchange rate refresh failed, revaluing with the rates of {table.day}")
+        return table
+
+REVALUATION_REASONS = ('Market value refresh', 'Daily market value refresh')
+COMPACTED_REVALUATION_REASON = 'Monthly market value refresh'
+
+def revalue_stock_accounts(query, reason, on_progress=None):
+    rows = revaluation_rows(query).all()
+    # 结束读事务，避免在请求行情期间长时间持有数据库事务
+    db.session.commit()
+    if not rows:
+        return {}
+
+    fx_rates = revaluation_fx_rates()
+    prices, errors = get_stock_prices((row.stockSymbol for row in rows), on_progress=on_progress)
+    for row in rows:
+        if row.stockSymbol in prices and not revaluable(row, prices, fx_rates):
+            errors[row.stockSymbol] = revaluation_error(row, errors)
+    updated = apply_revaluations(rows, prices, fx_rates, reason)
+    db.session.commit()
+    logging.info(f"Revalued {updated} of {len(rows)} stock accounts ({len(prices)} symbols fetched, {len(errors)} failed)")
+    return errors
+
+def revaluable(row, prices, fx_rates):
+    return row.stockSymbol in prices and fx_rates.has(row.currency or row.reportingCurrency) and fx_rates.has(row.reportingCurrency)
+
+def revaluation_error(row, errors):
+    if row.stockSymbol in errors:
+        return errors[row.stockSymbol]
+    if not row.stockSymbol:
+        return 'No stock symbol'
+    return f'No exchange rate from {row.currency} to {row.reportingCurrency}'
+
+def revalued_market_values(rows, prices, fx_rates):
+    """price x shares x rate from the account's currency to its owner's reporting currency, for all `rows` at once."""
+    price = np.fromiter((prices[row.stockSymbol] for row in rows), dtype=float, count=len(rows))
+    shares = np.fromiter((row.shares or 0 for row in rows), dtype=float, count=len(rows))
+    rates = fx_rates.rates([row.currency or row.reportingCurrency for row in rows], [row.reportingCurrency for row in rows])
+    return (price * shares * rates).tolist()
+
+def apply_revaluations(rows, prices, fx_rates, reason):
+    """Write new market values, ledger rows and summary deltas for `rows` (not committed); returns the number changed."""
+    now = datetime.now(timezone.utc)
+    account_ids = [row.id for row in rows if revaluable(row, prices, fx_rates)]
+    # 加锁后重新读取余额和股数，避免覆盖期间发生的收支或转账
+    lock_accounts(account_ids)
+    rows = revaluation_rows(active_accounts().filter(Account.id.in_(account_ids))).all() if account_ids else []
+    account_updates = []
+    transactions = []
+    balance_deltas = {}
+    for row, value in zip(rows, revalued_market_values(rows, prices, fx_rates)):
+        previous_market_value = Decimal(row.marketValue or 0).quantize(CENT)
+        new_market_value = Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+        if previous_market_value != new_market_value:
+            account_updates.append({'id': row.id, 'marketValue': new_market_value, 'updatedAt': now})
+            value_delta, _ = balance_deltas.get((row.user_id, row.type), (Decimal(0), 0))
+            balance_deltas[(row.user_id, row.type)] = (value_delta + new_market_value - previous_market_value, 0)
+            transactions.append({
+                'accountId': row.id,
+                'change': new_market_value - previous_market_value,
+                'previousBalance': previous_market_value,
+                'newBalance': new_market_value,
+                'timestamp': now,
+                'createdAt': now,
+                'updatedAt': now,
+                'reason': reason
+            })
+            publish_balance(row.user_id, row.id, row.type, new_market_value - previous_market_value, new_market_value)
+
+    if account_updates:
+        db.session.execute(update(Account), account_updates)
+        db.session.execute(insert(Transaction), transactions)
+        adjust_type_balances(balance_deltas)
+    return len(account_updates)
+
+REVALUATION_COLUMNS = (Account.id, Account.user_id, Account.type, Account.stockSymbol, Account.shares, Account.marketValue,
+                       Account.currency, User.reportingCurrency)
+
+def revaluation_rows(query):
+    return query.join(User, User.id == Account.user_id).with_entities(*REVALUATION_COLUMNS)
+
+def run_bounds(name, run_date, shards):
+    """Lowest and highest active stock account id of today's run `name` in `shards` shards.
+
+    Whichever shard starts first computes them and keeps them on the '<name>:bounds/<shards>' cursor, so
+    shards started at different times split the same range.
+    """
+    bounds_name = f'{name}:bounds/{shards}'
+    cursor = db.session.get(RefreshCursor, bounds_name)
+    if cursor is None or cursor.runDate != run_date:
+        low, high = db.session.query(func.min(Account.id), func.max(Account.id)).filter(
+            Account.type == '股票账户', Account.deletedAt.is_(None)
+        ).one()
+        now = datetime.now(timezone.utc)
+        values = {'runDate': run_date, 'shardStart': low or 0, 'shardEnd': high or 0, 'startedAt': now, 'finishedAt': now}
+        try:
+            if cursor is None:
+                db.session.add(RefreshCursor(name=bounds_name, **values))
+            else:
+                # 条件更新：另一个分片已写入今天的边界时不覆盖
+                db.session.execute(update(RefreshCursor).where(RefreshCursor.name == bounds_name)
+                                   .where(RefreshCursor.runDate != run_date).values(**values))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        db.session.expire_all()
+        cursor = db.session.get(RefreshCursor, bounds_name)
+    return cursor.shardStart, cursor.shardEnd
+
+def shard_bounds(name, run_date, shard, shards):
+    """Account-id range [start, end] of shard `shard` of `shards`; the first and last shards are open-ended."""
+    if shards <= 1:
+        return None, None
+    low, high = run_bounds(name, run_date, shards)
+    size = -(-(high - low + 1) // shards)
+    start = low + shard * size
+    return None if shard == 0 else start, None if shard == shards - 1 else start + size - 1
+
+def load_refresh_cursor(name, run_date, shard, shards, restart=False):
+    """Today's cursor for shard `shard` of run `name`, resumed if it already started today, otherwise reset."""
+    cursor_name = name if shards <= 1 else f'{name}:{shard}/{shards}'
+    cursor = db.session.get(RefreshCursor, cursor_name)
+    if cursor is not None and cursor.runDate == run_date and not restart:
+        return cursor
+    start, end = shard_bounds(name, run_date, shard, shards)
+    if cursor is None:
+        cursor = RefreshCursor(name=cursor_name)
+        db.session.add(cursor)
+    cursor.runDate, cursor.shardStart, cursor.shardEnd = run_date, start, end
+    cursor.lastAccountId = (cursor.shardStart or 1) - 1
+    cursor.processed = cursor.updated = cursor.failed = 0
+    cursor.startedAt = datetime.now(timezone.utc)
+    cursor.finishedAt = None
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 另一个进程同时创建了游标，沿用它
+        db.session.rollback()
+        return db.session.get(RefreshCursor, cursor_name)
+    return cursor
+
+def dead_letter(cursor, row, error):
+    db.session.add(RefreshDeadLetter(runDate=cursor.runDate, cursorName=cursor.name, accountId=row.id,
+                                     stockSymbol=row.stockSymbol, error=str(error)[:255]))
+
+def refresh_stock_accounts(reason='Daily market value refresh', shard=0, shards=1, restart=False, name='daily-refresh'):
+    """Revalue every active stock account in id order, one committed batch at a time.
+
+    The cursor advances in the same transaction as each batch, so a run that dies part way resumes
+    after the last committed batch. Accounts whose quote keeps failing, or whose write fails, go to
+    RefreshDeadLetters instead of aborting the run. A run that already finished today is not repeated
+    unless `restart` is set.
+    """
+    cursor = load_refresh_cursor(name, date.today(), shard, shards, restart)
+    if cursor.finishedAt is not None:
+        return cursor
+    retries, backoff = app.config['REFRESH_RETRIES'], app.config['REFRESH_RETRY_BACKOFF']
+    fx_rates = revaluation_fx_rates(retries, backoff)
+
+    query = active_accounts().filter(Account.type == '股票账户')
+    if cursor.shardEnd is not None:
+        query = query.filter(Account.id <= cursor.shardEnd)
+    while True:
+        rows = revaluation_rows(query.filter(Account.id > cursor.lastAccountId)).order_by(Account.id) \
+            .limit(app.config['REFRESH_BATCH_SIZE']).all()
+        # 结束读事务，请求行情期间不持有数据库事务
+        db.session.commit()
+        if not rows:
+            break
+        prices, errors = get_stock_prices((row.stockSymbol for row in rows), retries, backoff)
+        failed = [row for row in rows if not revaluable(row, prices, fx_rates)]
+        try:
+            updated = apply_revaluations(rows, prices, fx_rates, reason)
+            for row in failed:
+                dead_letter(cursor, row, revaluation_error(row, errors))
+        except SQLAlchemyError:
+            # 批量写入失败时逐个账户重试，隔离出有问题的账户
+            db.session.rollback()
+            logging.exception(f"Batch after account {cursor.lastAccountId} failed, retrying accounts one by one")
+            updated, failed = revalue_rows_individually(cursor, rows, prices, fx_rates, reason, errors)
+        cursor.lastAccountId = rows[-1].id
+        cursor.processed += len(rows)
+        cursor.updated += updated
+        cursor.failed += len(failed)
+        publish_event(None, 'daily-refresh', refresh_progress(cursor))
+        db.session.commit()
 
-def get_exchange_rate():
-    response = requests.get(app.config['EXCHANGE_RATE_API_URL'])
-    data = response.json()
-    return data['rates']['CNY']
+    cursor.finishedAt = datetime.now(timezone.utc)
+    publish_event(None, 'daily-refresh', refresh_progress(cursor))
+    db.session.commit()
+    logging.info(f"Refresh {cursor.name} finished: {cursor.updated} of {cursor.processed} accounts revalued, {cursor.failed} dead-lettered")
+    return cursor
+
+def claim_refresh_cursor(name):
+    """Claim cursor `name` for a new run; False while an earlier run of it is still advancing."""
+    now = datetime.now(timezone.utc)
+    stale = now - timedelta(seconds=app.config['REVALUATION_STALE_SECONDS'])
+    claimed = db.session.execute(
+        update(RefreshCursor)
+        .where(RefreshCursor.name == name)
+        .where(or_(RefreshCursor.finishedAt.isnot(None), RefreshCursor.updatedAt < stale))
+        .values(finishedAt=None, startedAt=now, updatedAt=now)
+    ).rowcount
+    if not claimed:
+        if db.session.get(RefreshCursor, name) is not None:
+            db.session.rollback()
+            return False
+        db.session.add(RefreshCursor(name=name, runDate=date.today(), startedAt=now))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+def refresh_progress(cursor):
+    return {'name': cursor.name, 'processed': cursor.processed, 'updated': cursor.updated, 'failed': cursor.failed,
+            'finished': cursor.finishedAt is not None}
+
+def revalue_rows_individually(cursor, rows, prices, fx_rates, reason, errors):
+    updated, failed = 0, []
+    for row in rows:
+        if not revaluable(row, prices, fx_rates):
+            dead_letter(cursor, row, revaluation_error(row, errors))
+            db.session.commit()
+            failed.append(row)
+            continue
+        try:
+            updated += apply_revaluations([row], prices, fx_rates, reason)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            dead_letter(cursor, row, e)
+            failed.append(row)
+    return updated, failed
+
+def provisional_market_value(symbol, shares, currency, reporting_currency, previous_value=None, previous_shares=None):
+    """Value a stock holding in `reporting_currency` without calling upstream: cached quote, else the last stored close,
+    converted at the stored exchange rates.
+
+    Falls back to scaling the previous value by the change in shares, then to 0.
+    """
+    today = date.today()
+    price = quote_fetcher.get_cached_stock_price(symbol)
+    if price is None:
+        price = price_store.get_close(symbol, today)
+    fx_rates = fx_rate_table(today)
+    if price is not None and fx_rates is not None and fx_rates.has(currency) and fx_rates.has(reporting_currency):
+        return round(price * shares * fx_rates.rate(currency, reporting_currency), 2)
+    if previous_shares:
+        return round(float(previous_value or 0) / previous_shares * shares, 2)
+    return 0
+
+def queue_revaluation(account):
+    """Record a revaluation job for `account`; submit it with submit_revaluation() once committed."""
+    job = RevaluationJob(accountId=account.id, user_id=account.user_id, provisionalValue=account.marketValue or 0)
+    db.session.add(job)
+    return job
+
+def submit_revaluation(job):
+    revaluation_executor.submit(run_revaluation_job, job.id)
+
+def run_revaluation_job(job_id):
+    with app.app_context():
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=app.config['REVALUATION_STALE_SECONDS'])
+        # 条件更新认领任务，保证同一任务只被一个线程或进程执行
+        claimed = db.session.execute(
+            update(RevaluationJob)
+            .where(RevaluationJob.id == job_id)
+            .where(or_(RevaluationJob.status == 'pending',
+                       and_(RevaluationJob.status == 'running', RevaluationJob.updatedAt < stale)))
+            .values(status='running', updatedAt=now)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(RevaluationJob, job_id)
+        try:
+            errors = revalue_stock_accounts(active_accounts().filter_by(id=job.accountId), 'Market value refresh')
+        except (ValueError, KeyError, OSError) as e:
+            db.session.rollback()
+            errors = {'': str(e)}
+        job = db.session.get(RevaluationJob, job_id)
+        account = db.session.get(Account, job.accountId)
+        job.status = 'failed' if errors else 'done'
+        job.error = '; '.join(errors.values())[:255] if errors else None
+        job.marketValue = account.marketValue
+        job.finishedAt = datetime.now(timezone.utc)
+        db.session.commit()
+
+def process_pending_revaluations():
+    """Run revaluation jobs that were never picked up, e.g. because their worker process exited."""
+    with app.app_context():
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=1)
+        stale = datetime.now(timezone.utc) - timedelta(seconds=app.config['REVALUATION_STALE_SECONDS'])
+        job_ids = [job_id for (job_id,) in db.session.query(RevaluationJob.id).filter(or_(
+            and_(RevaluationJob.status == 'pending', RevaluationJob.updatedAt < cutoff),
+            and_(RevaluationJob.status == 'running', RevaluationJob.updatedAt < stale)
+        ))]
+        db.session.commit()
+    for job_id in job_ids:
+        run_revaluation_job(job_id)
 
 def is_local_network(ip):
     local_patterns = [
@@ -139,34 +563,347 @@ def is_local_network(ip):
             return True
     return False
 
+CENT = Decimal('0.01')
+
+class BalanceError(Exception):
+    def __init__(self, message, account_id=None, insufficient=False):
+        super().__init__(message)
+        self.account_id = account_id
+        self.insufficient = insufficient
+
+def to_amount(value):
+    """A positive amount as a Decimal rounded to cents; raises ValueError otherwise."""
+    try:
+        amount = Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+    except (InvalidOperation, TypeError):
+        raise ValueError(f'Invalid amount: {value}')
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError(f'Invalid amount: {value}')
+    return amount
+
+def lock_accounts(account_ids, user_id=None):
+    """Take row write locks on the active accounts in `account_ids` before reading their balances.
+
+    A no-op UPDATE locks rows on every backend (SQLite has no SELECT ... FOR UPDATE); a single
+    statement over the id list locks them in primary-key order, the same order change_balances uses.
+    """
+    if account_ids:
+        stmt = update(Account).where(Account.id.in_(account_ids), Account.deletedAt.is_(None))
+        if user_id is not None:
+            stmt = stmt.where(Account.user_id == user_id)
+        # 赋值为原值，行被锁定但内容（包括 updatedAt）不变
+        db.session.execute(stmt.values(updatedAt=Account.updatedAt).execution_options(synchronize_session=False))
+
+def change_balances(changes, user_id=None):
+    """Apply [(account_id, Decimal delta, reason)] in one transaction; does not commit.
+
+    Each balance moves with an atomic UPDATE marketValue = marketValue + delta, in ascending account id
+    order so concurrent multi-account changes cannot deadlock. Debits only apply when the balance covers
+    them; an account's credits are applied before its debits. The new balance is read back under the row
+    lock for the ledger row. Raises BalanceError and leaves the rollback to the caller when an account is
+    missing or a debit is not covered.
+    """
+    now = datetime.now(timezone.utc)
+    transactions = []
+    balance_deltas = {}
+    for account_id, delta, reason in sorted(changes, key=lambda change: (change[0], -change[1])):
+        balance = func.coalesce(Account.marketValue, 0)
+        stmt = update(Account).where(Account.id == account_id, Account.deletedAt.is_(None))
+        if user_id is not None:
+            stmt = stmt.where(Account.user_id == user_id)
+        if delta < 0:
+            stmt = stmt.where(balance >= -delta)
+        updated = db.session.execute(
+            stmt.values(marketValue=balance + delta, updatedAt=now).execution_options(synchronize_session=False)
+        ).rowcount
+        if not updated:
+            if active_accounts().filter(Account.id == account_id).count():
+                raise BalanceError('账户余额不足', account_id, insufficient=True)
+            raise BalanceError('账户未找到或无权限', account_id)
+        row = db.session.execute(
+            db.select(Account.marketValue, Account.user_id, Account.type).where(Account.id == account_id)
+        ).one()
+        new_balance = Decimal(row.marketValue).quantize(CENT)
+        transactions.append({
+            'accountId': account_id,
+            'change': delta,
+            'previousBalance': new_balance - delta,
+            'newBalance': new_balance,
+            'timestamp': now,
+            'createdAt': now,
+            'updatedAt': now,
+            'reason': reason
+        })
+        value_delta, _ = balance_deltas.get((row.user_id, row.type), (Decimal(0), 0))
+        balance_deltas[(row.user_id, row.type)] = (value_delta + delta, 0)
+        publish_balance(row.user_id, account_id, row.type, delta, new_balance)
+    db.session.execute(insert(Transaction), transactions)
+    adjust_type_balances(balance_deltas)
+    # 会话中已加载的账户对象可能持有旧余额
+    db.session.expire_all()
+    return [row['newBalance'] for row in transactions]
+
+def claim_idempotency_key(key, request_hash):
+    """Claim `key` for this request and commit the claim. Returns None if claimed, or the existing row."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    existing = db.session.get(IdempotencyKey, (current_user.id, key))
+    if existing is not None:
+        stale = existing.statusCode is None and existing.createdAt < now - timedelta(seconds=app.config['IDEMPOTENCY_LOCK_SECONDS'])
+        if existing.expiresAt > now and not stale:
+            return existing
+        # 已过期或上次请求未完成（进程中断），删除后重新认领
+        db.session.delete(existing)
+        db.session.flush()
+    db.session.add(IdempotencyKey(user_id=current_user.id, key=key, requestHash=request_hash, createdAt=now,
+                                  expiresAt=now + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 并发的相同请求已先认领
+        db.session.rollback()
+        return db.session.get(IdempotencyKey, (current_user.id, key))
+    return None
+
+def idempotent_write(func):
+    """Commit the handler's writes, deduplicated by an optional Idempotency-Key header.
+
+    The stored response is saved in the same transaction as the writes. A retry with the same key and
+    body gets that response replayed instead of being applied twice. The handler must not commit itself.
+    """
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key or not current_user.is_authenticated:
+            response = make_response(func(*args, **kwargs))
+            db.session.commit()
+            return response
+        if len(key) > 255:
+            return jsonify({'message': 'Idempotency-Key 过长'}), 400
+        request_hash = hashlib.sha256(f'{request.method} {request.path} '.encode() + request.get_data()).hexdigest()
+        existing = claim_idempotency_key(key, request_hash)
+        if existing is not None:
+            if existing.requestHash != request_hash:
+                return jsonify({'message': '该 Idempotency-Key 已用于其他请求'}), 422
+            if existing.statusCode is None:
+                return jsonify({'message': '相同请求正在处理中'}), 409
+            return Response(existing.responseBody, status=existing.statusCode, mimetype=existing.mimetype,
+                            headers={'Idempotent-Replayed': 'true'})
+        try:
+            response = make_response(func(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            IdempotencyKey.query.filter_by(user_id=current_user.id, key=key).delete()
+            db.session.commit()
+            raise
+        record = db.session.get(IdempotencyKey, (current_user.id, key))
+        record.statusCode = response.status_code
+        record.responseBody = response.get_data(as_text=True)
+        record.mimetype = response.mimetype
+        db.session.commit()
+        return response
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def purge_idempotency_keys():
+    with app.app_context():
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        deleted = IdempotencyKey.query.filter(IdempotencyKey.expiresAt < now).delete(synchronize_session=False)
+        db.session.commit()
+        logging.info(f"Purged {deleted} expired idempotency keys")
+
+def get_user_account(account_id):
+    account = db.session.get(Account, account_id)
+    if account and account.deletedAt is None and current_user.is_authenticated and account.user_id == current_user.id:
+        return account
+    return None
+
+def get_locked_user_account(account_id):
+    """get_user_account() with the row locked and reloaded, for read-modify-write of its balance."""
+    account = get_user_account(account_id)
+    if account is None:
+        return None
+    lock_accounts([account.id])
+    db.session.refresh(account)
+    if account.deletedAt is not None:
+        db.session.rollback()
+        return None
+    return account
+
+def active_accounts():
+    return Account.query.filter(Account.deletedAt.is_(None))
+
+def mark_data_changed(user_ids=None):
+    """Bump these users' dataVersion (all users if None) when the current transaction commits."""
+    changed = db.session.info.setdefault('changed_user_ids', set())
+    if user_ids is None:
+        db.session.info['changed_all_users'] = True
+    else:
+        changed.update(user_ids)
+
+@event.listens_for(db.session, 'before_commit')
+def bump_data_versions(session):
+    changed = session.info.pop('changed_user_ids', None)
+    stmt = update(User).values(dataVersion=User.dataVersion + 1, updatedAt=User.updatedAt) \
+        .execution_options(synchronize_session=False)
+    if session.info.pop('changed_all_users', False):
+        session.execute(stmt)
+    elif changed:
+        session.execute(stmt.where(User.id.in_(changed)))
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_data_changes(session):
+    session.info.pop('changed_user_ids', None)
+    session.info.pop('changed_all_users', None)
+    session.info.pop('pending_events', None)
+
+def publish_event(user_id, name, data=None):
+    """Push `name` to `user_id`'s event streams (every user's if None) once the current transaction commits."""
+    db.session.info.setdefault('pending_events', []).append((user_id, name, data))
+
+def publish_balance(user_id, account_id, type_, change, balance):
+    publish_event(user_id, 'balance', {'accountId': account_id, 'type': type_, 'change': float(change),
+                                       'marketValue': float(balance)})
+
+@event.listens_for(db.session, 'after_commit')
+def publish_pending_events(session):
+    for user_id, name, data in session.info.pop('pending_events', ()):
+        event_broker.publish(user_id, name, data)
+
+def cached_per_user(func):
+    """Serve a GET handler's 200 response from a per-user cache keyed by the user's dataVersion.
+
+    The version doubles as a strong ETag, so a matching If-None-Match gets a 304 without running the handler.
+    """
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return func(*args, **kwargs)
+        etag = f'{func.__name__}-{current_user.id}-{current_user.dataVersion}'
+        if request.query_string:
+            etag += '-' + hashlib.sha256(request.query_string).hexdigest()[:16]
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        body = response_cache.peek(etag)
+        if body is None:
+            response = make_response(func(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data(as_text=True)
+            response_cache.set(etag, body, app.config['RESPONSE_CACHE_TTL'])
+        return Response(body, mimetype='application/json', headers=headers)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def read_replica(func):
+    """Run a read-only handler's queries on DB_READ_REPLICA_URL, when one is configured; reads may lag the primary.
+
+    Not for handlers under cached_per_user: their cache key is the dataVersion read on the primary, and a lagging
+    body would be cached under it.
+    """
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def adjust_type_balances(deltas):
+    """Apply {(user_id, type): (market value delta, account count delta)} to the per-type balance summary."""
+    mark_data_changed({user_id for user_id, _ in deltas})
+    now = datetime.now(timezone.utc)
+    rows = [
+        {'user_id': user_id, 'type': type_, 'totalMarketValue': round(value_delta, 2),
+         'accountCount': count_delta, 'updatedAt': now}
+        for (user_id, type_), (value_delta, count_delta) in deltas.items()
+        if value_delta or count_delta
+    ]
+    upsert(db.session, AccountTypeBalance.__table__, rows, ['user_id', 'type'],
+           set_columns=['updatedAt'], increment_columns=['totalMarketValue', 'accountCount'])
+
+def rebuild_type_balances(user_ids=None):
+    mark_data_changed(user_ids)
+    query = db.session.query(
+        Account.user_id, Account.type, func.coalesce(func.sum(Account.marketValue), 0), func.count(Account.id)
+    ).filter(Account.deletedAt.is_(None))
+    delete_query = AccountTypeBalance.query
+    if user_ids is not None:
+        query = query.filter(Account.user_id.in_(user_ids))
+        delete_query = delete_query.filter(AccountTypeBalance.user_id.in_(user_ids))
+    delete_query.delete(synchronize_session=False)
+    now = datetime.now(timezone.utc)
+    rows = [
+        {'user_id': user_id, 'type': type_, 'totalMarketValue': total, 'accountCount': count, 'updatedAt': now}
+        for user_id, type_, total, count in query.group_by(Account.user_id, Account.type)
+    ]
+    if rows:
+        db.session.execute(insert(AccountTypeBalance), rows)
+
+def client_ip():
+    forwarded_for = request.headers.get('X-Forwarded-For', '')
+    return forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr
+
+def first_user_id():
+    return db.session.query(User.id).order_by(User.id).limit(1).scalar()
+
+def lan_user():
+    """The user local-network requests are logged in as; its id is cached so each request is one primary-key lookup."""
+    ttl = app.config['LAN_USER_CACHE_TTL']
+    user_id = lan_user_cache.get_or_fetch('lan-user', ttl, first_user_id)
+    user = db.session.get(User, user_id) if user_id is not None else None
+    if user is None and user_id is not None:
+        # 缓存的用户已不存在
+        user_id = first_user_id()
+        if user_id is not None:
+            lan_user_cache.set('lan-user', user_id, ttl)
+            user = db.session.get(User, user_id)
+    return user
+
 def local_network_or_login_required(func):
     def wrapper(*args, **kwargs):
-        forwarded_for = request.headers.get('X-Forwarded-For', '')
-        ip = forwarded_for.split(',')[0] if forwarded_for else request.remote_addr
-        if is_local_network(ip):
+        if is_local_network(client_ip()):
             if not current_user.is_authenticated:
-                user = db.session.query(User).first()
+                user = lan_user()
                 if user:
                     login_user(user)
                 else:
-                    return redirect(url_for('register'))
+                    return redirect(url_for('main.register'))
             return func(*args, **kwargs)
         return login_required(func)(*args, **kwargs)
     wrapper.__name__ = func.__name__
     return wrapper
 
-@app.route('/register', methods=['GET', 'POST'])
+def login_rate_limited(username):
+    """A 429 response when the client address or `username` has used up its login attempts, else None."""
+    for scope, key, per_minute in (('ip', client_ip(), app.config['LOGIN_IP_RATE']),
+                                   ('username', username, app.config['LOGIN_USERNAME_RATE'])):
+        if per_minute <= 0:
+            continue
+        wait = login_rate_limits.take(f'{scope}:{key}', per_minute / 60, per_minute)
+        if wait:
+            LOGIN_THROTTLED.inc(scope=scope)
+            return jsonify({'message': '尝试次数过多，请稍后再试。'}), 429, {'Retry-After': str(math.ceil(wait))}
+    return None
+
+# 密码哈希在独立进程中执行，排队已满或超时返回 503，不占用请求线程
+@bp.app_errorhandler(HasherBusy)
+def password_hasher_busy(e):
+    logging.warning(f"Password hashing busy for {request.method} {request.path}")
+    return jsonify({'message': '登录繁忙，请稍后重试'}), 503, {'Retry-After': '1'}
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        limited = login_rate_limited(username)
+        if limited:
+            return limited
 
         # Check if the username already exists
         existing_user = User.query.filter_by(username=username).first()
         if existing_user:
             return jsonify({'message': '用户名已存在，请选择其他用户名。'}), 400
+        db.session.close()  # 哈希期间不占用数据库连接
 
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        hashed_password = password_hasher.hash(password)
         new_user = User(username=username, password=hashed_password)
         try:
             db.session.add(new_user)
@@ -177,55 +914,95 @@ def register():
             return jsonify({'message': '用户名已存在，请选择其他用户名。'}), 400
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+def rehash_password(user, new_hash):
+    """Store `new_hash`, made with the current PASSWORD_HASH_METHOD, unless the password changed meanwhile.
+
+    The next login tries again when the database is unavailable; the login itself still succeeds.
+    """
+    try:
+        db.session.execute(update(User).where(User.id == user.id, User.password == user.password)
+                           .values(password=new_hash))
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        if not is_transient_error(e):
+            raise
+        logging.warning(f"Password rehash skipped for user {user.id}: {str(e).splitlines()[0][:200]}")
+
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        limited = login_rate_limited(username)
+        if limited:
+            return limited
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
-            login_user(user)
-            return jsonify({'message': '登录成功。'}), 200
-        else:
-            return jsonify({'message': '用户名或者密码错误。'}), 400
+        db.session.close()  # 哈希期间不占用数据库连接；user 保留已加载的字段
+        if user:
+            matches, new_hash = password_hasher.verify(user.password, password)
+            if matches:
+                if new_hash:
+                    rehash_password(user, new_hash)
+                login_user(user)
+                return jsonify({'message': '登录成功。'}), 200
+        return jsonify({'message': '用户名或者密码错误。'}), 400
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/')
+@bp.route('/')
 @local_network_or_login_required
 def index():
     return render_template('index.html')
 
-@app.route('/api/accounts', methods=['GET'])
+@bp.route('/api/accounts', methods=['GET'])
 @local_network_or_login_required
+@cached_per_user
 def get_accounts():
     if current_user.is_authenticated:
-        accounts = Account.query.filter_by(user_id=current_user.id).all()
-        return jsonify([account.to_dict() for account in accounts])
+        body = ACCOUNT_LIST.execute(db.session, ACCOUNT_LIST.select(
+            Account.user_id == current_user.id, Account.deletedAt.is_(None)
+        ))
+        return Response(body, mimetype='application/json')
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/accounts/<int:id>', methods=['GET'])
+@bp.route('/api/accounts/<int:id>', methods=['GET'])
 @local_network_or_login_required
+@read_replica
 def get_account(id):
-    account = db.session.get(Account, id)
-    if account and current_user.is_authenticated and account.user_id == current_user.id:
+    account = get_user_account(id)
+    if account:
         return jsonify(account.to_dict())
     return jsonify({'message': 'Account not found'}), 404
 
-@app.route('/api/accounts', methods=['POST'])
+def account_currency(type_, currency, reporting_currency):
+    """The currency column for a new account: a stock's quote currency (USD by default), None for other accounts."""
+    if type_ != '股票账户':
+        if currency and parse_currency(currency) != reporting_currency:
+            raise ValueError(f'非股票账户只能使用报告币种 {reporting_currency}')
+        return None
+    currency = parse_currency(currency or 'USD')
+    fx_rates = fx_rate_table()
+    if fx_rates is not None and not (fx_rates.has(currency) and fx_rates.has(reporting_currency)):
+        raise ValueError(f'没有 {currency} 兑 {reporting_currency} 的汇率')
+    return currency
+
+@bp.route('/api/accounts', methods=['POST'])
 @local_network_or_login_required
 def add_account():
     if current_user.is_authenticated:
         data = request.json
+        try:
+            currency = account_currency(data['type'], data.get('currency'), current_user.reportingCurrency)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
         if data['type'] == '股票账户':
-            stock_price = get_stock_price(data['stockSymbol'])
-            exchange_rate = get_exchange_rate()
-            market_value = stock_price * data['shares'] * exchange_rate
+            market_value = provisional_market_value(data['stockSymbol'], data['shares'], currency, current_user.reportingCurrency)
         else:
             market_value = data.get('marketValue', 0)
 
@@ -234,13 +1011,14 @@ def add_account():
             details=data['details'],
             stockSymbol=data.get('stockSymbol'),
             shares=data.get('shares'),
+            currency=currency,
             marketValue=market_value,
             createdAt=datetime.now(timezone.utc),
             updatedAt=datetime.now(timezone.utc),
             user_id=current_user.id
         )
         db.session.add(new_account)
-        db.session.commit()
+        db.session.flush()
 
         # Add transaction
         transaction = Transaction(
@@ -254,181 +1032,316 @@ def add_account():
             reason='Account creation'
         )
         db.session.add(transaction)
+        adjust_type_balances({(current_user.id, new_account.type): (float(market_value or 0), 1)})
+        publish_event(current_user.id, 'accounts')
+        job = queue_revaluation(new_account) if new_account.type == '股票账户' else None
         db.session.commit()
 
+        if job:
+            # 先以缓存价格入账，最终市值由后台任务计算
+            submit_revaluation(job)
+            revaluation = job.to_dict()
+            return jsonify({**new_account.to_dict(), 'revaluation': revaluation}), 202, {'Location': revaluation['url']}
         return jsonify(new_account.to_dict()), 201
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/accounts/<int:id>', methods=['PUT'])
+@bp.route('/api/accounts/<int:id>', methods=['PUT'])
 @local_network_or_login_required
 def update_account(id):
-    account = db.session.get(Account, id)
-    if account and current_user.is_authenticated and account.user_id == current_user.id:
+    account = get_locked_user_account(id)
+    if account:
         data = request.json
-        previous_market_value = float(account.marketValue)
+        previous_market_value = Decimal(account.marketValue or 0).quantize(CENT)
+        previous_shares = account.shares
         account.shares = data.get('shares', account.shares)
         if account.type == '股票账户':
-            stock_price = get_stock_price(account.stockSymbol)
-            exchange_rate = get_exchange_rate()
-            account.marketValue = stock_price * account.shares * exchange_rate
+            market_value = provisional_market_value(account.stockSymbol, account.shares or 0, account.currency,
+                                                    current_user.reportingCurrency, previous_market_value, previous_shares)
         else:
-            account.marketValue = data.get('marketValue', account.marketValue)
+            market_value = data.get('marketValue', previous_market_value)
+        try:
+            account.marketValue = Decimal(str(market_value)).quantize(CENT, rounding=ROUND_HALF_UP)
+        except InvalidOperation:
+            db.session.rollback()
+            return jsonify({'message': '请输入有效的金额'}), 400
         account.updatedAt = datetime.now(timezone.utc)
+        mark_data_changed([account.user_id])
+        publish_event(account.user_id, 'accounts')
 
         # Add transaction only if market value changed
         if account.marketValue != previous_market_value:
             transaction = Transaction(
                 accountId=account.id,
-                change=float(account.marketValue) - previous_market_value,
+                change=account.marketValue - previous_market_value,
                 previousBalance=previous_market_value,
-                newBalance=float(account.marketValue),
+                newBalance=account.marketValue,
                 timestamp=datetime.now(timezone.utc),
                 createdAt=datetime.now(timezone.utc),
                 updatedAt=datetime.now(timezone.utc),
                 reason='Account update'
             )
             db.session.add(transaction)
-            db.session.commit()
+            adjust_type_balances({(account.user_id, account.type): (account.marketValue - previous_market_value, 0)})
+        job = queue_revaluation(account) if account.type == '股票账户' else None
+        db.session.commit()
 
+        if job:
+            submit_revaluation(job)
+            revaluation = job.to_dict()
+            return jsonify({**account.to_dict(), 'revaluation': revaluation}), 202, {'Location': revaluation['url']}
         return jsonify(account.to_dict())
     return jsonify({'message': 'Account not found'}), 404
 
-@app.route('/api/accounts/<int:id>', methods=['DELETE'])
+@bp.route('/api/revaluations/<int:id>', methods=['GET'])
+@local_network_or_login_required
+def get_revaluation_job(id):
+    job = db.session.get(RevaluationJob, id)
+    if job and current_user.is_authenticated and job.user_id == current_user.id:
+        return jsonify(job.to_dict())
+    return jsonify({'message': 'Job not found'}), 404
+
+@bp.route('/api/accounts/<int:id>', methods=['DELETE'])
 @local_network_or_login_required
 def delete_account(id):
-    account = db.session.get(Account, id)
-    if account and current_user.is_authenticated and account.user_id == current_user.id:
-        previous_market_value = float(account.marketValue)
-        db.session.delete(account)
-        db.session.commit()
+    account = get_locked_user_account(id)
+    if account:
+        previous_market_value = Decimal(account.marketValue or 0).quantize(CENT)
+        now = datetime.now(timezone.utc)
+        # 软删除：保留账户行，使其流水记录仍可通过外键关联
+        account.marketValue = 0
+        account.deletedAt = now
+        account.updatedAt = now
 
-        # Add transaction
         transaction = Transaction(
             accountId=account.id,
             change=-previous_market_value,
             previousBalance=previous_market_value,
             newBalance=0,
-            timestamp=datetime.now(timezone.utc),
-            createdAt=datetime.now(timezone.utc),
-            updatedAt=datetime.now(timezone.utc),
+            timestamp=now,
+            createdAt=now,
+            updatedAt=now,
             reason='Account deletion'
         )
         db.session.add(transaction)
+        adjust_type_balances({(account.user_id, account.type): (-previous_market_value, -1)})
+        publish_event(account.user_id, 'accounts')
         db.session.commit()
 
         return jsonify({'message': 'Account deleted'})
     return jsonify({'message': 'Account not found'}), 404
 
-@app.route('/api/monthlyMarketValues', methods=['GET'])
+@bp.route('/api/monthlyMarketValues', methods=['GET'])
 @local_network_or_login_required
+@cached_per_user
 def get_monthly_market_values():
-    values = MonthlyMarketValue.query.order_by(MonthlyMarketValue.month.asc()).all()
+    body = MONTHLY_MARKET_VALUE_LIST.execute(db.session, MONTHLY_MARKET_VALUE_LIST.select(
+        MonthlyMarketValue.user_id == current_user.id
+    ).order_by(MonthlyMarketValue.month.asc()))
+    return Response(body, mimetype='application/json')
+
+@bp.route('/api/monthlyTypeMarketValues', methods=['GET'])
+@local_network_or_login_required
+@cached_per_user
+def get_monthly_type_market_values():
+    values = MonthlyTypeMarketValue.query.filter_by(user_id=current_user.id).order_by(
+        MonthlyTypeMarketValue.month.asc(), MonthlyTypeMarketValue.type.asc()
+    ).all()
     return jsonify([value.to_dict() for value in values])
 
-@app.route('/api/monthlyMarketValues', methods=['POST'])
+@bp.route('/api/monthlyMarketValues', methods=['POST'])
 @local_network_or_login_required
 def add_monthly_market_value():
     data = request.json
-    new_value = MonthlyMarketValue(
-        totalMarketValue=data['totalMarketValue'],
-        month=datetime.strptime(data['month'], '%Y-%m-%d'),
-        createdAt=datetime.now(timezone.utc),
-        updatedAt=datetime.now(timezone.utc)
-    )
-    db.session.add(new_value)
+    month = datetime.strptime(data['month'], '%Y-%m-%d').date()
+    save_monthly_snapshots({(current_user.id, month): data['totalMarketValue']}, {})
     db.session.commit()
-    return jsonify(new_value.to_dict()), 201
+    value = MonthlyMarketValue.query.filter_by(user_id=current_user.id, month=month).one()
+    return jsonify(value.to_dict()), 201
 
-@app.route('/api/refresh', methods=['POST'])
+@bp.route('/api/refresh', methods=['POST'])
 @local_network_or_login_required
 def refresh_market_values():
     if current_user.is_authenticated:
-        accounts = Account.query.filter_by(type='股票账户', user_id=current_user.id).all()
-        exchange_rate = get_exchange_rate()
-        for account in accounts:
-            stock_price = get_stock_price(account.stockSymbol)
-            previous_market_value = float(account.marketValue)
-            new_market_value = round(stock_price * account.shares * exchange_rate,2)
-            if previous_market_value != new_market_value:
-                transaction = Transaction(
-                    accountId=account.id,
-                    change=new_market_value - previous_market_value,
-                    previousBalance=previous_market_value,
-                    newBalance=new_market_value,
-                    timestamp=datetime.now(timezone.utc),
-                    createdAt=datetime.now(timezone.utc),
-                    updatedAt=datetime.now(timezone.utc),
-                    reason='Market value refresh'
-                )
-                db.session.add(transaction)
-                account.marketValue = new_market_value
-                account.updatedAt = datetime.now(timezone.utc)
-        db.session.commit()
-        return jsonify({'message': 'Market values refreshed'}), 200
+        user_id = current_user.id
+
+        def on_progress(done, total):
+            event_broker.publish(user_id, 'refresh', {'fetched': done, 'total': total, 'finished': False})
+
+        errors = revalue_stock_accounts(
+            active_accounts().filter_by(type='股票账户', user_id=user_id),
+            'Market value refresh',
+            on_progress
+        )
+        event_broker.publish(user_id, 'refresh', {'failedSymbols': sorted(errors), 'finished': True})
+        return jsonify({'message': 'Market values refreshed', 'failedSymbols': sorted(errors)}), 200
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/transfer', methods=['POST'])
+@bp.route('/api/events', methods=['GET'])
+@local_network_or_login_required
+def stream_events():
+    """Server-Sent Events stream of the user's changes.
+
+    Events: 'balance' (an account's balance moved), 'accounts' (accounts were added, edited, deleted or
+    imported: reload the list), 'refresh' (progress of the user's /api/refresh), 'daily-refresh' (progress of
+    the scheduled refresh) and 'resync' (the stream fell behind and dropped events: reload everything).
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'message': 'User not authenticated'}), 401
+    subscription = event_broker.subscribe(current_user.id)
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    # 长连接期间不占用数据库连接
+    db.session.remove()
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                events = subscription.get(heartbeat)
+                if not events:
+                    # 注释行保活，客户端已断开时写入失败，生成器随之关闭
+                    yield ': ping\n\n'
+                    continue
+                yield ''.join(f'id: {event_id}\nevent: {name}\ndata: {data}\n\n' for event_id, name, data in events)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/api/transfer', methods=['POST'])
 @local_network_or_login_required
+@idempotent_write
 def transfer_funds():
     if current_user.is_authenticated:
         data = request.json
-        from_account = db.session.get(Account, data['fromAccountId'])
-        to_account = db.session.get(Account, data['toAccountId'])
-        amount = data['amount']
+        from_account = get_user_account(data['fromAccountId'])
+        to_account = get_user_account(data['toAccountId'])
+        try:
+            amount = to_amount(data['amount'])
+        except ValueError:
+            return jsonify({'message': '请输入有效的金额'}), 400
 
-        if not from_account or not to_account or from_account.user_id != current_user.id or to_account.user_id != current_user.id:
+        if not from_account or not to_account or from_account.id == to_account.id:
             return jsonify({'message': '无效的账户ID'}), 400
 
-        if from_account.marketValue is None or from_account.marketValue < amount:
-            return jsonify({'message': '转出账户余额不足'}), 400
-
-        from_previous_balance = float(from_account.marketValue)
-        to_previous_balance = float(to_account.marketValue) or 0
+        try:
+            change_balances([
+                (from_account.id, -amount, 'Transfer out'),
+                (to_account.id, amount, 'Transfer in')
+            ], current_user.id)
+        except BalanceError as e:
+            db.session.rollback()
+            return jsonify({'message': '转出账户余额不足' if e.insufficient else str(e)}), 400
 
-        from_account.marketValue = float(from_account.marketValue) - amount
-        to_account.marketValue = float(to_account.marketValue) + amount
+        return jsonify({'message': '转账成功'}), 200
+    return jsonify({'message': 'User not authenticated'}), 401
 
-        from_transaction = Transaction(
-            accountId=from_account.id,
-            change=-amount,
-            previousBalance=from_previous_balance,
-            newBalance=float(from_account.marketValue),
-            timestamp=datetime.now(timezone.utc),
-            createdAt=datetime.now(timezone.utc),
-            updatedAt=datetime.now(timezone.utc),
-            reason='Transfer out'
-        )
-        to_transaction = Transaction(
-            accountId=to_account.id,
-            change=amount,
-            previousBalance=to_previous_balance,
-            newBalance=float(to_account.marketValue),
-            timestamp=datetime.now(timezone.utc),
-            createdAt=datetime.now(timezone.utc),
-            updatedAt=datetime.now(timezone.utc),
-            reason='Transfer in'
-        )
+@bp.route('/api/transfers/batch', methods=['POST'])
+@local_network_or_login_required
+@idempotent_write
+def batch_transfer():
+    """Apply every leg of {'legs': [{fromAccountId, toAccountId, amount}], 'reason'} or none of them."""
+    if current_user.is_authenticated:
+        data = request.json or {}
+        legs = data.get('legs')
+        if not isinstance(legs, list) or not legs:
+            return jsonify({'message': '请提供转账明细'}), 400
+        if len(legs) > app.config['MAX_TRANSFER_LEGS']:
+            return jsonify({'message': f"单次最多 {app.config['MAX_TRANSFER_LEGS']} 笔转账"}), 400
+        reason = data.get('reason')
+        changes = []
+        account_ids = set()
+        for index, leg in enumerate(legs):
+            try:
+                from_id, to_id = int(leg['fromAccountId']), int(leg['toAccountId'])
+                amount = to_amount(leg['amount'])
+            except (KeyError, TypeError, ValueError):
+                return jsonify({'message': f'第 {index + 1} 笔转账无效', 'leg': index}), 400
+            if from_id == to_id:
+                return jsonify({'message': f'第 {index + 1} 笔转账的账户相同', 'leg': index}), 400
+            changes.append((from_id, -amount, reason or 'Transfer out'))
+            changes.append((to_id, amount, reason or 'Transfer in'))
+            account_ids.update((from_id, to_id))
+        owned = active_accounts().filter(Account.user_id == current_user.id, Account.id.in_(account_ids)).count()
+        if owned != len(account_ids):
+            return jsonify({'message': '无效的账户ID'}), 400
 
-        db.session.add(from_transaction)
-        db.session.add(to_transaction)
-        db.session.commit()
+        try:
+            change_balances(changes, current_user.id)
+        except BalanceError as e:
+            db.session.rollback()
+            return jsonify({'message': str(e), 'accountId': e.account_id}), 400
 
-        return jsonify({'message': '转账成功'}), 200
+        return jsonify({'message': '转账成功', 'legs': len(legs)}), 200
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/typeMarketValues', methods=['GET'])
+@bp.route('/api/typeMarketValues', methods=['GET'])
 @local_network_or_login_required
+@cached_per_user
 def get_type_market_values():
     if current_user.is_authenticated:
-        type_market_values = db.session.query(
-            Account.type, func.sum(Account.marketValue).label('totalMarketValue')
-        ).filter(Account.user_id == current_user.id).group_by(Account.type).all()
+        type_market_values = db.session.execute(type_market_values_query(current_user.id)).all()
         result = {type_: float(marketValue) for type_, marketValue in type_market_values}
         return jsonify(result)
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/transactions', methods=['GET'])
+@bp.route('/api/portfolio/value', methods=['GET'])
+@local_network_or_login_required
+@read_replica
+def get_portfolio_value():
+    """The portfolio in ?currency= (default: the reporting currency), by account type and by currency held."""
+    if current_user.is_authenticated:
+        reporting_currency = current_user.reportingCurrency
+        try:
+            currency = parse_currency(request.args.get('currency') or reporting_currency)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        fx_rates = fx_rate_table()
+        if currency != reporting_currency and (fx_rates is None or not (fx_rates.has(currency) and fx_rates.has(reporting_currency))):
+            return jsonify({'message': f'没有 {reporting_currency} 兑 {currency} 的汇率'}), 400
+        rate = fx_rates.rate(reporting_currency, currency) if currency != reporting_currency else 1.0
+        rows = active_accounts().filter(Account.user_id == current_user.id).with_entities(
+            Account.type, Account.currency, Account.marketValue
+        ).all()
+        # 所有金额乘同一个汇率，再按账户类型和持有币种分组求和
+        values = np.fromiter((float(row.marketValue or 0) for row in rows), dtype=float, count=len(rows)) * rate
+        types, type_index = np.unique([row.type for row in rows], return_inverse=True)
+        held, held_index = np.unique([row.currency or reporting_currency for row in rows], return_inverse=True)
+        return jsonify({
+            'currency': currency,
+            'exchangeRate': rate,
+            'rateDate': fx_rates.day.strftime('%Y-%m-%d') if fx_rates is not None and fx_rates.day else None,
+            'totalMarketValue': round(float(values.sum()), 2),
+            'byType': dict(zip(types.tolist(), np.round(np.bincount(type_index, values, len(types)), 2).tolist())),
+            'byCurrency': dict(zip(held.tolist(), np.round(np.bincount(held_index, values, len(held)), 2).tolist())),
+        })
+    return jsonify({'message': 'User not authenticated'}), 401
+
+@bp.route('/api/settings', methods=['GET', 'PUT'])
+@local_network_or_login_required
+def user_settings():
+    if current_user.is_authenticated:
+        if request.method == 'PUT':
+            try:
+                currency = parse_currency(request.json.get('reportingCurrency'))
+            except ValueError as e:
+                return jsonify({'message': str(e)}), 400
+            fx_rates = fx_rate_table()
+            if fx_rates is not None and not fx_rates.has(currency):
+                return jsonify({'message': f'没有 {currency} 的汇率'}), 400
+            if currency != current_user.reportingCurrency:
+                # 已有的市值、流水和汇总都按原报告币种记账，因此只允许在创建账户之前修改
+                if Account.query.filter_by(user_id=current_user.id).first():
+                    return jsonify({'message': '已有账户时不能修改报告币种'}), 409
+                current_user.reportingCurrency = currency
+                mark_data_changed([current_user.id])
+                db.session.commit()
+        return jsonify({'reportingCurrency': current_user.reportingCurrency})
+    return jsonify({'message': 'User not authenticated'}), 401
+
+@bp.route('/api/transactions', methods=['GET'])
 @local_network_or_login_required
+@read_replica
 def get_transactions():
     if current_user.is_authenticated:
         start_date = request.args.get('start')
@@ -437,164 +1350,1560 @@ def get_transactions():
         if not start_date or not end_date:
             return jsonify({'message': '请输入有效的日期范围'}), 400
 
-        start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
-        end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1)
+        try:
+            start_datetime = datetime.strptime(start_date, '%Y-%m-%d')
+            end_datetime = datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1) - timedelta(seconds=1)
+            limit = request.args.get('limit', type=int)
+            cursor = parse_transaction_cursor(request.args.get('cursor'))
+        except ValueError:
+            return jsonify({'message': '请输入有效的日期范围'}), 400
 
-        transactions = Transaction.query.filter(
-            Transaction.timestamp >= start_datetime,
-            Transaction.timestamp <= end_datetime,
-            Transaction.accountId.in_([account.id for account in current_user.accounts])
-        ).order_by(Transaction.timestamp.desc()).all()
+        stmt = transactions_query(current_user.id, start_datetime, end_datetime)
+
+        # Keyset pagination on (timestamp, id): the next page starts strictly after the cursor row
+        if cursor:
+            cursor_timestamp, cursor_id = cursor
+            stmt = stmt.filter(or_(
+                Transaction.timestamp < cursor_timestamp,
+                and_(Transaction.timestamp == cursor_timestamp, Transaction.id < cursor_id)
+            ))
+
+        headers = {}
+        horizon = archived_ledger_horizon()
+        if limit:
+            rows = db.session.execute(stmt.limit(limit)).all()
+            if len(rows) < limit and horizon and start_datetime < day_start(horizon):
+                rows += itertools.islice(archived_transaction_rows(current_user.id, start_datetime, end_datetime, cursor),
+                                         limit - len(rows))
+            if len(rows) == limit:
+                headers['X-Next-Cursor'] = format_transaction_cursor(rows[-1].timestamp, rows[-1].id)
+        else:
+            rows = db.session.execute(stmt.execution_options(yield_per=500, statement_timeout=None))
+            if horizon and start_datetime < day_start(horizon):
+                # 已归档月份都早于表中的行，按时间倒序接在后面
+                rows = itertools.chain(rows, archived_transaction_rows(current_user.id, start_datetime, end_datetime, cursor))
+
+        def generate():
+            yield '['
+            for index, row in enumerate(rows):
+                item = json.dumps({
+                    'accountDetails': '已经删除账户' if row.deletedAt else row.details,
+                    'change': float(row.change),
+                    'reason': row.reason,
+                    'timestamp': row.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+                }, ensure_ascii=False)
+                yield item if index == 0 else ',' + item
+            yield ']'
+
+        return Response(stream_with_context(generate()), mimetype='application/json', headers=headers)
+    return jsonify({'message': 'User not authenticated'}), 401
 
-        result = []
-        for transaction in transactions:
-            account = db.session.get(Account, transaction.accountId)
-            account_details = account.details if account else '已经删除账户'
-            result.append({
-                'accountDetails': account_details,
-                'change': float(transaction.change),
-                'reason': transaction.reason,
-                'timestamp': transaction.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+ACCOUNT_EXPORT_COLUMNS = ['id', 'type', 'details', 'stockSymbol', 'shares', 'currency', 'marketValue', 'createdAt']
+TRANSACTION_EXPORT_COLUMNS = ['id', 'accountId', 'change', 'previousBalance', 'newBalance', 'timestamp', 'reason']
+
+def parse_number(row, field, required=True):
+    value = row.get(field)
+    if value is None:
+        if required:
+            raise ValueError(f'缺少字段 {field}')
+        return None
+    try:
+        number = Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f'无效的数值 {field}: {value}')
+    if not number.is_finite():
+        raise ValueError(f'无效的数值 {field}: {value}')
+    return number
+
+def parse_timestamp(row, field):
+    """Optional ISO date or datetime; aware values are converted to naive UTC like the rest of the ledger."""
+    value = row.get(field)
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f'无效的时间 {field}: {value}')
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_account_row(row, reporting_currency):
+    type_, details = row.get('type'), row.get('details')
+    if not type_ or not details:
+        raise ValueError('缺少字段 type 或 details')
+    if len(str(details)) > 100:
+        raise ValueError('details 超过 100 个字符')
+    account = {'type': str(type_)[:50], 'details': str(details), 'createdAt': parse_timestamp(row, 'createdAt')}
+    account['currency'] = account_currency(account['type'], row.get('currency'), reporting_currency)
+    if account['type'] == '股票账户':
+        symbol = row.get('stockSymbol')
+        if not symbol or len(str(symbol)) > 10:
+            raise ValueError('股票账户需要有效的 stockSymbol')
+        try:
+            shares = int(row.get('shares') or 0)
+        except (TypeError, ValueError):
+            raise ValueError(f"无效的数值 shares: {row.get('shares')}")
+        market_value = parse_number(row, 'marketValue', required=False)
+        account.update(stockSymbol=str(symbol), shares=shares,
+                       marketValue=market_value if market_value is not None else provisional_market_value(
+                           str(symbol), shares, account['currency'], reporting_currency))
+    else:
+        account.update(stockSymbol=None, shares=None, marketValue=parse_number(row, 'marketValue', required=False) or 0)
+    return account
+
+def parse_transaction_row(row):
+    try:
+        account_id = int(row.get('accountId'))
+    except (TypeError, ValueError):
+        raise ValueError(f"无效的 accountId: {row.get('accountId')}")
+    reason = row.get('reason')
+    if reason is not None and len(str(reason)) > 255:
+        raise ValueError('reason 超过 255 个字符')
+    return {
+        'accountId': account_id,
+        'change': parse_number(row, 'change'),
+        'timestamp': parse_timestamp(row, 'timestamp'),
+        'reason': str(reason) if reason is not None else None
+    }
+
+def validate_chunk(chunk, parse, summary):
+    """Parse one chunk of (line, row, error) tuples; records errors in `summary` and returns [(line, parsed)]."""
+    valid = []
+    for line, row, error in chunk:
+        if error is None:
+            try:
+                valid.append((line, parse(row)))
+                continue
+            except ValueError as e:
+                error = str(e)
+        record_import_error(summary, line, error)
+    return valid
+
+def record_import_error(summary, line, message):
+    summary['failed'] += 1
+    if len(summary['errors']) < app.config['IMPORT_MAX_ERRORS']:
+        summary['errors'].append({'line': line, 'message': message})
+
+def rebuild_history_since(earliest, user_id):
+    """Refresh `user_id`'s checkpoints and daily totals after ledger rows were written at or after `earliest`."""
+    if earliest is None:
+        return
+    day = earliest.date()
+    current_month = date.today().replace(day=1)
+    if day < current_month:
+        build_balance_checkpoints(add_months(day.replace(day=1), 1), [user_id])
+    if day < date.today():
+        build_daily_balances(day, [user_id])
+
+def import_accounts(user_id, rows):
+    """Create accounts from parsed rows in committed chunks; each gets an 'Account creation' ledger row."""
+    summary = {'imported': 0, 'failed': 0, 'errors': []}
+    earliest = None
+    reporting_currency = db.session.get(User, user_id).reportingCurrency
+    horizon = archived_ledger_horizon()
+
+    def parse(row):
+        account = parse_account_row(row, reporting_currency)
+        check_not_archived(account['createdAt'], horizon)
+        return account
+
+    for chunk in chunked(rows, app.config['IMPORT_CHUNK_SIZE']):
+        valid = validate_chunk(chunk, parse, summary)
+        if not valid:
+            continue
+        now = datetime.now(timezone.utc)
+        accounts = [{**data, 'user_id': user_id, 'createdAt': data['createdAt'] or now, 'updatedAt': now}
+                    for _, data in valid]
+        for account, account_id in zip(accounts, insert_returning_ids(db.session, Account, accounts)):
+            account['id'] = account_id
+        db.session.execute(insert(Transaction), [{
+            'accountId': account['id'],
+            'change': account['marketValue'],
+            'previousBalance': 0,
+            'newBalance': account['marketValue'],
+            'timestamp': account['createdAt'],
+            'createdAt': now,
+            'updatedAt': now,
+            'reason': 'Account creation'
+        } for account in accounts])
+        deltas = {}
+        for account in accounts:
+            value_delta, count_delta = deltas.get((user_id, account['type']), (0, 0))
+            deltas[(user_id, account['type'])] = (value_delta + float(account['marketValue'] or 0), count_delta + 1)
+        adjust_type_balances(deltas)
+        publish_event(user_id, 'accounts')
+        chunk_earliest = min(account['createdAt'].replace(tzinfo=None) for account in accounts)
+        earliest = min(earliest or chunk_earliest, chunk_earliest)
+        db.session.commit()
+        summary['imported'] += len(accounts)
+    rebuild_history_since(earliest, user_id)
+    db.session.commit()
+    return summary
+
+def import_transactions(user_id, rows):
+    """Append ledger rows and apply their changes to the accounts, in committed chunks.
+
+    Rows are applied in file order. A row may not be dated before the account's latest ledger row,
+    so each account's previousBalance/newBalance chain stays consistent.
+    """
+    summary = {'imported': 0, 'failed': 0, 'errors': []}
+    earliest = None
+    horizon = archived_ledger_horizon()
+
+    def parse(row):
+        transaction = parse_transaction_row(row)
+        check_not_archived(transaction['timestamp'], horizon)
+        return transaction
+
+    for chunk in chunked(rows, app.config['IMPORT_CHUNK_SIZE']):
+        valid = validate_chunk(chunk, parse, summary)
+        account_ids = {data['accountId'] for _, data in valid}
+        if not account_ids:
+            continue
+        lock_accounts(account_ids, user_id)
+        accounts = {
+            row.id: row for row in active_accounts().filter(Account.user_id == user_id, Account.id.in_(account_ids))
+            .with_entities(Account.id, Account.type, Account.marketValue)
+        }
+        latest = dict(db.session.query(Transaction.accountId, func.max(Transaction.timestamp))
+                      .filter(Transaction.accountId.in_(accounts)).group_by(Transaction.accountId))
+        balances = {account_id: Decimal(row.marketValue or 0).quantize(CENT) for account_id, row in accounts.items()}
+        now = datetime.now(timezone.utc)
+        naive_now = now.replace(tzinfo=None)
+        transactions = []
+        deltas = {}
+        for line, data in valid:
+            account = accounts.get(data['accountId'])
+            if account is None:
+                record_import_error(summary, line, '账户未找到或无权限')
+                continue
+            timestamp = data['timestamp'] or naive_now
+            if latest.get(account.id) and timestamp < latest[account.id]:
+                record_import_error(summary, line, '时间早于该账户最后一条流水')
+                continue
+            previous_balance = balances[account.id]
+            balances[account.id] = previous_balance + data['change']
+            latest[account.id] = timestamp
+            transactions.append({
+                'accountId': account.id,
+                'change': data['change'],
+                'previousBalance': previous_balance,
+                'newBalance': balances[account.id],
+                'timestamp': timestamp,
+                'createdAt': now,
+                'updatedAt': now,
+                'reason': data['reason']
             })
+            value_delta, _ = deltas.get((user_id, account.type), (0, 0))
+            deltas[(user_id, account.type)] = (value_delta + data['change'], 0)
+            earliest = min(earliest or timestamp, timestamp)
+        if transactions:
+            db.session.execute(insert(Transaction), transactions)
+            touched = {row['accountId'] for row in transactions}
+            db.session.execute(update(Account), [
+                {'id': account_id, 'marketValue': balances[account_id], 'updatedAt': now} for account_id in touched
+            ])
+            adjust_type_balances(deltas)
+            # 批量导入不逐笔推送余额变化，客户端整体重新加载
+            publish_event(user_id, 'accounts')
+        db.session.commit()
+        summary['imported'] += len(transactions)
+    rebuild_history_since(earliest, user_id)
+    db.session.commit()
+    return summary
+
+def export_accounts(user_id):
+    stmt = db.select(*(getattr(Account, column) for column in ACCOUNT_EXPORT_COLUMNS)).filter(
+        Account.user_id == user_id, Account.deletedAt.is_(None)
+    ).order_by(Account.id)
+    for row in db.session.execute(stmt.execution_options(yield_per=1000, statement_timeout=None)):
+        yield {
+            **row._asdict(),
+            'marketValue': float(row.marketValue) if row.marketValue is not None else 0,
+            'createdAt': row.createdAt.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+def export_transactions(user_id, start=None, end=None):
+    """The user's ledger rows with start <= timestamp < end: archived months first, then Transactions, each by id."""
+    horizon = archived_ledger_horizon()
+    if horizon and (start is None or start < day_start(horizon)):
+        account_ids = {account_id for (account_id,) in db.session.query(Account.id).filter(Account.user_id == user_id)}
+        for row in archived_ledger_rows(account_ids, start, end):
+            yield {
+                **{column: row[column] for column in TRANSACTION_EXPORT_COLUMNS},
+                'change': float(row['change']),
+                'previousBalance': float(row['previousBalance']),
+                'newBalance': float(row['newBalance']),
+                'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M:%S')
+            }
+    stmt = db.select(*(getattr(Transaction, column) for column in TRANSACTION_EXPORT_COLUMNS)).join(
+        Account, Account.id == Transaction.accountId
+    ).filter(Account.user_id == user_id).order_by(Transaction.id)
+    if start:
+        stmt = stmt.filter(Transaction.timestamp >= start)
+    if end:
+        stmt = stmt.filter(Transaction.timestamp < end)
+    for row in db.session.execute(stmt.execution_options(yield_per=1000, statement_timeout=None)):
+        yield {
+            **row._asdict(),
+            'change': float(row.change),
+            'previousBalance': float(row.previousBalance),
+            'newBalance': float(row.newBalance),
+            'timestamp': row.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+        }
 
+def request_format():
+    return resolve_format(request.args.get('format'), request.mimetype) or 'ndjson'
+
+@bp.route('/api/import/<any(accounts, transactions):kind>', methods=['POST'])
+@local_network_or_login_required
+def bulk_import(kind):
+    if current_user.is_authenticated:
+        fmt = resolve_format(request.args.get('format'), request.mimetype)
+        if fmt is None:
+            return jsonify({'message': '仅支持 CSV 或 NDJSON 格式'}), 415
+        # 逐行读取请求体，不把整个文件读入内存
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+        importer = import_accounts if kind == 'accounts' else import_transactions
+        summary = importer(current_user.id, read_rows(stream, fmt))
+        return jsonify(summary), 200 if not summary['failed'] else 207
+    return jsonify({'message': 'User not authenticated'}), 401
+
+@bp.route('/api/export/<any(accounts, transactions):kind>', methods=['GET'])
+@local_network_or_login_required
+@read_replica
+def bulk_export(kind):
+    if current_user.is_authenticated:
+        fmt = request_format()
+        if kind == 'accounts':
+            rows, columns = export_accounts(current_user.id), ACCOUNT_EXPORT_COLUMNS
+        else:
+            try:
+                start = datetime.strptime(request.args['start'], '%Y-%m-%d') if 'start' in request.args else None
+                end = datetime.strptime(request.args['end'], '%Y-%m-%d') + timedelta(days=1) if 'end' in request.args else None
+            except ValueError:
+                return jsonify({'message': '请输入有效的日期范围'}), 400
+            rows, columns = export_transactions(current_user.id, start, end), TRANSACTION_EXPORT_COLUMNS
+        filename = f"{kind}.{fmt}"
+        return Response(stream_with_context(write_rows(rows, columns, fmt)), mimetype=FORMATS[fmt],
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+    return jsonify({'message': 'User not authenticated'}), 401
+
+def type_market_values_query(user_id):
+    return db.select(AccountTypeBalance.type, AccountTypeBalance.totalMarketValue).filter(
+        AccountTypeBalance.user_id == user_id, AccountTypeBalance.accountCount > 0
+    )
+
+def transactions_query(user_id, start_datetime, end_datetime):
+    return db.select(
+        Transaction.id, Transaction.change, Transaction.reason, Transaction.timestamp,
+        Account.details, Account.deletedAt
+    ).join(Account, Account.id == Transaction.accountId).filter(
+        Account.user_id == user_id,
+        Transaction.timestamp >= start_datetime,
+        Transaction.timestamp <= end_datetime
+    ).order_by(Transaction.timestamp.desc(), Transaction.id.desc())
+
+ArchivedTransactionRow = namedtuple('ArchivedTransactionRow', 'id change reason timestamp details deletedAt')
+
+def archived_transaction_rows(user_id, start_datetime, end_datetime, cursor=None):
+    """transactions_query() rows from the archived months, newest first, continuing after `cursor`."""
+    accounts = {account_id: (details, deleted_at) for account_id, details, deleted_at in db.session.query(
+        Account.id, Account.details, Account.deletedAt).filter(Account.user_id == user_id)}
+    for row in archived_ledger_rows(accounts, start_datetime, end_datetime + timedelta(seconds=1), newest_first=True):
+        if row['timestamp'] > end_datetime or (cursor and (row['timestamp'], row['id']) >= cursor):
+            continue
+        details, deleted_at = accounts[row['accountId']]
+        yield ArchivedTransactionRow(row['id'], row['change'], row['reason'], row['timestamp'], details, deleted_at)
+
+def format_transaction_cursor(timestamp, transaction_id):
+    return f"{timestamp.strftime('%Y-%m-%dT%H:%M:%S.%f')}_{transaction_id}"
+
+def parse_transaction_cursor(cursor):
+    if not cursor:
+        return None
+    timestamp, transaction_id = cursor.rsplit('_', 1)
+    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f'), int(transaction_id)
+
+@bp.route('/api/accounts/asOf', methods=['GET'])
+@local_network_or_login_required
+@read_replica
+def get_accounts_as_of():
+    if current_user.is_authenticated:
+        try:
+            ts = parse_as_of(request.args.get('ts', ''))
+        except ValueError:
+            return jsonify({'message': '请输入有效的时间'}), 400
+        balances = balances_as_of(ts, [current_user.id])
+        accounts = Account.query.filter(
+            Account.user_id == current_user.id,
+            Account.createdAt < ts,
+            or_(Account.deletedAt.is_(None), Account.deletedAt >= ts)
+        ).all()
+        result = []
+        for account in accounts:
+            item = account.to_dict()
+            item['marketValue'] = balances.get(account.id, (None, 0))[1]
+            result.append(item)
+        return jsonify(result)
+    return jsonify({'message': 'User not authenticated'}), 401
+
+@bp.route('/api/balances/series', methods=['GET'])
+@local_network_or_login_required
+@read_replica
+def get_balance_series():
+    if current_user.is_authenticated:
+        interval = request.args.get('interval', 'day')
+        try:
+            end_day = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args else date.today()
+            start_day = (datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args
+                         else end_day - timedelta(days=365))
+        except ValueError:
+            return jsonify({'message': '请输入有效的日期范围'}), 400
+        if interval not in ('day', 'month') or start_day > end_day:
+            return jsonify({'message': '请输入有效的日期范围'}), 400
+        return jsonify(balance_series(current_user.id, start_day, end_day, interval))
+    return jsonify({'message': 'User not authenticated'}), 401
+
+@bp.route('/api/analytics', methods=['GET'])
+@local_network_or_login_required
+@read_replica
+def get_analytics():
+    if current_user.is_authenticated:
+        try:
+            end_day = datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args else date.today()
+            start_day = (datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args
+                         else end_day - timedelta(days=365))
+            window = int(request.args.get('window', 30))
+        except ValueError:
+            return jsonify({'message': '请输入有效的日期范围'}), 400
+        if start_day >= end_day or window < 2:
+            return jsonify({'message': '请输入有效的日期范围'}), 400
+
+        # 新的流水会改变水位线，从而使缓存失效
+        watermark = db.session.query(func.max(Transaction.id)).join(
+            Account, Account.id == Transaction.accountId
+        ).filter(Account.user_id == current_user.id).scalar()
+        key = f'analytics:{current_user.id}:{start_day}:{end_day}:{window}:{watermark}:{date.today()}'
+        result = analytics_cache.get_or_fetch(
+            key, app.config['ANALYTICS_CACHE_TTL'],
+            lambda: compute_analytics(current_user.id, start_day, end_day, window)
+        )
         return jsonify(result)
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/income', methods=['POST'])
+def daily_cash_flows(user_id, start_day, end_day):
+    """{day: net external flow}: every ledger change except market revaluations."""
+    day = period_key(db.session, Transaction.timestamp, 'day')
+    rows = db.session.query(day, func.sum(Transaction.change)).join(
+        Account, Account.id == Transaction.accountId
+    ).filter(
+        Account.user_id == user_id,
+        Transaction.timestamp >= day_start(start_day),
+        Transaction.timestamp < day_start(end_day + timedelta(days=1)),
+        or_(Transaction.reason.is_(None), Transaction.reason.notin_(REVALUATION_REASONS + (COMPACTED_REVALUATION_REASON,)))
+    ).group_by(day)
+    flows = {key: float(total) for key, total in rows}
+    horizon = archived_ledger_horizon()
+    if horizon and start_day < horizon:
+        account_ids = {account_id for (account_id,) in db.session.query(Account.id).filter(Account.user_id == user_id)}
+        for row in archived_ledger_rows(account_ids, day_start(start_day), day_start(end_day + timedelta(days=1))):
+            if row['reason'] not in REVALUATION_REASONS + (COMPACTED_REVALUATION_REASON,):
+                key = row['timestamp'].strftime('%Y-%m-%d')
+                flows[key] = flows.get(key, 0) + float(row['change'])
+    return flows
+
+def compute_analytics(user_id, start_day, end_day, window):
+    series = balance_series(user_id, start_day, end_day)
+    flows = daily_cash_flows(user_id, start_day, end_day)
+    dates = [point['date'] for point in series]
+    values = [point['totalMarketValue'] for point in series]
+    result = portfolio_analytics(dates, values, [flows.get(day, 0) for day in dates], window)
+
+    start_month = start_day.replace(day=1)
+    start_totals = {
+        type_: float(total) for type_, total in db.session.query(
+            MonthlyTypeMarketValue.type, MonthlyTypeMarketValue.totalMarketValue
+        ).filter_by(user_id=user_id, month=start_month)
+    }
+    end_totals = {type_: float(total) for type_, total in db.session.execute(type_market_values_query(user_id))}
+    result['allocationDrift'] = {
+        'since': start_month.strftime('%Y-%m-%d'),
+        'types': allocation_drift(start_totals, end_totals)
+    }
+    return result
+
+@bp.route('/api/accounts/<int:id>/valuation', methods=['GET'])
 @local_network_or_login_required
+@read_replica
+def get_account_valuation(id):
+    account = get_user_account(id)
+    if not account or account.type != '股票账户':
+        return jsonify({'message': 'Account not found'}), 404
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d').date() if 'date' in request.args else date.today()
+    except ValueError:
+        return jsonify({'message': '请输入有效的日期'}), 400
+    valuation = value_stock_on(account.stockSymbol, account.shares or 0, day, account.currency or 'USD',
+                               current_user.reportingCurrency)
+    if valuation is None:
+        return jsonify({'message': f'No local price or exchange rate history for {account.stockSymbol} on {day}'}), 404
+    return jsonify({'id': account.id, 'date': day.strftime('%Y-%m-%d'), **valuation})
+
+def value_stock_on(symbol, shares, day, currency, reporting_currency):
+    """Value `shares` of `symbol`, quoted in `currency`, in `reporting_currency` on `day` from the local price store
+    and FX rate table (last close and rates on or before it)."""
+    price = price_store.get_close(symbol, day)
+    fx_rates = fx_rate_table(day)
+    if price is None or fx_rates is None or not (fx_rates.has(currency) and fx_rates.has(reporting_currency)):
+        return None
+    exchange_rate = fx_rates.rate(currency, reporting_currency)
+    return {
+        'stockSymbol': symbol,
+        'shares': shares,
+        'price': price,
+        'exchangeRate': exchange_rate,
+        'marketValue': round(price * shares * exchange_rate, 2)
+    }
+
+def price_history_symbols():
+    symbols = [symbol for (symbol,) in active_accounts().filter_by(type='股票账户').with_entities(Account.stockSymbol).distinct() if symbol]
+    return sorted(symbols) + [app.config['PRICE_HISTORY_FX_SYMBOL']]
+
+def update_price_history():
+    today = date.today()
+    stored, errors = backfill_prices(price_store, quote_fetcher, price_history_symbols(), today - timedelta(days=7), today)
+    logging.info(f"Price history updated for {len(stored)} symbols ({len(errors)} failed)")
+
+def parse_as_of(value):
+    # A bare date means the end of that day
+    if len(value) == 10:
+        return datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+@bp.route('/api/income', methods=['POST'])
+@local_network_or_login_required
+@idempotent_write
 def add_income():
     if current_user.is_authenticated:
         data = request.json
-        account = db.session.get(Account, data['accountId'])
-        if account and account.user_id == current_user.id:
-            amount = data['amount']
-            account.marketValue = float(account.marketValue) + amount
-            transaction = Transaction(
-                accountId=account.id,
-                change=amount,
-                previousBalance=float(account.marketValue) - amount,
-                newBalance=float(account.marketValue),
-                timestamp=datetime.now(timezone.utc),
-                createdAt=datetime.now(timezone.utc),
-                updatedAt=datetime.now(timezone.utc),
-                reason=data['reason']
-            )
-            db.session.add(transaction)
-            db.session.commit()
+        account = get_user_account(data['accountId'])
+        if account:
+            try:
+                amount = to_amount(data['amount'])
+            except ValueError:
+                return jsonify({'message': '请输入有效的金额'}), 400
+            try:
+                change_balances([(account.id, amount, data['reason'])], current_user.id)
+            except BalanceError as e:
+                db.session.rollback()
+                return jsonify({'message': str(e)}), 400
             return jsonify({'message': '收入已记录'}), 200
         return jsonify({'message': '账户未找到或无权限'}), 404
     return jsonify({'message': 'User not authenticated'}), 401
 
-@app.route('/api/expense', methods=['POST'])
+@bp.route('/api/expense', methods=['POST'])
 @local_network_or_login_required
+@idempotent_write
 def add_expense():
     if current_user.is_authenticated:
         data = request.json
-        account = db.session.get(Account, data['accountId'])
-        if account and account.user_id == current_user.id:
-            amount = data['amount']
-            if account.marketValue is None or account.marketValue < amount:
-                return jsonify({'message': '账户余额不足'}), 400
-            account.marketValue = float(account.marketValue) - amount
-            transaction = Transaction(
-                accountId=account.id,
-                change=-amount,
-                previousBalance=float(account.marketValue) + amount,
-                newBalance=float(account.marketValue),
-                timestamp=datetime.now(timezone.utc),
-                createdAt=datetime.now(timezone.utc),
-                updatedAt=datetime.now(timezone.utc),
-                reason=data['reason']
-            )
-            db.session.add(transaction)
-            db.session.commit()
+        account = get_user_account(data['accountId'])
+        if account:
+            try:
+                amount = to_amount(data['amount'])
+            except ValueError:
+                return jsonify({'message': '请输入有效的金额'}), 400
+            try:
+                change_balances([(account.id, -amount, data['reason'])], current_user.id)
+            except BalanceError as e:
+                db.session.rollback()
+                return jsonify({'message': str(e)}), 400
             return jsonify({'message': '支出已记录'}), 200
         return jsonify({'message': '账户未找到或无权限'}), 404
     return jsonify({'message': 'User not authenticated'}), 401
 
-def refresh_daily_stock_market_values():
+def refresh_daily_fx_rates():
     with app.app_context():
-        accounts = Account.query.filter_by(type='股票账户').all()
-        exchange_rate = get_exchange_rate()
-        for account in accounts:
-            try:
-                stock_price = get_stock_price(account.stockSymbol)
-                previous_market_value = float(account.marketValue)
-                new_market_value = round(stock_price * account.shares * exchange_rate,2)
-                if previous_market_value != new_market_value:
-                    transaction = Transaction(
-                        accountId=account.id,
-                        change=new_market_value - previous_market_value,
-                        previousBalance=previous_market_value,
-                        newBalance=new_market_value,
-                        timestamp=datetime.now(timezone.utc),
-                        createdAt=datetime.now(timezone.utc),
-                        updatedAt=datetime.now(timezone.utc),
-                        reason='Daily market value refresh'
-                    )
-                    db.session.add(transaction)
-                    account.marketValue = new_market_value
-                    account.updatedAt = datetime.now(timezone.utc)
-            except ValueError as e:
-                logging.error(f"Error updating stock price for {account.stockSymbol}: {e}")
+        with_retries(refresh_fx_rates, app.config['REFRESH_RETRIES'], app.config['REFRESH_RETRY_BACKOFF'])
+
+def refresh_daily_stock_market_values(reason='Daily market value refresh', name='daily-refresh', restart=False):
+    with app.app_context():
+        cursor = refresh_stock_accounts(reason, restart=restart, name=name)
+        progress = refresh_progress(cursor)
+        build_daily_balances()
         db.session.commit()
+        if app.config['PRICE_STORE_DAILY_UPDATE']:
+            update_price_history()
+        return progress
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+def save_monthly_snapshots(totals, type_totals):
+    """Upsert {(user_id, month): total} and {(user_id, month, type): total}; re-running a month overwrites it."""
+    mark_data_changed({user_id for user_id, _ in totals} | {user_id for user_id, _, _ in type_totals})
+    now = datetime.now(timezone.utc)
+    upsert(db.session, MonthlyMarketValue.__table__, [
+        {'user_id': user_id, 'month': month, 'totalMarketValue': round(total, 2), 'createdAt': now, 'updatedAt': now}
+        for (user_id, month), total in totals.items()
+    ], ['user_id', 'month'], set_columns=['totalMarketValue', 'updatedAt'])
+    upsert(db.session, MonthlyTypeMarketValue.__table__, [
+        {'user_id': user_id, 'month': month, 'type': type_, 'totalMarketValue': round(total, 2), 'updatedAt': now}
+        for (user_id, month, type_), total in type_totals.items()
+    ], ['user_id', 'month', 'type'], set_columns=['totalMarketValue', 'updatedAt'])
+
+def snapshot_current_month(user_ids=None):
+    month = date.today().replace(day=1)
+    query = db.session.query(AccountTypeBalance.user_id, AccountTypeBalance.type, AccountTypeBalance.totalMarketValue)
+    if user_ids is not None:
+        query = query.filter(AccountTypeBalance.user_id.in_(user_ids))
+    totals, type_totals = {}, {}
+    for user_id, type_, total in query.filter(AccountTypeBalance.accountCount > 0):
+        totals[(user_id, month)] = totals.get((user_id, month), 0) + float(total)
+        type_totals[(user_id, month, type_)] = float(total)
+    save_monthly_snapshots(totals, type_totals)
+
+def month_range(start_month, end_month):
+    months = []
+    month = start_month.replace(day=1)
+    while month <= end_month:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+def day_start(day):
+    return datetime.combine(day, datetime.min.time())
+
+def last_ledger_rows(before, since=None, interval=None, user_ids=None, order_by_period=False):
+    """Last ledger row per account (per period when `interval` is 'day' or 'month') with since <= timestamp < before."""
+    period = period_key(db.session, Transaction.timestamp, interval) if interval else None
+    partition_by = (Transaction.accountId, period) if interval else (Transaction.accountId,)
+    ranked = db.select(
+        Transaction.accountId, Account.user_id, Account.type, Transaction.newBalance,
+        (period if interval else db.literal(None)).label('period'),
+        func.row_number().over(
+            partition_by=partition_by,
+            order_by=(Transaction.timestamp.desc(), Transaction.id.desc())
+        ).label('rank')
+    ).join(Account, Account.id == Transaction.accountId).filter(Transaction.timestamp < before)
+    if since is not None:
+        ranked = ranked.filter(Transaction.timestamp >= since)
+    if user_ids is not None:
+        ranked = ranked.filter(Account.user_id.in_(user_ids))
+    ranked = ranked.subquery()
+    order_by = (ranked.c.period, ranked.c.accountId) if order_by_period else (ranked.c.accountId, ranked.c.period)
+    return db.session.execute(
+        db.select(ranked.c.accountId, ranked.c.user_id, ranked.c.type, ranked.c.period, ranked.c.newBalance)
+        .filter(ranked.c.rank == 1)
+        .order_by(*order_by)
+    )
+
+def latest_checkpoint_month(month, inclusive=True):
+    query = db.session.query(func.max(BalanceCheckpoint.month))
+    if inclusive:
+        return query.filter(BalanceCheckpoint.month <= month).scalar()
+    return query.filter(BalanceCheckpoint.month < month).scalar()
+
+def checkpoint_balances(checkpoint_month, user_ids=None):
+    query = db.session.query(
+        BalanceCheckpoint.accountId, Account.user_id, Account.type, BalanceCheckpoint.balance
+    ).join(Account, Account.id == BalanceCheckpoint.accountId).filter(BalanceCheckpoint.month == checkpoint_month)
+    if user_ids is not None:
+        query = query.filter(Account.user_id.in_(user_ids))
+    return query
+
+def replay_month_starts(months, user_ids=None):
+    """Yield (account_id, user_id, type, month, balance) at the start of each month in `months`.
+
+    Replay starts from the newest checkpoint strictly before the first month, so only ledger rows
+    after it are read. Accounts with no history before a month are skipped for that month.
+    """
+    checkpoint_month = latest_checkpoint_month(months[0], inclusive=False)
+    accounts = {}
+    if checkpoint_month:
+        for account_id, user_id, type_, balance in checkpoint_balances(checkpoint_month, user_ids):
+            accounts[account_id] = (user_id, type_, float(balance), [])
+    rows = last_ledger_rows(
+        day_start(months[-1]), since=day_start(checkpoint_month) if checkpoint_month else None,
+        interval='month', user_ids=user_ids
+    )
+    for row in rows:
+        accounts.setdefault(row.accountId, (row.user_id, row.type, None, []))[3].append(row)
+
+    month_keys = [month.strftime('%Y-%m') for month in months]
+    for account_id, (user_id, type_, balance, account_rows) in accounts.items():
+        # A ledger row affects every month start after the month it falls in
+        index = 0
+        for month, key in zip(months, month_keys):
+            while index < len(account_rows) and account_rows[index].period < key:
+                balance = float(account_rows[index].newBalance)
+                index += 1
+            if balance is not None:
+                yield account_id, user_id, type_, month, balance
+
+def backfill_monthly_snapshots(start_month, end_month, user_ids=None):
+    """Rebuild snapshots for every month in [start_month, end_month] by replaying the ledger.
+
+    A month's snapshot is the balance at the start of its first day, i.e. the newBalance of each
+    account's last ledger row before that instant.
+    """
+    months = month_range(start_month, end_month)
+    if not months:
+        return 0
+    totals, type_totals = {}, {}
+    for _, user_id, type_, month, balance in replay_month_starts(months, user_ids):
+        totals[(user_id, month)] = totals.get((user_id, month), 0) + balance
+        type_totals[(user_id, month, type_)] = type_totals.get((user_id, month, type_), 0) + balance
+    save_monthly_snapshots(totals, type_totals)
+    return len(totals)
+
+def build_balance_checkpoints(since_month=None, user_ids=None):
+    """(Re)build per-account month-start checkpoints from `since_month` (default: after the newest one) to now.
+
+    With `user_ids`, only their accounts' checkpoints are rebuilt, and only up to the newest checkpoint month
+    already built for everyone: a month that holds checkpoints for some users only would read as zero for the rest.
+    """
+    current_month = date.today().replace(day=1)
+    if user_ids is not None:
+        current_month = latest_checkpoint_month(current_month)
+        if current_month is None:
+            return 0
+    if since_month is None:
+        latest = latest_checkpoint_month(current_month)
+        if latest:
+            since_month = add_months(latest, 1)
+        else:
+            first_timestamp = db.session.query(func.min(Transaction.timestamp)).scalar()
+            if first_timestamp is None:
+                return 0
+            since_month = add_months(first_timestamp.date().replace(day=1), 1)
+    months = month_range(since_month, current_month)
+    if not months:
+        return 0
+    stale = BalanceCheckpoint.query.filter(BalanceCheckpoint.month >= months[0])
+    if user_ids is not None:
+        stale = stale.filter(BalanceCheckpoint.accountId.in_(
+            db.select(Account.id).where(Account.user_id.in_(user_ids))
+        ))
+    stale.delete(synchronize_session=False)
+    # Zero balances are not stored: no checkpoint row means a zero balance at that month start
+    rows = [
+        {'accountId': account_id, 'month': month, 'balance': round(balance, 2)}
+        for account_id, _, _, month, balance in replay_month_starts(months, user_ids)
+        if balance
+    ]
+    if rows:
+        db.session.execute(insert(BalanceCheckpoint), rows)
+    return len(rows)
+
+def balances_as_of(ts, user_ids=None):
+    """{account_id: (user_id, balance)} at instant `ts`: the month-start checkpoint plus ledger rows after it."""
+    checkpoint_month = latest_checkpoint_month(ts.date())
+    balances = {}
+    if checkpoint_month:
+        balances = {
+            account_id: (user_id, float(balance))
+            for account_id, user_id, _, balance in checkpoint_balances(checkpoint_month, user_ids)
+        }
+    since = day_start(checkpoint_month) if checkpoint_month else None
+    for row in last_ledger_rows(ts, since=since, user_ids=user_ids):
+        balances[row.accountId] = (row.user_id, float(row.newBalance))
+    return balances
+
+def replay_daily_totals(start_day, end_day, user_ids=None):
+    """Yield (user_id, day, total) at the end of each day in [start_day, end_day] for users with history."""
+    days = [start_day + timedelta(days=offset) for offset in range((end_day - start_day).days + 1)]
+    if not days:
+        return
+    balances = balances_as_of(day_start(start_day), user_ids)
+    totals = {}
+    for user_id, balance in balances.values():
+        totals[user_id] = totals.get(user_id, 0) + balance
+    rows = last_ledger_rows(
+        day_start(end_day + timedelta(days=1)), since=day_start(start_day), interval='day',
+        user_ids=user_ids, order_by_period=True
+    )
+    row = next(rows, None)
+    for day in days:
+        key = day.strftime('%Y-%m-%d')
+        while row is not None and row.period == key:
+            new_balance = float(row.newBalance)
+            _, previous_balance = balances.get(row.accountId, (row.user_id, 0))
+            totals[row.user_id] = totals.get(row.user_id, 0) + new_balance - previous_balance
+            balances[row.accountId] = (row.user_id, new_balance)
+            row = next(rows, None)
+        for user_id, total in totals.items():
+            yield user_id, day, total
+
+def build_daily_balances(since_day=None, user_ids=None):
+    """(Re)build per-user end-of-day totals from `since_day` (default: after the newest one) through yesterday,
+    for `user_ids` (default: every user)."""
+    yesterday = date.today() - timedelta(days=1)
+    if since_day is None:
+        latest = db.session.query(func.max(DailyBalance.day)).scalar()
+        if latest:
+            since_day = latest + timedelta(days=1)
+        else:
+            first_timestamp = db.session.query(func.min(Transaction.timestamp)).scalar()
+            if first_timestamp is None:
+                return 0
+            since_day = first_timestamp.date()
+    if since_day > yesterday:
+        return 0
+    stale = DailyBalance.query.filter(DailyBalance.day >= since_day)
+    if user_ids is not None:
+        stale = stale.filter(DailyBalance.user_id.in_(user_ids))
+    stale.delete(synchronize_session=False)
+    rows = [
+        {'user_id': user_id, 'day': day, 'totalMarketValue': round(total, 2)}
+        for user_id, day, total in replay_daily_totals(since_day, yesterday, user_ids)
+    ]
+    if rows:
+        db.session.execute(insert(DailyBalance), rows)
+    return len(rows)
+
+def balance_series(user_id, start_day, end_day, interval='day'):
+    """Portfolio total at the end of each day (or month) from start_day to end_day.
+
+    Days up to the newest DailyBalances checkpoint are read directly; later days are replayed from the ledger.
+    """
+    daily = {}
+    replay_from = start_day
+    last_built = db.session.query(func.max(DailyBalance.day)).filter(DailyBalance.user_id == user_id).scalar()
+    if last_built and last_built >= start_day:
+        built_end = min(end_day, last_built)
+        daily.update(db.session.query(DailyBalance.day, DailyBalance.totalMarketValue).filter(
+            DailyBalance.user_id == user_id, DailyBalance.day >= start_day, DailyBalance.day <= built_end
+        ))
+        replay_from = built_end + timedelta(days=1)
+    if replay_from <= end_day:
+        daily.update((day, total) for _, day, total in replay_daily_totals(replay_from, end_day, [user_id]))
+
+    if interval == 'month':
+        # Value at the end of each month, or at end_day for the last, partial month
+        points = [min(add_months(month, 1) - timedelta(days=1), end_day) for month in month_range(start_day, end_day)]
+        labels = month_range(start_day, end_day)
+    else:
+        points = [start_day + timedelta(days=offset) for offset in range((end_day - start_day).days + 1)]
+        labels = points
+    return [
+        {'date': label.strftime('%Y-%m-%d'), 'totalMarketValue': round(float(daily.get(point, 0)), 2)}
+        for label, point in zip(labels, points)
+    ]
 
 def calculate_monthly_total_market_value():
     with app.app_context():
-        accounts = Account.query.all()
-        total_market_value = sum(float(account.marketValue) or 0 for account in accounts)
-        new_value = MonthlyMarketValue(
-            totalMarketValue=total_market_value,
-            month=date.today().replace(day=1),
-            createdAt=datetime.now(timezone.utc),
-            updatedAt=datetime.now(timezone.utc)
-        )
-        db.session.add(new_value)
+        snapshot_current_month()
+        build_balance_checkpoints()
+        db.session.commit()
+
+LEDGER_ROW_COLUMNS = (Transaction.id, Transaction.accountId, Transaction.change, Transaction.previousBalance,
+                      Transaction.newBalance, Transaction.timestamp, Transaction.createdAt, Transaction.updatedAt,
+                      Transaction.reason)
+
+def months_ago(months):
+    return add_months(date.today().replace(day=1), -months)
+
+def ledger_partitions():
+    """Partition names of Transactions on MySQL, in order; [] on other databases or an unpartitioned table."""
+    if db.session.get_bind().dialect.name != 'mysql':
+        return []
+    return [name for (name,) in db.session.execute(db.text(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS WHERE TABLE_SCHEMA = DATABASE() "
+        "AND TABLE_NAME = 'Transactions' AND PARTITION_NAME IS NOT NULL ORDER BY PARTITION_ORDINAL_POSITION"
+    ))]
+
+def ensure_ledger_partitions():
+    """Split pmax so the current month and the next LEDGER_PARTITIONS_AHEAD months each have a partition."""
+    partitions = ledger_partitions()
+    if 'pmax' not in partitions:
+        return []
+    months = [month for month in map(partition_month, partitions) if month]
+    current_month = date.today().replace(day=1)
+    first_missing = next_month(max(months)) if months else current_month
+    missing = month_range(first_missing, add_months(current_month, app.config['LEDGER_PARTITIONS_AHEAD']))
+    if missing:
+        # REORGANIZE 只改写 pmax 中的行，正常情况下 pmax 为空
+        db.session.execute(db.text(
+            f'ALTER TABLE Transactions REORGANIZE PARTITION pmax INTO '
+            f'({partition_definitions(missing)}, PARTITION pmax VALUES LESS THAN MAXVALUE)'
+        ))
+    return missing
+
+def archived_ledger_horizon():
+    """First month still in Transactions when older months have been archived, else None."""
+    latest = db.session.query(func.max(ArchivedLedgerMonth.month)).scalar()
+    return next_month(latest) if latest else None
+
+def check_not_archived(timestamp, horizon):
+    if horizon and timestamp and timestamp < day_start(horizon):
+        raise ValueError(f"{horizon.strftime('%Y-%m')} 之前的流水已归档，不能再写入")
+
+def compact_ledger(before=None):
+    """Merge each account's consecutive revaluation rows in every month before `before` (default:
+    LEDGER_COMPACT_AFTER_MONTHS ago) into one 'Monthly market value refresh' row; returns the number of rows removed.
+
+    Only revaluation rows with no income, expense or transfer between them are merged, into the last row of the run,
+    which takes the run's total change and the newBalance of the row before the run as its previousBalance, so the
+    previousBalance -> newBalance chain and the balance after every other row are unchanged. The replaced rows are written to compacted-YYYY-MM-* files first.
+    """
+    before = before or months_ago(app.config['LEDGER_COMPACT_AFTER_MONTHS'])
+    first = db.session.query(func.min(Transaction.timestamp)).filter(
+        Transaction.reason.in_(REVALUATION_REASONS), Transaction.timestamp < day_start(before)
+    ).scalar()
+    db.session.commit()
+    if first is None:
+        return 0
+    removed = 0
+    for month in month_range(first.date().replace(day=1), add_months(before, -1)):
+        removed += compact_ledger_month(month)
+    logging.info(f"Compacted {removed} revaluation ledger rows before {before}")
+    return removed
+
+def compact_ledger_month(month):
+    start, end = day_start(month), day_start(next_month(month))
+    in_month = and_(Transaction.timestamp >= start, Transaction.timestamp < end)
+    account_ids = [account_id for (account_id,) in db.session.query(Transaction.accountId)
+                   .filter(in_month, Transaction.reason.in_(REVALUATION_REASONS))
+                   .distinct().order_by(Transaction.accountId)]
+    removed = 0
+    for batch in chunked(account_ids, app.config['LEDGER_BATCH_SIZE']):
+        rows = db.session.execute(db.select(*LEDGER_ROW_COLUMNS).filter(in_month, Transaction.accountId.in_(batch))
+                                  .order_by(Transaction.accountId, Transaction.timestamp, Transaction.id)).all()
+        runs = revaluation_runs(rows)
+        if not runs:
+            continue
+        # 文件名由行 id 决定，提交前中断后重跑会覆盖同一个文件
+        replaced = [row for run, _ in runs for row in run]
+        ids = [row.id for row in replaced]
+        ledger_files.write(f"compacted-{month.strftime('%Y-%m')}-{min(ids)}-{max(ids)}", replaced)
+        now = datetime.now(timezone.utc)
+        db.session.execute(update(Transaction), [
+            {'id': run[-1].id, 'change': sum(row.change for row in run), 'previousBalance': previous_balance,
+             'reason': COMPACTED_REVALUATION_REASON, 'updatedAt': now}
+            for run, previous_balance in runs
+        ])
+        deleted = [row.id for run, _ in runs for row in run[:-1]]
+        for chunk in chunked(deleted, 1000):
+            db.session.execute(delete(Transaction).where(
+                Transaction.id.in_(chunk), Transaction.timestamp >= start, Transaction.timestamp < end
+            ).execution_options(synchronize_session=False))
         db.session.commit()
+        removed += len(deleted)
+    return removed
+
+def revaluation_runs(rows):
+    """Runs of two or more consecutive revaluation rows of one account in `rows` (ordered by account, timestamp and
+    id), each with the previousBalance its merged row takes: the newBalance of the row before the run."""
+    mergeable = (*REVALUATION_REASONS, COMPACTED_REVALUATION_REASON)
+    runs = []
+    for _, account_rows in itertools.groupby(rows, key=lambda row: row.accountId):
+        previous, run = None, []
+        for row in itertools.chain(account_rows, [None]):
+            if row is not None and row.reason in mergeable:
+                run.append(row)
+                continue
+            if len(run) > 1:
+                runs.append((run, previous.newBalance if previous is not None else run[0].previousBalance))
+            previous, run = row, []
+    return runs
+
+def ledger_chain_breaks(account_ids=None):
+    """Ledger rows in Transactions whose previousBalance is not the newBalance of the account's row before them, or
+    whose change does not lead from previousBalance to newBalance, as (accountId, transaction id) pairs."""
+    query = db.select(Transaction.id, Transaction.accountId, Transaction.change, Transaction.previousBalance,
+                      Transaction.newBalance).order_by(Transaction.accountId, Transaction.timestamp, Transaction.id)
+    if account_ids is not None:
+        query = query.filter(Transaction.accountId.in_(account_ids))
+    breaks = []
+    previous = None
+    for row in db.session.execute(query).yield_per(5000):
+        chained = previous is None or previous.accountId != row.accountId or previous.newBalance == row.previousBalance
+        if not chained or row.previousBalance + row.change != row.newBalance:
+            breaks.append((row.accountId, row.id))
+        previous = row
+    return breaks
+
+def archivable_before():
+    """First month that must stay in Transactions: point-in-time queries over archived months are answered from
+    balance checkpoints and daily balances, so only months both already cover can be archived."""
+    checkpoint = latest_checkpoint_month(date.today())
+    last_day = db.session.query(func.max(DailyBalance.day)).scalar()
+    if checkpoint is None or last_day is None:
+        return None
+    return min(checkpoint, (last_day + timedelta(days=1)).replace(day=1))
+
+def archive_ledger(before=None):
+    """Move every month of Transactions before `before` (default: LEDGER_ARCHIVE_AFTER_MONTHS ago) to compressed
+    files, oldest first; returns the archived months."""
+    if before is None:
+        if not app.config['LEDGER_ARCHIVE_AFTER_MONTHS']:
+            return []
+        before = months_ago(app.config['LEDGER_ARCHIVE_AFTER_MONTHS'])
+    horizon = archived_ledger_horizon()
+    if horizon:
+        # 上次归档后若在删除分区前中断，先清理已归档月份的残留行
+        purge_archived_ledger(horizon)
+    ready = archivable_before()
+    if ready is None:
+        logging.warning("Ledger not archived: build balance checkpoints and daily balances first")
+        return []
+    first = horizon
+    if first is None:
+        first_timestamp = db.session.query(func.min(Transaction.timestamp)).scalar()
+        if first_timestamp is None:
+            return []
+        first = first_timestamp.date().replace(day=1)
+    db.session.commit()
+    months = month_range(first, add_months(min(before, ready), -1))
+    for month in months:
+        archive_ledger_month(month)
+    if months:
+        logging.info(f"Archived ledger months {months[0]:%Y-%m} to {months[-1]:%Y-%m}")
+    return months
+
+def archive_ledger_month(month):
+    start, end = day_start(month), day_start(next_month(month))
+    rows = db.session.execute(db.select(*LEDGER_ROW_COLUMNS).filter(
+        Transaction.timestamp >= start, Transaction.timestamp < end
+    ).order_by(Transaction.id).execution_options(yield_per=1000))
+    count, digest = ledger_files.write(f"transactions-{month.strftime('%Y-%m')}", rows)
+    db.session.add(ArchivedLedgerMonth(month=month, rowCount=count, sha256=digest))
+    db.session.commit()
+    purge_archived_ledger(next_month(month))
+
+def purge_archived_ledger(horizon):
+    """Remove the rows before `horizon` from Transactions: drop their MySQL partitions, delete them elsewhere."""
+    for name in ledger_partitions():
+        month = partition_month(name)
+        if month and month < horizon:
+            # DDL 会隐式提交，归档记录已先行提交
+            db.session.execute(db.text(f'ALTER TABLE Transactions DROP PARTITION {name}'))
+    db.session.execute(delete(Transaction).where(Transaction.timestamp < day_start(horizon))
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+
+def archived_ledger_rows(account_ids, start=None, end=None, newest_first=False):
+    """Archived ledger rows of `account_ids` with start <= timestamp < end, read from the monthly files.
+
+    Rows come month by month, oldest month first in id order, or with `newest_first` newest first by (timestamp, id).
+    """
+    query = db.session.query(ArchivedLedgerMonth.month).filter(ArchivedLedgerMonth.rowCount > 0)
+    if start is not None:
+        query = query.filter(ArchivedLedgerMonth.month >= start.date().replace(day=1))
+    if end is not None:
+        query = query.filter(ArchivedLedgerMonth.month <= end.date())
+    months = [month for (month,) in query.order_by(
+        ArchivedLedgerMonth.month.desc() if newest_first else ArchivedLedgerMonth.month
+    )]
+    for month in months:
+        rows = [
+            row for row in ledger_files.read(f"transactions-{month.strftime('%Y-%m')}")
+            if row['accountId'] in account_ids and (start is None or row['timestamp'] >= start)
+            and (end is None or row['timestamp'] < end)
+        ]
+        if newest_first:
+            rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+        yield from rows
+
+def maintain_ledger():
+    with app.app_context():
+        ensure_ledger_partitions()
+        compact_ledger()
+        archive_ledger()
 
 # 手动刷新路由
-@app.route('/manual-refresh', methods=['POST'])
+@bp.route('/manual-refresh', methods=['POST'])
 @local_network_or_login_required
 def manual_refresh():
-    refresh_daily_stock_market_values()
-    return jsonify({'message': 'Market values refreshed manually'}), 200
-
-@app.route('/scheduler/jobs', methods=['GET'])
+    # 手动刷新使用独立游标并从头开始，不受当天定时刷新是否完成的影响
+    if not claim_refresh_cursor('manual-refresh'):
+        return jsonify({'message': '手动刷新正在进行中，请稍后再试'}), 409
+    progress = refresh_daily_stock_market_values('Market value refresh', 'manual-refresh', restart=True)
+    if not progress['processed']:
+        message = 'No stock accounts to refresh'
+    elif not progress['updated']:
+        message = 'No market values changed'
+    else:
+        message = 'Market values refreshed manually'
+    return jsonify({'message': message, **progress}), 200
+
+@bp.route('/scheduler/jobs', methods=['GET'])
 @local_network_or_login_required
 def get_scheduler_jobs():
-    jobs = scheduler.get_jobs()
-    job_list = [{'id': job.id, 'next_run_time': job.next_run_time.isoformat() if job.next_run_time else None} for job in jobs]
+    now = utcnow()
+    leases = {lease.name: lease for lease in JobLease.query.all()}
+    job_list = []
+    for name, (_, trigger) in LEASED_JOBS.items():
+        lease = leases.get(name)
+        last_run = JobRun.query.filter_by(name=name).order_by(JobRun.startedAt.desc()).first()
+        held = lease is not None and lease.holder is not None and lease.expiresAt > now
+        job_list.append({
+            'id': name,
+            'next_run_time': trigger.get_next_fire_time(None, datetime.now(trigger.timezone)).isoformat(),
+            'holder': lease.holder if held else None,
+            'token': lease.token if lease else 0,
+            'leaseExpiresAt': lease.expiresAt.strftime('%Y-%m-%d %H:%M:%S') if held else None,
+            'retryAt': lease.expiresAt.strftime('%Y-%m-%d %H:%M:%S')
+                if lease is not None and lease.holder is None and lease.expiresAt is not None else None,
+            'lastDuration': lease.lastDuration if lease else None,
+            'lastStatus': lease.lastStatus if lease else None,
+            'lastRun': last_run.to_dict() if last_run else None,
+            'backlog': len(due_fire_times(trigger, lease.lastScheduledFor, now)) if lease else 0
+        })
+    for job in scheduler.get_jobs() if scheduler else []:
+        job_list.append({'id': job.id, 'next_run_time': job.next_run_time.isoformat() if job.next_run_time else None})
     return jsonify(job_list)
 
-scheduler = BackgroundScheduler()
-# 获取锁文件的路径
-lock_file_path = '/tmp/myaccounts_scheduler.lock'
+@bp.route('/scheduler/refresh', methods=['GET'])
+@local_network_or_login_required
+def get_refresh_status():
+    today = date.today()
+    cursors = RefreshCursor.query.order_by(RefreshCursor.name).all()
+    dead_letters = RefreshDeadLetter.query.filter_by(runDate=today).order_by(RefreshDeadLetter.id).limit(100).all()
+    return jsonify({
+        'cursors': [cursor.to_dict() for cursor in cursors],
+        'deadLetters': [dead_letter.to_dict() for dead_letter in dead_letters]
+    })
+
+@bp.route('/cache/stats', methods=['GET'])
+@local_network_or_login_required
+def get_cache_stats():
+    return jsonify(price_cache.get_stats())
+
+# 连接池耗尽、语句超时、锁等待超时或连接断开时返回 503，客户端可稍后重试
+@bp.app_errorhandler(SQLAlchemyError)
+def database_unavailable(e):
+    if not is_transient_error(e):
+        raise e
+    db.session.rollback()
+    logging.warning(f"Database unavailable for {request.method} {request.path}: {str(e).splitlines()[0][:200]}")
+    return jsonify({'message': '数据库繁忙，请稍后重试'}), 503, {'Retry-After': '1'}
+
+# 请求耗时按数据库、行情接口、序列化拆分，统计 SQL 条数并发现 N+1 查询
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is not None:
+        stats.phases['db'] += time.perf_counter() - conn.info.pop('statement_started', time.perf_counter())
+        stats.statements[statement] += 1
+
+@bp.before_app_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        stats = begin_request(request.url_rule.rule if request.url_rule else 'unmatched', request.method)
+        if slow_request_profiler:
+            slow_request_profiler.start(stats)
+
+@bp.after_app_request
+def add_server_timing(response):
+    stats = current_stats()
+    if stats is not None:
+        stats.status = response.status_code
+        timings = [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in stats.phases.items()]
+        response.headers['Server-Timing'] = ', '.join(timings + [f'total;dur={stats.elapsed() * 1000:.1f}'])
+    return response
+
+# 流式响应的请求上下文在内容发送完毕后才结束，因此这里的耗时包含整个响应
+@bp.teardown_app_request
+def record_request_metrics(exc):
+    stats = current_stats()
+    if stats is None:
+        return
+    end_request()
+    duration = stats.elapsed()
+    REQUEST_DURATION.observe(duration, endpoint=stats.endpoint, method=stats.method, status=stats.status)
+    for phase, seconds in stats.phases.items():
+        REQUEST_PHASE_DURATION.observe(seconds, endpoint=stats.endpoint, phase=phase)
+    REQUEST_PHASE_DURATION.observe(max(0.0, duration - sum(stats.phases.values())), endpoint=stats.endpoint, phase='other')
+    REQUEST_STATEMENTS.observe(sum(stats.statements.values()), endpoint=stats.endpoint)
+    repeated = stats.repeated_statements(app.config['N_PLUS_ONE_THRESHOLD'])
+    if repeated:
+        REPEATED_STATEMENT_REQUESTS.inc(endpoint=stats.endpoint)
+        statement, count = repeated[0]
+        logging.warning(f"Possible N+1 query in {stats.method} {stats.endpoint}: {count} x {' '.join(statement.split())[:200]}")
+    if slow_request_profiler:
+        profile = slow_request_profiler.finish(stats)
+        if profile:
+            logging.warning(f"Slow request {stats.method} {stats.endpoint} took {profile['duration']}s: {profile['phases']}")
+
+@bp.route('/metrics', methods=['GET'])
+@local_network_or_login_required
+def get_metrics():
+    return Response(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-def acquire_lock():
-    if not os.path.exists(lock_file_path):
-        open(lock_file_path, 'w').close()
-    lock_file = open(lock_file_path, 'r+')
-    try:
-        if platform.system() == "Windows":
-            import msvcrt
-            # Use Windows-specific functionality
-            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
-        else:
-            import fcntl
-            # Use POSIX-specific functionality
-            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        return lock_file
-    except IOError:
-        lock_file.close()
+@bp.route('/metrics/slow-requests', methods=['GET'])
+@local_network_or_login_required
+def get_slow_request_profiles():
+    if slow_request_profiler is None:
+        return jsonify({'message': 'Set SLOW_REQUEST_PROFILE_SECONDS to profile slow requests'}), 404
+    return jsonify(list(slow_request_profiler.profiles))
+
+@bp.cli.command('rebuild-balance-summaries')
+def rebuild_balance_summaries():
+    """Recompute the per-user, per-type balance summary from Accounts."""
+    rebuild_type_balances()
+    db.session.commit()
+    click.echo(f'Rebuilt {AccountTypeBalance.query.count()} balance summary rows')
+
+def check_rebuild_start(start):
+    """Rebuilds replay Transactions, which no longer hold the archived months."""
+    horizon = archived_ledger_horizon()
+    if start is not None and horizon and start < horizon:
+        raise click.UsageError(f"the ledger before {horizon.strftime('%Y-%m')} is archived; rebuild from that month or later")
+
+@bp.cli.command('backfill-monthly-snapshots')
+@click.option('--start', 'start_month', required=True, help='First month to rebuild, YYYY-MM')
+@click.option('--end', 'end_month', default=None, help='Last month to rebuild, YYYY-MM (default: current month)')
+@click.option('--user-id', 'user_ids', type=int, multiple=True, help='Limit to these users (default: all)')
+def backfill_monthly_snapshots_command(start_month, end_month, user_ids):
+    """Rebuild per-user monthly snapshots from the Transactions ledger."""
+    start = datetime.strptime(start_month, '%Y-%m').date()
+    end = datetime.strptime(end_month, '%Y-%m').date() if end_month else date.today().replace(day=1)
+    check_rebuild_start(start)
+    count = backfill_monthly_snapshots(start, end, list(user_ids) or None)
+    db.session.commit()
+    click.echo(f'Wrote {count} user-month snapshots')
+
+@bp.cli.command('build-balance-checkpoints')
+@click.option('--since', 'since_month', default=None, help='Rebuild from this month, YYYY-MM (default: after the newest checkpoint)')
+def build_balance_checkpoints_command(since_month):
+    """Build per-account month-start balance checkpoints used by point-in-time queries."""
+    since = datetime.strptime(since_month, '%Y-%m').date() if since_month else None
+    check_rebuild_start(since)
+    count = build_balance_checkpoints(since)
+    db.session.commit()
+    click.echo(f'Wrote {count} balance checkpoints')
+
+@bp.cli.command('build-daily-balances')
+@click.option('--since', 'since_day', default=None, help='Rebuild from this day, YYYY-MM-DD (default: after the newest one)')
+def build_daily_balances_command(since_day):
+    """Build per-user end-of-day portfolio totals used by /api/balances/series."""
+    since = datetime.strptime(since_day, '%Y-%m-%d').date() if since_day else None
+    check_rebuild_start(since)
+    count = build_daily_balances(since)
+    db.session.commit()
+    click.echo(f'Wrote {count} daily balances')
+
+@bp.cli.command('backfill-prices')
+@click.option('--start', required=True, help='First day, YYYY-MM-DD')
+@click.option('--end', default=None, help='Last day, YYYY-MM-DD (default: today)')
+@click.option('--symbol', 'symbols', multiple=True, help='Symbols to load (default: every held symbol and the FX pair)')
+@click.option('--fixture', default=None, type=click.Path(exists=True), help='Load closes from a JSON fixture instead of Polygon')
+def backfill_prices_command(start, end, symbols, fixture):
+    """Load daily closes into the local price store from Polygon range aggregates."""
+    start_day = datetime.strptime(start, '%Y-%m-%d').date()
+    end_day = datetime.strptime(end, '%Y-%m-%d').date() if end else date.today()
+    provider = FixtureProvider(fixture) if fixture else quote_fetcher
+    stored, errors = backfill_prices(price_store, provider, list(symbols) or price_history_symbols(), start_day, end_day)
+    for symbol, count in sorted(stored.items()):
+        click.echo(f'{symbol}: {count} closes')
+    for symbol, error in sorted(errors.items()):
+        click.echo(f'{symbol}: {error}', err=True)
+    if errors:
+        raise SystemExit(1)
+
+@bp.cli.command('refresh-market-values')
+@click.option('--shard', default='0/1', help='Run shard i of n, by account-id range, e.g. 2/4')
+@click.option('--restart', is_flag=True, help="Start today's run over instead of resuming it")
+def refresh_market_values_command(shard, restart):
+    """Revalue stock accounts in committed batches, resuming an interrupted run."""
+    index, shards = (int(part) for part in shard.split('/'))
+    if not 0 <= index < shards:
+        raise click.BadParameter('expected i/n with 0 <= i < n', param_hint='--shard')
+    cursor = refresh_stock_accounts(shard=index, shards=shards, restart=restart)
+    click.echo(f'{cursor.name}: {cursor.updated} of {cursor.processed} accounts revalued, {cursor.failed} dead-lettered')
+
+@bp.cli.command('refresh-fx-rates')
+def refresh_fx_rates_command():
+    """Store today's exchange rates with one bulk fetch, if they are not stored yet."""
+    table = refresh_fx_rates()
+    click.echo(f'{len(table.currencies)} currencies against {table.base} for {table.day}')
+
+@bp.cli.command('compact-ledger')
+@click.option('--before', default=None, help='Compact months before this one, YYYY-MM (default: LEDGER_COMPACT_AFTER_MONTHS ago)')
+def compact_ledger_command(before):
+    """Collapse old daily revaluation rows into one row per account and month."""
+    removed = compact_ledger(datetime.strptime(before, '%Y-%m').date() if before else None)
+    click.echo(f'Removed {removed} revaluation rows')
+
+@bp.cli.command('check-ledger')
+def check_ledger_command():
+    """Fail when an account's ledger rows do not form an unbroken previousBalance -> newBalance chain."""
+    breaks = ledger_chain_breaks()
+    for account_id, transaction_id in breaks:
+        click.echo(f'account {account_id}: ledger chain broken at transaction {transaction_id}', err=True)
+    click.echo(f'{len(breaks)} broken ledger rows')
+    if breaks:
+        raise SystemExit(1)
+
+@bp.cli.command('archive-ledger')
+@click.option('--before', default=None, help='Archive months before this one, YYYY-MM (default: LEDGER_ARCHIVE_AFTER_MONTHS ago)')
+def archive_ledger_command(before):
+    """Move old months of Transactions to compressed files under LEDGER_ARCHIVE_PATH."""
+    ensure_ledger_partitions()
+    months = archive_ledger(datetime.strptime(before, '%Y-%m').date() if before else None)
+    for month in months:
+        click.echo(month.strftime('%Y-%m'))
+    click.echo(f'Archived {len(months)} months')
+
+@bp.cli.command('read-ledger-archive')
+@click.argument('month')
+@click.option('--compacted', is_flag=True, help='Read the revaluation rows removed by compact-ledger instead')
+@click.option('--user-id', type=int, default=None, help="Only this user's accounts")
+def read_ledger_archive_command(month, compacted, user_id):
+    """Print archived ledger rows of MONTH (YYYY-MM) as NDJSON."""
+    datetime.strptime(month, '%Y-%m')
+    names = ledger_files.names(f'compacted-{month}-') if compacted else [f'transactions-{month}']
+    names = [name for name in names if os.path.exists(ledger_files.path(name))]
+    if not names:
+        raise click.UsageError(f'no archive for {month}')
+    account_ids = None
+    if user_id is not None:
+        account_ids = {account_id for (account_id,) in db.session.query(Account.id).filter(Account.user_id == user_id)}
+    for name in names:
+        for row in ledger_files.read(name):
+            if account_ids is None or row['accountId'] in account_ids:
+                click.echo(json.dumps(encode_row(row), ensure_ascii=False))
+
+@bp.cli.command('import')
+@click.argument('kind', type=click.Choice(['accounts', 'transactions']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', required=True, type=int)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default=None, help='Default: from the file extension')
+def import_command(kind, path, user_id, fmt):
+    """Bulk-import accounts or transactions for a user from a CSV or NDJSON file."""
+    fmt = fmt or resolve_format(os.path.splitext(path)[1])
+    if fmt is None:
+        raise click.BadParameter('cannot tell the format from the file name; pass --format', param_hint='--format')
+    importer = import_accounts if kind == 'accounts' else import_transactions
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        summary = importer(user_id, read_rows(f, fmt))
+    for error in summary['errors']:
+        click.echo(f"line {error['line']}: {error['message']}", err=True)
+    click.echo(f"Imported {summary['imported']} {kind}, {summary['failed']} failed")
+    if summary['failed']:
+        raise SystemExit(1)
+
+@bp.cli.command('export')
+@click.argument('kind', type=click.Choice(['accounts', 'transactions']))
+@click.option('--user-id', required=True, type=int)
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+def export_command(kind, user_id, fmt, output):
+    """Stream a user's accounts or transactions as CSV or NDJSON."""
+    if kind == 'accounts':
+        rows, columns = export_accounts(user_id), ACCOUNT_EXPORT_COLUMNS
+    else:
+        rows, columns = export_transactions(user_id), TRANSACTION_EXPORT_COLUMNS
+    for text in write_rows(rows, columns, fmt):
+        output.write(text)
+
+@bp.cli.command('check-query-plans')
+def check_query_plans():
+    """Fail when a hot query falls back to a full table scan."""
+    now = datetime.now(timezone.utc)
+    hot_queries = {
+        'transactions': transactions_query(0, now - timedelta(days=30), now),
+        'typeMarketValues': type_market_values_query(0),
+        'refresh': active_accounts().filter_by(type='股票账户', user_id=0).statement,
+    }
+    failed = False
+    with db.engine.connect() as connection:
+        for name, stmt in hot_queries.items():
+            scans = find_full_scans(connection, stmt)
+            if scans:
+                failed = True
+                click.echo(f'{name}: full table scan: {scans}', err=True)
+            else:
+                click.echo(f'{name}: ok')
+    if failed:
+        raise SystemExit(1)
+
+# 定时任务通过数据库租约协调：任意节点上的任意进程都可以执行，但每个触发时间只执行一次
+LEASED_JOBS = {
+    'refresh_daily_fx_rates': (refresh_daily_fx_rates, CronTrigger(hour=8, minute=30)),
+    'refresh_daily_stock_market_values': (refresh_daily_stock_market_values, CronTrigger(hour=9, minute=0)),
+    'calculate_monthly_total_market_value': (calculate_monthly_total_market_value, CronTrigger(day=1, hour=9, minute=0)),
+    'purge_idempotency_keys': (purge_idempotency_keys, CronTrigger(minute=30)),
+    'maintain_ledger': (maintain_ledger, CronTrigger(day=2, hour=4, minute=0)),
+}
+LEASE_HOLDER = f'{socket.gethostname()}:{os.getpid()}'
+# 当前线程正在执行的定时任务的 (名称, 令牌)，任务内的每次提交都先校验令牌
+job_fence = threading.local()
+
+class LeaseLost(Exception):
+    """The lease of the running scheduled job was taken over, so its writes are refused."""
+
+@event.listens_for(RoutingSession, 'before_commit')
+def check_job_fence(session):
+    fence = getattr(job_fence, 'lease', None)
+    if fence is None:
+        return
+    name, token = fence
+    # 锁住租约行直到提交完成，接管者递增令牌必须等这次提交结束
+    current = session.execute(select(JobLease.token).where(JobLease.name == name).with_for_update()).scalar()
+    if current != token:
+        raise LeaseLost(f'Lease for {name} moved from token {token} to {current}')
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def due_fire_times(trigger, last_scheduled_for, now, limit=1000):
+    """Fire times of `trigger` in (last_scheduled_for, now], as naive UTC datetimes."""
+    fire_times = []
+    previous = last_scheduled_for.replace(tzinfo=timezone.utc)
+    while len(fire_times) < limit:
+        fire_time = trigger.get_next_fire_time(None, previous + timedelta(microseconds=1))
+        if fire_time is None:
+            break
+        fire_time = fire_time.astimezone(timezone.utc).replace(tzinfo=None)
+        if fire_time > now:
+            break
+        fire_times.append(fire_time)
+        previous = fire_time.replace(tzinfo=timezone.utc)
+    return fire_times
+
+def acquire_job_lease(name, scheduled_for):
+    """Take the lease for a due run of `name`; returns the new fencing token, or None if it is held, already run or
+    waiting to retry a failed run."""
+    now = utcnow()
+    acquired = db.session.execute(
+        update(JobLease)
+        .where(JobLease.name == name)
+        .where(JobLease.lastScheduledFor < scheduled_for)
+        .where(or_(JobLease.expiresAt.is_(None), JobLease.expiresAt < now))
+        .values(holder=LEASE_HOLDER, token=JobLease.token + 1, heartbeatAt=now,
+                expiresAt=now + timedelta(seconds=app.config['JOB_LEASE_TTL']))
+    ).rowcount
+    db.session.commit()
+    if not acquired:
         return None
+    return db.session.query(JobLease.token).filter_by(name=name).scalar()
+
+def heartbeat_job_lease(name, token, stopped):
+    interval = app.config['JOB_LEASE_TTL'] / 3
+    while not stopped.wait(interval):
+        with app.app_context():
+            now = utcnow()
+            renewed = db.session.execute(
+                update(JobLease)
+                .where(JobLease.name == name, JobLease.token == token)
+                .values(heartbeatAt=now, expiresAt=now + timedelta(seconds=app.config['JOB_LEASE_TTL']))
+            ).rowcount
+            db.session.commit()
+        if not renewed:
+            logging.warning(f"Lost the lease for {name} (token {token})")
+            return
 
-# 仅在获得锁时添加调度任务
+def run_leased_job(name, scheduled_for):
+    with app.app_context():
+        token = acquire_job_lease(name, scheduled_for)
+        if token is None:
+            return False
+        run = JobRun(name=name, token=token, holder=LEASE_HOLDER, scheduledFor=scheduled_for, startedAt=utcnow())
+        db.session.add(run)
+        db.session.commit()
+        run_id = run.id
+
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=heartbeat_job_lease, args=(name, token, stopped), daemon=True)
+    heartbeat.start()
+    started = time.monotonic()
+    status, error = 'success', None
+    job_fence.lease = (name, token)
+    try:
+        LEASED_JOBS[name][0]()
+    except LeaseLost as e:
+        logging.warning(f"Scheduled job {name} stopped: {e}")
+        status, error = 'fenced', str(e)[:255]
+    except Exception as e:
+        logging.exception(f"Scheduled job {name} failed")
+        status, error = 'failed', str(e)[:255]
+    finally:
+        job_fence.lease = None
+        stopped.set()
+    duration = round(time.monotonic() - started, 3)
+    JOB_DURATION.observe(duration, job=name, status=status)
 
-lock_file = acquire_lock()
-if lock_file:
-    scheduler.add_job(func=refresh_daily_stock_market_values, trigger='cron', hour=9, minute=0)
-    scheduler.add_job(func=calculate_monthly_total_market_value, trigger='cron', day=1, hour=9, minute=0)
+    with app.app_context():
+        # 只有仍持有当前令牌的执行者才能提交结果，被接管的旧执行者的结果会被拒绝；
+        # 失败的执行不推进 lastScheduledFor，JOB_RETRY_SECONDS 后重试
+        if status == 'success':
+            values = {'expiresAt': None, 'lastScheduledFor': scheduled_for}
+        else:
+            values = {'expiresAt': utcnow() + timedelta(seconds=app.config['JOB_RETRY_SECONDS'])}
+        released = db.session.execute(
+            update(JobLease)
+            .where(JobLease.name == name, JobLease.token == token)
+            .values(holder=None, lastDuration=duration, lastStatus=status, **values)
+        ).rowcount
+        if not released:
+            status = 'fenced'
+            logging.warning(f"Discarding the result of {name} (token {token}): the lease was taken over")
+        db.session.execute(
+            update(JobRun).where(JobRun.id == run_id)
+            .values(finishedAt=utcnow(), duration=duration, status=status, error=error)
+        )
+        db.session.commit()
+    logging.info(f"Scheduled job {name} for {scheduled_for} finished in {duration}s: {status}")
+    return True
+
+def ensure_job_leases():
+    now = utcnow()
+    existing = {name for (name,) in db.session.query(JobLease.name)}
+    for name in LEASED_JOBS.keys() - existing:
+        # 新任务从现在开始计算触发时间，不补跑历史
+        db.session.add(JobLease(name=name, lastScheduledFor=now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+def run_due_jobs():
+    """Run every leased job with a missed or due fire time; missed runs are coalesced into one catch-up run."""
+    with app.app_context():
+        ensure_job_leases()
+        now = utcnow()
+        due = {}
+        for lease in JobLease.query.filter(JobLease.name.in_(LEASED_JOBS)):
+            fire_times = due_fire_times(LEASED_JOBS[lease.name][1], lease.lastScheduledFor, now)
+            if fire_times:
+                due[lease.name] = fire_times[-1]
+        db.session.commit()
+    for name, scheduled_for in due.items():
+        run_leased_job(name, scheduled_for)
+
+def start_scheduler():
+    """Run the scheduled jobs on a background thread of this process."""
+    global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=run_due_jobs, trigger='interval', seconds=app.config['SCHEDULER_TICK_SECONDS'],
+                      id='run_due_jobs', max_instances=1, coalesce=True)
+    scheduler.add_job(func=process_pending_revaluations, trigger='interval', minutes=1,
+                      id='process_pending_revaluations', max_instances=1, coalesce=True)
     scheduler.start()
+    return scheduler
+
+@bp.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Run the scheduled jobs in the foreground: the dedicated scheduler process."""
+    if scheduler is None:
+        start_scheduler()
+    click.echo(f"Running {', '.join(LEASED_JOBS)} as {LEASE_HOLDER}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        scheduler.shutdown()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # 开发时单进程同时处理请求和定时任务
+    create_app(role='scheduler').run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,130 @@
+"""Ledger compaction check: compacts months that mix revaluations with incomes, expenses and transfers.
+
+Generates --accounts stock accounts, each with --months months of ledger history ending before the compaction
+cutoff, in which daily revaluation rows are interleaved at random with income, expense and transfer rows.
+It then runs compact_ledger() and checks that:
+
+    * every account's ledger still forms an unbroken previousBalance -> newBalance chain,
+    * each account's changes still sum to its balance,
+    * the balance after every income, expense and transfer row is unchanged,
+    * a second run removes nothing.
+
+Exits 1 when any check fails.
+
+    python bench/ledger_compaction.py --accounts 50 --months 3
+
+Without DATABASE_URL a throwaway SQLite database is used. The schema is created with create_all(),
+so point DATABASE_URL at an empty database.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='compaction-')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(WORKDIR, "compaction.db")}')
+os.environ.setdefault('PRICE_CACHE_BACKEND', 'memory')
+os.environ.setdefault('PRICE_STORE_PATH', os.path.join(WORKDIR, 'prices'))
+os.environ.setdefault('LEDGER_ARCHIVE_PATH', os.path.join(WORKDIR, 'ledger'))
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import func, insert  # noqa: E402
+
+import app as tracker  # noqa: E402
+tracker.create_app()
+
+OTHER_REASONS = ('Income', 'Expense', 'Transfer in', 'Transfer out')
+
+
+def generate(accounts, months, seed):
+    """Insert the accounts and their ledgers; returns (account ids, first day of the month after the history)."""
+    rng = random.Random(seed)
+    cutoff = date.today().replace(day=1)
+    start = cutoff
+    for _ in range(months):
+        start = (start - timedelta(days=1)).replace(day=1)
+    tracker.db.create_all()
+    user = tracker.User(username=f'compaction-{os.getpid()}', password='-')
+    tracker.db.session.add(user)
+    tracker.db.session.flush()
+    ids = []
+    for index in range(accounts):
+        account = tracker.Account(type='股票账户', details=f'compaction {index}', stockSymbol='AAPL', shares=1,
+                                  marketValue=0, user_id=user.id)
+        tracker.db.session.add(account)
+        tracker.db.session.flush()
+        balance = Decimal(0)
+        moment = datetime.combine(start, datetime.min.time())
+        rows = []
+        while moment.date() < cutoff:
+            if rows and rng.random() < 0.3:
+                reason = rng.choice(OTHER_REASONS)
+                change = Decimal(rng.randint(1, 500))
+                if reason in ('Expense', 'Transfer out'):
+                    change = -min(change, balance)
+            else:
+                reason = 'Account creation' if not rows else rng.choice(tracker.REVALUATION_REASONS)
+                change = Decimal(rng.randint(-300, 300) if rows else 1000)
+                change = max(change, -balance)
+            rows.append({'accountId': account.id, 'change': change, 'previousBalance': balance,
+                         'newBalance': balance + change, 'timestamp': moment, 'reason': reason})
+            balance += change
+            moment += timedelta(hours=rng.randint(6, 30))
+        tracker.db.session.execute(insert(tracker.Transaction), rows)
+        account.marketValue = balance
+        ids.append(account.id)
+    tracker.db.session.commit()
+    return ids, cutoff
+
+
+def other_rows():
+    return {row.id: row.newBalance for row in tracker.db.session.query(tracker.Transaction.id, tracker.Transaction.newBalance)
+            .filter(tracker.Transaction.reason.notin_(tracker.REVALUATION_REASONS))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with tracker.app.app_context():
+        ids, cutoff = generate(args.accounts, args.months, args.seed)
+        before_rows = tracker.db.session.query(func.count(tracker.Transaction.id)).scalar()
+        others = other_rows()
+
+        started = time.perf_counter()
+        removed = tracker.compact_ledger(cutoff)
+        seconds = time.perf_counter() - started
+        again = tracker.compact_ledger(cutoff)
+
+        problems = [f'account {account_id}: ledger chain broken at transaction {transaction_id}'
+                    for account_id, transaction_id in tracker.ledger_chain_breaks(ids)]
+        sums = dict(tracker.db.session.query(tracker.Transaction.accountId, func.sum(tracker.Transaction.change))
+                    .group_by(tracker.Transaction.accountId))
+        for account in tracker.Account.query.filter(tracker.Account.id.in_(ids)):
+            if Decimal(sums[account.id]) != Decimal(account.marketValue):
+                problems.append(f'account {account.id}: balance {account.marketValue} != sum of changes {sums[account.id]}')
+        after = other_rows()
+        problems += [f'transaction {row_id}: balance changed from {balance} to {after.get(row_id)}'
+                     for row_id, balance in others.items() if after.get(row_id) != balance]
+        if again:
+            problems.append(f'second compaction removed {again} more rows')
+
+    print(f'compacted            {removed} of {before_rows} ledger rows removed in {seconds:.2f}s, '
+          f'{len(others)} income/expense/transfer rows kept')
+    for problem in problems[:20]:
+        print(f'FAIL {problem}')
+    if problems:
+        sys.exit(1)
+    print('OK: ledger chain intact')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Login burst test: what a flood of POST /login does to the latency of everything else.
+
+Serves the app from a child process (werkzeug's threaded server, one thread per request like a gthread
+worker) and keeps --api-clients logged-in clients requesting GET /api/accounts. It measures their latency
+for --seconds on their own, then for --seconds while --burst clients post /login as fast as they can.
+That happens once for each mode:
+
+    inline       PASSWORD_HASH_WORKERS=0: hashing on the request threads, as before the hashing pool
+    pool         hashing in the lower-priority process pool, no rate limits
+    pool+limits  the pool with the LOGIN_USERNAME_RATE / LOGIN_IP_RATE defaults
+
+and reports GET /api/accounts p50/p95 without and with the burst, successful logins per second and the
+429 (rate limited) and 503 (hashing queue full or timed out) responses. Refused attempts are cheap but
+still requests, so with the limits on, the burst clients' retry loop is what remains of the slowdown.
+Exits 1 when the burst makes the pool's p95 more than --max-slowdown times its p95 without the burst.
+
+    python bench/login_burst.py --burst 16 --seconds 10
+    PASSWORD_HASH_METHOD=scrypt:32768:8:1 python bench/login_burst.py
+
+Without DATABASE_URL each child uses a throwaway SQLite database created with create_all().
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = 'burst'
+PASSWORD = 'burst'
+MODES = {
+    'inline': {'PASSWORD_HASH_WORKERS': '0', 'LOGIN_USERNAME_RATE': '0', 'LOGIN_IP_RATE': '0'},
+    'pool': {'LOGIN_USERNAME_RATE': '0', 'LOGIN_IP_RATE': '0'},
+    'pool+limits': {},
+}
+
+
+def child():
+    workdir = tempfile.mkdtemp(prefix='login-burst-')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "burst.db")}')
+    os.environ.setdefault('PRICE_CACHE_BACKEND', 'memory')
+    os.environ.setdefault('PRICE_STORE_PATH', os.path.join(workdir, 'prices'))
+    os.environ.setdefault('LEDGER_ARCHIVE_PATH', os.path.join(workdir, 'ledger'))
+    os.environ.setdefault('EVENTS_PATH', os.path.join(workdir, 'events.sqlite3'))
+    sys.path.insert(0, ROOT)
+
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+
+    import app as tracker
+    tracker.create_app()
+
+    with tracker.app.app_context():
+        tracker.db.create_all()
+        user = tracker.User(username=USERNAME, password=generate_password_hash(
+            PASSWORD, method=tracker.app.config['PASSWORD_HASH_METHOD']))
+        tracker.db.session.add(user)
+        tracker.db.session.flush()
+        for number in range(20):
+            tracker.db.session.add(tracker.Account(type='银行账户', details=f'burst {number}', marketValue=number,
+                                                   user_id=user.id))
+        tracker.db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, tracker.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(json.dumps({'port': server.server_port, 'method': tracker.app.config['PASSWORD_HASH_METHOD']}), flush=True)
+    sys.stdin.read()
+
+
+def api_phase(base, sessions, seconds):
+    """GET /api/accounts latencies in seconds, from every session in a loop for `seconds`."""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def run(session):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = session.get(f'{base}/api/accounts')
+            elapsed = time.perf_counter() - started
+            assert response.status_code == 200, response.status_code
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=run, args=(session,)) for session in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def login_burst(base, clients, stop):
+    """Post /login from `clients` threads until `stop` is set; returns the count of each status code."""
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def run():
+        session = requests.Session()
+        while not stop.is_set():
+            status = session.post(f'{base}/login', data={'username': USERNAME, 'password': PASSWORD}).status_code
+            with lock:
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    return statuses, threads
+
+
+def run_mode(mode, args):
+    env = {**os.environ, **MODES[mode]}
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child'], env=env,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        started = json.loads(server.stdout.readline())
+        base = f'http://127.0.0.1:{started["port"]}'
+        sessions = []
+        for _ in range(args.api_clients):
+            session = requests.Session()
+            response = session.post(f'{base}/login', data={'username': USERNAME, 'password': PASSWORD})
+            assert response.status_code == 200, response.text
+            sessions.append(session)
+        api_phase(base, sessions, 1)  # 预热
+        quiet = api_phase(base, sessions, args.seconds)
+
+        stop = threading.Event()
+        statuses, threads = login_burst(base, args.burst, stop)
+        burst_started = time.perf_counter()
+        burst = api_phase(base, sessions, args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        burst_seconds = time.perf_counter() - burst_started
+    finally:
+        server.kill()
+        server.wait()
+    return {'method': started['method'], 'quiet': quiet, 'burst': burst, 'statuses': statuses,
+            'loginsPerSecond': statuses[200] / burst_seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--api-clients', type=int, default=4)
+    parser.add_argument('--burst', type=int, default=16, help='clients posting /login during the burst')
+    parser.add_argument('--seconds', type=float, default=8, help='length of each phase')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--max-slowdown', type=float, default=3, help='allowed p95 growth of the pool mode')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    results = {mode: run_mode(mode, args) for mode in args.modes.split(',')}
+    print(f'password hash        {next(iter(results.values()))["method"]}; {args.api_clients} clients on GET /api/accounts, '
+          f'{args.burst} posting /login, {os.cpu_count()} CPU')
+    for mode, result in results.items():
+        quiet = np.percentile(result['quiet'], [50, 95]) * 1000
+        burst = np.percentile(result['burst'], [50, 95]) * 1000
+        statuses = result['statuses']
+        print(f'{mode:<20} GET /api/accounts p50/p95 {quiet[0]:.1f}/{quiet[1]:.1f} ms quiet, '
+              f'{burst[0]:.1f}/{burst[1]:.1f} ms during the burst; {result["loginsPerSecond"]:.1f} logins/s, '
+              f'{statuses[429]} x 429, {statuses[503]} x 503, '
+              f'{sum(count for status, count in statuses.items() if status not in (200, 429, 503))} other')
+
+    failed = False
+    if 'pool' in results:
+        pool = results['pool']
+        failed = np.percentile(pool['burst'], 95) > args.max_slowdown * np.percentile(pool['quiet'], 95)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
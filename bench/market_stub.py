@@ -0,0 +1,128 @@
+"""Local stand-in for the Polygon and exchange-rate APIs, so the app can run without network access.
+
+Serves the three endpoints QuoteFetcher calls, with deterministic prices derived from the symbol:
+
+    GET /v2/aggs/ticker/<symbol>/prev
+    GET /v2/aggs/ticker/<symbol>/range/1/day/<start>/<end>
+    GET /v4/latest/USD
+
+Symbols starting with ERR answer like an unknown ticker. Point the app at it with
+
+    python bench/market_stub.py --port 8765 --latency 50
+    POLYGON_API_URL=http://127.0.0.1:8765 EXCHANGE_RATE_API_URL=http://127.0.0.1:8765/v4/latest/USD python app.py
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+USD_CNY = 7.1
+USD_RATES = {'USD': 1, 'CNY': USD_CNY, 'HKD': 7.8, 'EUR': 0.92, 'GBP': 0.79, 'JPY': 150.0}
+PREV_PATH = re.compile(r'^/v2/aggs/ticker/([^/]+)/prev$')
+RANGE_PATH = re.compile(r'^/v2/aggs/ticker/([^/]+)/range/1/day/(\d{4}-\d{2}-\d{2})/(\d{4}-\d{2}-\d{2})$')
+
+
+def stub_close(symbol, day):
+    """A repeatable close for `symbol` on `day`: a per-symbol base price with a small daily wobble."""
+    if symbol.startswith('C:'):
+        base = USD_CNY
+    else:
+        base = 20 + zlib.crc32(symbol.encode()) % 48000 / 100
+    return round(base * (1 + (zlib.crc32(f'{symbol}{day}'.encode()) % 200 - 100) / 5000), 4)
+
+
+def bar(symbol, day):
+    timestamp = datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000
+    return {'t': int(timestamp), 'c': stub_close(symbol, day)}
+
+
+class MarketStub:
+    """Threaded HTTP server answering like Polygon and exchangerate-api, with optional added latency."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        stub = self
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                status, body = stub.respond(urlparse(self.path).path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+
+    def respond(self, path):
+        if path == '/v4/latest/USD':
+            return 200, {'base': 'USD', 'rates': USD_RATES}
+        match = PREV_PATH.match(path)
+        if match:
+            symbol = match.group(1)
+            if symbol.startswith('ERR'):
+                return 200, {'status': 'OK', 'ticker': symbol, 'resultsCount': 0}
+            return 200, {'status': 'OK', 'ticker': symbol,
+                         'results': [bar(symbol, date.today() - timedelta(days=1))]}
+        match = RANGE_PATH.match(path)
+        if match:
+            symbol = match.group(1)
+            if symbol.startswith('ERR'):
+                return 404, {'status': 'NOT_FOUND', 'message': f'Unknown ticker {symbol}'}
+            start, end = (date.fromisoformat(value) for value in match.group(2, 3))
+            days = (start + timedelta(days=offset) for offset in range((end - start).days + 1))
+            results = [bar(symbol, day) for day in days if day.weekday() < 5]
+            return 200, {'status': 'OK', 'ticker': symbol, 'resultsCount': len(results), 'results': results}
+        return 404, {'status': 'NOT_FOUND'}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='market-stub', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def env(self):
+        """Environment variables pointing the app's QuoteFetcher at this stub."""
+        return {
+            'POLYGON_API_URL': self.url,
+            'EXCHANGE_RATE_API_URL': f'{self.url}/v4/latest/USD',
+            'POLYGON_RATE_LIMIT': '0',
+            'EXCHANGE_RATE_RATE_LIMIT': '0',
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to every response')
+    args = parser.parse_args()
+    stub = MarketStub(args.host, args.port, args.latency / 1000)
+    print(f'Serving market data on {stub.url}')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""CPU cost of the list endpoints: ORM hydration + to_dict() + jsonify against the column projection.
+
+Builds one user with --accounts accounts and --months monthly market values, checks that both paths
+produce the same JSON, then reports CPU time per response for each path (with orjson and with the
+stdlib fallback) and the speed-up.
+
+    python bench/serialization_bench.py --accounts 2000 --months 240 --repeat 20
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix='serialize-')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(WORKDIR, "serialize.db")}')
+os.environ.setdefault('PRICE_CACHE_BACKEND', 'memory')
+os.environ.setdefault('PRICE_STORE_PATH', os.path.join(WORKDIR, 'prices'))
+sys.path.insert(0, ROOT)
+
+import serializers  # noqa: E402
+import app as tracker  # noqa: E402
+tracker.create_app()
+
+
+def setup(accounts, months):
+    tracker.db.create_all()
+    user = tracker.User(username=f'serialize-{os.getpid()}', password='-')
+    tracker.db.session.add(user)
+    tracker.db.session.flush()
+    tracker.db.session.add_all(
+        tracker.Account(type='股票账户' if index % 3 else '银行账户', details=f'账户 {index}',
+                        stockSymbol='AAPL' if index % 3 else None, shares=index if index % 3 else None,
+                        marketValue=Decimal(index * 37 % 100000) / 100 if index % 50 else None, user_id=user.id)
+        for index in range(accounts)
+    )
+    tracker.db.session.add_all(
+        tracker.MonthlyMarketValue(user_id=user.id, month=date(2000 + index // 12, index % 12 + 1, 1),
+                                   totalMarketValue=Decimal(index * 12345 % 10000000) / 100)
+        for index in range(months)
+    )
+    tracker.db.session.commit()
+    return user.id
+
+
+def orm_accounts(user_id):
+    accounts = tracker.active_accounts().filter_by(user_id=user_id).all()
+    return tracker.jsonify([account.to_dict() for account in accounts]).get_data()
+
+
+def projected_accounts(user_id):
+    projection = tracker.ACCOUNT_LIST
+    return projection.execute(tracker.db.session, projection.select(
+        tracker.Account.user_id == user_id, tracker.Account.deletedAt.is_(None)
+    ))
+
+
+def orm_monthly(user_id):
+    values = tracker.MonthlyMarketValue.query.filter_by(user_id=user_id).order_by(
+        tracker.MonthlyMarketValue.month.asc()
+    ).all()
+    return tracker.jsonify([value.to_dict() for value in values]).get_data()
+
+
+def projected_monthly(user_id):
+    projection = tracker.MONTHLY_MARKET_VALUE_LIST
+    return projection.execute(tracker.db.session, projection.select(
+        tracker.MonthlyMarketValue.user_id == user_id
+    ).order_by(tracker.MonthlyMarketValue.month.asc()))
+
+
+def cpu_time(build, user_id, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        # a fresh session per run, as in a request, so the ORM path cannot reuse hydrated objects
+        tracker.db.session.remove()
+        started = time.process_time()
+        build(user_id)
+        best = min(best, time.process_time() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=2000)
+    parser.add_argument('--months', type=int, default=240)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    with tracker.app.test_request_context():
+        user_id = setup(args.accounts, args.months)
+        cases = [
+            ('/api/accounts', orm_accounts, projected_accounts),
+            ('/api/monthlyMarketValues', orm_monthly, projected_monthly),
+        ]
+        mismatches = 0
+        for name, orm, projected in cases:
+            if json.loads(orm(user_id)) != json.loads(projected(user_id)):
+                print(f'{name}: projected JSON differs from to_dict()')
+                mismatches += 1
+        print(f'{"endpoint":<28}{"rows":>6}{"orm ms":>10}{"orjson ms":>11}{"stdlib ms":>11}{"speed-up":>10}')
+        encoder = serializers.orjson
+        for name, orm, projected in cases:
+            rows = len(json.loads(projected(user_id)))
+            orm_time = cpu_time(orm, user_id, args.repeat)
+            fast_time = cpu_time(projected, user_id, args.repeat) if encoder else float('nan')
+            serializers.orjson = None
+            stdlib_time = cpu_time(projected, user_id, args.repeat)
+            serializers.orjson = encoder
+            best = fast_time if encoder else stdlib_time
+            print(f'{name:<28}{rows:>6}{orm_time * 1000:>10.2f}{fast_time * 1000:>11.2f}'
+                  f'{stdlib_time * 1000:>11.2f}{orm_time / best:>9.1f}x')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Idle event stream test: what hundreds of open /api/events connections cost the server.
+
+Serves the app from a child process (werkzeug's threaded server, one thread per connection like a gthread
+worker) and opens --connections streams against it, all logged in as one user. It reports the server's
+resident memory and thread count before and after, the memory per idle stream, database connections
+checked out while the streams are open (should be 0), how long one balance change takes to reach every
+stream, and whether the server releases the streams once the clients disconnect. Exits 1 when a stream
+costs more than --max-kb of memory, holds a database connection, or is not released.
+
+    python bench/sse_idle.py --connections 500
+    EVENTS_BACKEND=sqlite python bench/sse_idle.py --connections 200
+
+Without DATABASE_URL the child uses a throwaway SQLite database created with create_all().
+"""
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = 'sse'
+PASSWORD = 'sse'
+
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def child(args):
+    workdir = tempfile.mkdtemp(prefix='sse-')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "sse.db")}')
+    os.environ.setdefault('PRICE_CACHE_BACKEND', 'memory')
+    os.environ.setdefault('PRICE_STORE_PATH', os.path.join(workdir, 'prices'))
+    os.environ.setdefault('EVENTS_PATH', os.path.join(workdir, 'events.sqlite3'))
+    os.environ['EVENTS_HEARTBEAT'] = str(args.heartbeat)
+    sys.path.insert(0, ROOT)
+
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+
+    import app as tracker
+    tracker.create_app()
+
+    with tracker.app.app_context():
+        tracker.db.create_all()
+        user = tracker.User(username=USERNAME, password=generate_password_hash(PASSWORD))
+        tracker.db.session.add(user)
+        tracker.db.session.flush()
+        account = tracker.Account(type='银行账户', details='sse', marketValue=0, user_id=user.id)
+        tracker.db.session.add(account)
+        tracker.db.session.commit()
+        account_id = account.id
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, tracker.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(json.dumps({'port': server.server_port, 'accountId': account_id}), flush=True)
+
+    # 父进程每发一行命令，返回一行当前状态
+    for _ in sys.stdin:
+        with tracker.app.app_context():
+            checked_out = sum(engine.pool.checkedout() for engine in tracker.db.engines.values())
+        print(json.dumps({'rss': rss_kb(), 'threads': threading.active_count(), 'checkedOut': checked_out,
+                          **tracker.event_broker.get_stats()}), flush=True)
+
+
+def open_stream(port, cookie):
+    sock = socket.create_connection(('127.0.0.1', port))
+    # session_protection='strong' 要求与登录时相同的 User-Agent
+    sock.sendall(f'GET /api/events HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: session={cookie}\r\n'
+                 f'User-Agent: {requests.utils.default_user_agent()}\r\nAccept: text/event-stream\r\n\r\n'.encode())
+    received = b''
+    while b'retry:' not in received:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise RuntimeError(f'stream closed before it started: {received[:200]!r}')
+        received += chunk
+    sock.setblocking(False)
+    return sock
+
+
+def wait_for(sockets, marker, timeout):
+    """Seconds until each socket has received `marker`; None for sockets that did not within `timeout`."""
+    started = time.perf_counter()
+    buffers = {sock: b'' for sock in sockets}
+    arrived = {}
+    while len(arrived) < len(sockets) and time.perf_counter() - started < timeout:
+        pending = [sock for sock in sockets if sock not in arrived]
+        readable, _, _ = select.select(pending, [], [], 0.1)
+        for sock in readable:
+            buffers[sock] += sock.recv(65536)
+            if marker in buffers[sock]:
+                arrived[sock] = time.perf_counter() - started
+    return [arrived.get(sock) for sock in sockets]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connections', type=int, default=300)
+    parser.add_argument('--idle', type=float, default=5, help='seconds the streams stay open and idle')
+    parser.add_argument('--heartbeat', type=float, default=2, help='EVENTS_HEARTBEAT for the server, seconds')
+    parser.add_argument('--max-kb', type=float, default=256, help='memory allowed per idle stream')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', '--heartbeat', str(args.heartbeat)],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def stats():
+        server.stdin.write('stats\n')
+        server.stdin.flush()
+        return json.loads(server.stdout.readline())
+
+    try:
+        started = json.loads(server.stdout.readline())
+        base = f'http://127.0.0.1:{started["port"]}'
+        session = requests.Session()
+        response = session.post(f'{base}/login', data={'username': USERNAME, 'password': PASSWORD})
+        assert response.status_code == 200, response.text
+        cookie = session.cookies['session']
+
+        # 先开关一次连接，让首次请求的导入和缓存不计入每个连接的开销
+        warmup = open_stream(started['port'], cookie)
+        warmup.close()
+        time.sleep(args.heartbeat * 2 + 0.5)
+        before = stats()
+
+        started_at = time.perf_counter()
+        sockets = [open_stream(started['port'], cookie) for _ in range(args.connections)]
+        connect_seconds = time.perf_counter() - started_at
+        time.sleep(args.idle)
+        idle = stats()
+
+        sent = time.perf_counter()
+        response = session.post(f'{base}/api/income', json={'accountId': started['accountId'], 'amount': 1,
+                                                             'reason': 'sse'})
+        assert response.status_code == 200, response.text
+        delivery = wait_for(sockets, b'event: balance', 10)
+        delivered = sorted(seconds for seconds in delivery if seconds is not None)
+        income_ms = (time.perf_counter() - sent) * 1000
+
+        for sock in sockets:
+            sock.close()
+        # 服务端在下一次心跳写入失败时才发现连接已断开
+        time.sleep(args.heartbeat * 2 + 1)
+        after = stats()
+    finally:
+        server.kill()
+
+    per_stream_kb = (idle['rss'] - before['rss']) / args.connections
+    print(f'streams opened       {args.connections} in {connect_seconds:.2f}s')
+    print(f'server RSS           {before["rss"] / 1024:.1f} MB idle, {idle["rss"] / 1024:.1f} MB with streams open '
+          f'({per_stream_kb:.1f} KB per stream)')
+    print(f'server threads       {before["threads"]} -> {idle["threads"]}')
+    print(f'DB connections held  {idle["checkedOut"]} while streams are open')
+    if delivered:
+        print(f'balance fan-out      {len(delivered)}/{args.connections} streams, p50 '
+              f'{delivered[len(delivered) // 2] * 1000:.1f} ms, max {delivered[-1] * 1000:.1f} ms after the income '
+              f'response ({income_ms:.1f} ms from the request)')
+    print(f'streams after close  {after["streams"]} (threads {after["threads"]})')
+
+    failed = (per_stream_kb > args.max_kb or idle['checkedOut'] > 0 or len(delivered) < args.connections
+              or idle['streams'] != args.connections or after['streams'] != 0)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
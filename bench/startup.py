@@ -0,0 +1,213 @@
+"""Startup test: what a cold worker costs before it serves its first request.
+
+Starts --runs fresh interpreters, each serving the app over HTTP from werkzeug's threaded server, and reports
+the medians of:
+
+    import app      time to import the module, and whether that created an app or started threads
+    create_app()    config, database engines, blueprint and services
+    first response  GET /login counted from process start, then the first logged-in GET /api/accounts
+    worker RSS      resident memory after those requests
+
+It then builds the app once and forks --workers processes from it like `gunicorn --preload`, and reports
+the same first responses counted from the fork, and each fork's resident and private memory: the
+private part is what one more worker costs. Exits 1 when importing the module creates an app or a thread,
+or takes longer than --max-import-ms.
+
+    python bench/startup.py --runs 5 --workers 4
+
+Without DATABASE_URL the processes share a throwaway SQLite database created with create_all().
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = 'startup'
+PASSWORD = 'startup'
+
+
+def memory_kb(pid):
+    """(resident, private) memory of process `pid` in KB."""
+    with open(f'/proc/{pid}/status') as status:
+        rss = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+    private = 0
+    with open(f'/proc/{pid}/smaps_rollup') as smaps:
+        for line in smaps:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                private += int(line.split()[1])
+    return rss, private
+
+
+def environment(workdir):
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(workdir, "startup.db")}')
+    env.setdefault('PRICE_CACHE_BACKEND', 'memory')
+    env.setdefault('PRICE_STORE_PATH', os.path.join(workdir, 'prices'))
+    env.setdefault('LEDGER_ARCHIVE_PATH', os.path.join(workdir, 'ledger'))
+    env.setdefault('EVENTS_PATH', os.path.join(workdir, 'events.sqlite3'))
+    env['PROCESS_ROLE'] = 'web'
+    return env
+
+
+def setup():
+    from werkzeug.security import generate_password_hash
+
+    import app as tracker
+
+    with tracker.create_app().app_context():
+        tracker.db.create_all()
+        if not tracker.User.query.filter_by(username=USERNAME).first():
+            user = tracker.User(username=USERNAME, password=generate_password_hash(PASSWORD))
+            tracker.db.session.add(user)
+            tracker.db.session.flush()
+            tracker.db.session.add(tracker.Account(type='银行账户', details='startup', marketValue=0, user_id=user.id))
+            tracker.db.session.commit()
+
+
+def serve():
+    started = time.perf_counter()
+    import app as tracker
+    imported = time.perf_counter()
+    side_effects = {'appCreated': tracker.app is not None, 'threads': threading.active_count()}
+    flask_app = tracker.create_app()
+    created = time.perf_counter()
+
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(json.dumps({'port': server.server_port, 'import': imported - started, 'create': created - imported,
+                      **side_effects}), flush=True)
+    sys.stdin.read()
+
+
+def first_requests(client_get, client_post):
+    """When the first page was served, and how long the first /api/accounts took on its own (the password check
+    of the login in between is left out)."""
+    response = client_get('/login')
+    assert response.status_code == 200, response.status_code
+    page = time.perf_counter()
+    response = client_post('/login', data={'username': USERNAME, 'password': PASSWORD})
+    assert response.status_code == 200, response.status_code
+    started = time.perf_counter()
+    response = client_get('/api/accounts')
+    assert response.status_code == 200, response.status_code
+    return page, time.perf_counter() - started
+
+
+def preload(workers):
+    import app as tracker
+    flask_app = tracker.create_app()
+    results = []
+    children = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            # 与 gunicorn.conf.py 的 post_fork 相同：不复用父进程的连接，重新创建密码哈希进程池
+            with flask_app.app_context():
+                for engine in tracker.db.engines.values():
+                    engine.dispose(close=False)
+            tracker.password_hasher.start()
+            client = flask_app.test_client()
+            page, api = first_requests(client.get, client.post)
+            os.write(write_fd, json.dumps({'page': page - forked, 'api': api}).encode())
+            os.close(write_fd)
+            os.kill(os.getpid(), signal.SIGSTOP)
+            os._exit(0)
+        os.close(write_fd)
+        children.append((pid, read_fd))
+    for pid, read_fd in children:
+        os.waitpid(pid, os.WUNTRACED)
+        # 哈希进程继承了写端，不能等到 EOF；结果只有一次小于 PIPE_BUF 的写入
+        result = json.loads(os.read(read_fd, 65536))
+        os.close(read_fd)
+        result['rss'], result['private'] = memory_kb(pid)
+        results.append(result)
+    for pid, _ in children:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    parent_rss, _ = memory_kb(os.getpid())
+    print(json.dumps({'parentRss': parent_rss, 'workers': results}), flush=True)
+
+
+def run_once(env):
+    spawned = time.perf_counter()
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve'], env=env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        started = json.loads(child.stdout.readline())
+        base = f'http://127.0.0.1:{started["port"]}'
+        session = requests.Session()
+        page, api = first_requests(lambda path: session.get(base + path),
+                                   lambda path, **kwargs: session.post(base + path, **kwargs))
+        rss, _ = memory_kb(child.pid)
+    finally:
+        child.kill()
+        child.wait()
+    return {**started, 'page': page - spawned, 'api': api, 'rss': rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4, help='processes forked from one preloaded app')
+    parser.add_argument('--max-import-ms', type=float, default=1500)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--setup', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve or args.setup or args.preload:
+        sys.path.insert(0, ROOT)
+        if args.serve:
+            serve()
+        elif args.setup:
+            setup()
+        else:
+            preload(args.workers)
+        return
+
+    env = environment(tempfile.mkdtemp(prefix='startup-'))
+    subprocess.run([sys.executable, os.path.abspath(__file__), '--setup'], env=env, check=True)
+    runs = [run_once(env) for _ in range(args.runs)]
+    preloaded = json.loads(subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--preload', '--workers', str(args.workers)],
+        env=env, check=True, stdout=subprocess.PIPE, text=True
+    ).stdout)
+
+    def median(key, scale=1000):
+        return statistics.median(run[key] for run in runs) * scale
+
+    created_app = any(run['appCreated'] for run in runs)
+    threads = max(run['threads'] for run in runs)
+    print(f'import app           {median("import"):.1f} ms (median of {args.runs}); '
+          f'{"created an app" if created_app else "no app"}, {threads} thread{"s" if threads > 1 else ""} after import')
+    print(f'create_app()         {median("create"):.1f} ms')
+    print(f'first response       GET /login {median("page"):.1f} ms from process start, '
+          f'then the first GET /api/accounts {median("api"):.1f} ms')
+    print(f'worker RSS           {median("rss", 1 / 1024):.1f} MB after the first requests')
+    workers = preloaded['workers']
+    print(f'preloaded workers    {len(workers)} forked from a {preloaded["parentRss"] / 1024:.1f} MB parent: '
+          f'GET /login {statistics.median(worker["page"] for worker in workers) * 1000:.1f} ms after fork, '
+          f'first GET /api/accounts {statistics.median(worker["api"] for worker in workers) * 1000:.1f} ms, '
+          f'RSS {statistics.median(worker["rss"] for worker in workers) / 1024:.1f} MB, '
+          f'{statistics.median(worker["private"] for worker in workers) / 1024:.1f} MB private each')
+
+    failed = created_app or threads > 1 or median('import') > args.max_import_ms
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
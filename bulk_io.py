@@ -0,0 +1,71 @@
+import csv
+import io
+import json
+from itertools import islice
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+FORMAT_ALIASES = {
+    'csv': 'csv', 'text/csv': 'csv', '.csv': 'csv',
+    'ndjson': 'ndjson', 'jsonl': 'ndjson', 'application/x-ndjson': 'ndjson', 'application/jsonl': 'ndjson',
+    '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+}
+
+
+def resolve_format(*candidates):
+    """First recognised format among a ?format= value, a content type or a file extension, or None."""
+    for candidate in candidates:
+        if candidate:
+            fmt = FORMAT_ALIASES.get(candidate.split(';')[0].strip().lower())
+            if fmt:
+                return fmt
+    return None
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, row dict or None, error or None) from a text stream, one row at a time."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {key: value if value != '' else None for key, value in row.items() if key}, None
+        return
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f'无效的 JSON: {e}'
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, '每行必须是一个 JSON 对象'
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def write_rows(rows, columns, fmt, batch_size=500):
+    """Serialize dict rows as CSV (with a header) or NDJSON, yielding text every `batch_size` rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    for index, row in enumerate(rows, 1):
+        if writer:
+            writer.writerow([row[column] for column in columns])
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + '\n')
+        if index % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
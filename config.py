@@ -1,8 +1,82 @@
 import os
 
+basedir = os.path.abspath(os.path.dirname(__file__))
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your_secret_key'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'mysql+mysqlconnector://<username>:<password>@localhost/investment_tracker'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_READ_REPLICA_URL = os.environ.get('DB_READ_REPLICA_URL')  # optional replica for read-only GET endpoints
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))  # gunicorn worker processes
+    WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))  # gunicorn threads per worker
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))  # 0 sizes the pool from WEB_THREADS and the background workers
+    DB_MAX_OVERFLOW = int(os.environ['DB_MAX_OVERFLOW']) if 'DB_MAX_OVERFLOW' in os.environ else None  # default: half the pool
+    DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 0))  # across all workers; 0 for no cap
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))  # seconds a request waits for a free connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))  # below MySQL wait_timeout and any proxy idle timeout
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+    DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+    DB_STATEMENT_TIMEOUT = float(os.environ.get('DB_STATEMENT_TIMEOUT', 30))  # per statement during requests; 0 disables
+    DB_LOCK_TIMEOUT = int(os.environ.get('DB_LOCK_TIMEOUT', 10))  # InnoDB lock wait / SQLite busy timeout, seconds
+    DB_SQLITE_WAL = os.environ.get('DB_SQLITE_WAL', '1') == '1'
     POLYGON_API_KEY = os.environ.get('POLYGON_API_KEY') or 'your_polygon_api_key'
-    EXCHANGE_RATE_API_URL = 'https://api.exchangerate-api.com/v4/latest/USD'
+    POLYGON_API_URL = os.environ.get('POLYGON_API_URL') or 'https://api.polygon.io'
+    EXCHANGE_RATE_API_URL = os.environ.get('EXCHANGE_RATE_API_URL') or 'https://api.exchangerate-api.com/v4/latest/USD'
+    HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+    QUOTE_FETCH_WORKERS = int(os.environ.get('QUOTE_FETCH_WORKERS', 8))
+    POLYGON_RATE_LIMIT = float(os.environ.get('POLYGON_RATE_LIMIT', 5))  # requests per second
+    EXCHANGE_RATE_RATE_LIMIT = float(os.environ.get('EXCHANGE_RATE_RATE_LIMIT', 1))
+    PRICE_CACHE_BACKEND = os.environ.get('PRICE_CACHE_BACKEND') or 'sqlite'  # 'memory' or 'sqlite'
+    PRICE_CACHE_PATH = os.environ.get('PRICE_CACHE_PATH') or '/tmp/myaccounts_price_cache.sqlite3'
+    PRICE_CACHE_MAXSIZE = int(os.environ.get('PRICE_CACHE_MAXSIZE', 10000))
+    QUOTE_TTL_MARKET_OPEN = int(os.environ.get('QUOTE_TTL_MARKET_OPEN', 60))
+    QUOTE_TTL_MARKET_CLOSED = int(os.environ.get('QUOTE_TTL_MARKET_CLOSED', 3600))
+    FX_RATE_TTL = int(os.environ.get('FX_RATE_TTL', 600))  # seconds a process keeps the stored rate table in memory
+    FX_BASE_CURRENCY = os.environ.get('FX_BASE_CURRENCY') or 'USD'  # base of the EXCHANGE_RATE_API_URL table
+    ANALYTICS_CACHE_MAXSIZE = int(os.environ.get('ANALYTICS_CACHE_MAXSIZE', 256))
+    ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL', 86400))
+    RESPONSE_CACHE_MAXSIZE = int(os.environ.get('RESPONSE_CACHE_MAXSIZE', 2048))
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 86400))
+    # 'memory' reaches only the streams of the process that published; several workers need 'sqlite'
+    EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND') or ('sqlite' if WEB_CONCURRENCY > 1 else 'memory')
+    EVENTS_PATH = os.environ.get('EVENTS_PATH') or '/tmp/myaccounts_events.sqlite3'
+    EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))  # events a slow stream may fall behind before a resync
+    EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))  # seconds between keep-alive comments on idle streams
+    EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 0.5))  # sqlite backend
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:1000000'  # with its cost; other hashes are redone at login
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 1))  # hashing processes per worker; 0 hashes on the request thread
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))  # logins waiting for a process before the rest get 503
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+    PASSWORD_HASH_NICE = int(os.environ.get('PASSWORD_HASH_NICE', 10))  # hashing processes run at this lower priority
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND') or 'memory'  # 'memory' (per process) or 'sqlite' (all workers on the host)
+    RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH') or '/tmp/myaccounts_rate_limits.sqlite3'
+    LOGIN_USERNAME_RATE = float(os.environ.get('LOGIN_USERNAME_RATE', 5))  # login/register attempts per minute and burst; 0 disables
+    LOGIN_IP_RATE = float(os.environ.get('LOGIN_IP_RATE', 30))
+    LAN_USER_CACHE_TTL = int(os.environ.get('LAN_USER_CACHE_TTL', 300))  # seconds the user for local-network requests is cached
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10))  # identical statements per request that get logged
+    SLOW_REQUEST_PROFILE_SECONDS = float(os.environ.get('SLOW_REQUEST_PROFILE_SECONDS', 0))  # 0 disables the profiler
+    PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.01))
+    SLOW_REQUEST_PROFILES_KEPT = int(os.environ.get('SLOW_REQUEST_PROFILES_KEPT', 20))
+    PRICE_STORE_PATH = os.environ.get('PRICE_STORE_PATH') or os.path.join(basedir, 'data', 'prices')
+    PRICE_STORE_DAILY_UPDATE = os.environ.get('PRICE_STORE_DAILY_UPDATE', '1') == '1'
+    PRICE_HISTORY_FX_SYMBOL = 'C:USDCNY'  # Polygon forex pair stored alongside stock closes
+    LEDGER_COMPACT_AFTER_MONTHS = int(os.environ.get('LEDGER_COMPACT_AFTER_MONTHS', 3))  # revaluation rows older than this become monthly rows
+    LEDGER_ARCHIVE_AFTER_MONTHS = int(os.environ.get('LEDGER_ARCHIVE_AFTER_MONTHS', 24))  # months older than this move to files; 0 keeps them
+    LEDGER_ARCHIVE_PATH = os.environ.get('LEDGER_ARCHIVE_PATH') or os.path.join(basedir, 'data', 'ledger')
+    LEDGER_PARTITIONS_AHEAD = int(os.environ.get('LEDGER_PARTITIONS_AHEAD', 3))  # MySQL monthly partitions created in advance
+    LEDGER_BATCH_SIZE = int(os.environ.get('LEDGER_BATCH_SIZE', 500))  # accounts compacted per committed batch
+    REVALUATION_WORKERS = int(os.environ.get('REVALUATION_WORKERS', 2))
+    REVALUATION_STALE_SECONDS = int(os.environ.get('REVALUATION_STALE_SECONDS', 600))  # requeue jobs stuck this long
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))  # rows validated and committed together
+    IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))  # per-row errors listed in the response
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))  # seconds a stored response is replayed
+    IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 60))  # after this an unfinished request may be retried
+    MAX_TRANSFER_LEGS = int(os.environ.get('MAX_TRANSFER_LEGS', 100))
+    REFRESH_BATCH_SIZE = int(os.environ.get('REFRESH_BATCH_SIZE', 500))  # accounts per committed batch
+    REFRESH_RETRIES = int(os.environ.get('REFRESH_RETRIES', 3))
+    REFRESH_RETRY_BACKOFF = float(os.environ.get('REFRESH_RETRY_BACKOFF', 1.0))  # seconds, doubled per attempt
+    PROCESS_ROLE = os.environ.get('PROCESS_ROLE', 'web')  # 'scheduler' runs the scheduled jobs, 'web' only serves requests
+    SCHEDULER_TICK_SECONDS = int(os.environ.get('SCHEDULER_TICK_SECONDS', 30))
+    JOB_LEASE_TTL = int(os.environ.get('JOB_LEASE_TTL', 120))  # seconds without a heartbeat before a lease can be taken over
+    JOB_RETRY_SECONDS = int(os.environ.get('JOB_RETRY_SECONDS', 300))  # wait before retrying a failed scheduled run
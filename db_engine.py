@@ -0,0 +1,131 @@
+import time
+
+from flask import g, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError, TimeoutError as PoolTimeoutError
+
+# MySQL server gone away, lost connection, lock wait timeout, deadlock, max_execution_time exceeded
+MYSQL_TRANSIENT_ERRNOS = {2006, 2013, 1205, 1213, 3024}
+# SQLite busy timeout expired, statement interrupted by the statement timeout
+SQLITE_TRANSIENT_MESSAGES = {'database is locked', 'interrupted'}
+
+
+def pool_size(config):
+    """Connections one process uses at once: a request per gunicorn thread plus the background threads."""
+    background = config['REVALUATION_WORKERS']
+    if config['PROCESS_ROLE'] == 'scheduler':
+        background += 3  # run_due_jobs, process_pending_revaluations and a job lease heartbeat
+    return config['WEB_THREADS'] + background
+
+
+def engine_options(url, config):
+    """create_engine() keyword arguments for `url`, from the DB_* and gunicorn settings in `config`.
+
+    The pool is sized per process; with DB_MAX_CONNECTIONS set, pool_size + max_overflow of every
+    worker together stay under it, and requests beyond that wait up to DB_POOL_TIMEOUT for a connection
+    instead of opening new ones.
+    """
+    url = make_url(url)
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    if url.get_backend_name() == 'sqlite':
+        options['connect_args'] = {'timeout': config['DB_LOCK_TIMEOUT']}
+        if url.database in (None, '', ':memory:'):
+            return options  # 内存数据库只有一个共享连接，不设置连接池
+    elif url.get_backend_name() == 'mysql':
+        timeout_arg = 'connection_timeout' if url.get_driver_name() == 'mysqlconnector' else 'connect_timeout'
+        options['connect_args'] = {timeout_arg: config['DB_CONNECT_TIMEOUT']}
+
+    size = config['DB_POOL_SIZE'] or pool_size(config)
+    overflow = config['DB_MAX_OVERFLOW'] if config['DB_MAX_OVERFLOW'] is not None else size // 2
+    if config['DB_MAX_CONNECTIONS']:
+        budget = max(1, config['DB_MAX_CONNECTIONS'] // config['WEB_CONCURRENCY'])
+        size = min(size, budget)
+        overflow = max(0, min(overflow, budget - size))
+    options.update(pool_size=size, max_overflow=overflow, pool_timeout=config['DB_POOL_TIMEOUT'])
+    return options
+
+
+def configure_engine(engine, config):
+    """Per-connection settings: SQLite WAL mode, and lock wait and statement timeouts on both dialects.
+
+    DB_STATEMENT_TIMEOUT applies to statements run while handling a request; scheduled jobs and CLI
+    commands run unbounded. A statement can override it with execution_options(statement_timeout=seconds),
+    None disabling it. MySQL enforces it on SELECTs through the MAX_EXECUTION_TIME optimizer hint, SQLite
+    through a progress handler that interrupts the statement once its deadline has passed.
+    """
+    dialect = engine.dialect.name
+    default_timeout = config['DB_STATEMENT_TIMEOUT'] or None
+    lock_timeout = config['DB_LOCK_TIMEOUT']
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        if dialect == 'sqlite':
+            if config['DB_SQLITE_WAL']:
+                dbapi_connection.execute('PRAGMA journal_mode=WAL')
+            deadline = connection_record.info['statement_deadline'] = [None]
+            dbapi_connection.set_progress_handler(
+                lambda: deadline[0] is not None and time.monotonic() > deadline[0], 1000
+            )
+        elif dialect == 'mysql':
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET SESSION innodb_lock_wait_timeout = {int(lock_timeout)}')
+            cursor.close()
+
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def apply_statement_timeout(conn, cursor, statement, parameters, context, executemany):
+        timeout = default_timeout if has_request_context() else None
+        if context is not None:
+            timeout = context.execution_options.get('statement_timeout', timeout)
+        if dialect == 'sqlite':
+            deadline = conn.info.get('statement_deadline')
+            if deadline is not None:
+                deadline[0] = time.monotonic() + timeout if timeout else None
+        elif dialect == 'mysql' and timeout:
+            stripped = statement.lstrip()
+            if stripped[:6].upper() == 'SELECT':
+                statement = f'SELECT /*+ MAX_EXECUTION_TIME({int(timeout * 1000)}) */{stripped[6:]}'
+        return statement, parameters
+
+    if dialect == 'sqlite':
+        # SQLite 在取数时才逐行执行，截止时间保留到事务结束，提交和回滚本身不受限制
+        def clear_deadline(info):
+            deadline = info.get('statement_deadline')
+            if deadline is not None:
+                deadline[0] = None
+
+        def on_transaction_end(conn):
+            if not conn.invalidated:
+                clear_deadline(conn.info)
+
+        event.listen(engine, 'commit', on_transaction_end)
+        event.listen(engine, 'rollback', on_transaction_end)
+        event.listen(engine, 'reset', lambda dbapi_connection, record, state: clear_deadline(record.info))
+
+
+def is_transient_error(error):
+    """Whether `error` is the database being busy or unreachable rather than a bug: worth a 503 and a retry."""
+    if isinstance(error, PoolTimeoutError):
+        return True
+    if not isinstance(error, DBAPIError):
+        return False
+    return (error.connection_invalidated or getattr(error.orig, 'errno', None) in MYSQL_TRANSIENT_ERRNOS
+            or str(error.orig) in SQLITE_TRANSIENT_MESSAGES)
+
+
+class RoutingSession(Session):
+    """Sends the reads of requests marked with g.read_replica to the 'replica' bind, when one is configured.
+
+    Flushes always go to the primary, so ORM writes in such a request still land there.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() and g.get('read_replica'):
+            replica = self._db.engines.get('replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause, bind, **kwargs)
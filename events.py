@@ -0,0 +1,165 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import closing
+
+
+class Subscription:
+    """Events waiting to be written to one open stream.
+
+    The queue is bounded: a client that falls more than `maxsize` events behind loses them and gets a single
+    'resync' event instead, telling it to reload its data.
+    """
+
+    __slots__ = ('user_id', 'maxsize', 'events', 'condition')
+
+    def __init__(self, user_id, maxsize):
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.events = deque()
+        self.condition = threading.Condition(threading.Lock())
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) >= self.maxsize:
+                self.events.clear()
+                event = (event[0], 'resync', 'null')
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Pending (id, event, data) tuples, waiting up to `timeout` seconds for the first; [] on timeout."""
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+
+class MemoryBroker:
+    """In-process pub/sub: events reach the streams open in this worker process."""
+
+    name = 'memory'
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.published = 0
+
+    def subscribe(self, user_id):
+        subscription = Subscription(user_id, self.queue_size)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            streams = self.subscriptions.get(subscription.user_id)
+            if streams is not None:
+                streams.discard(subscription)
+                if not streams:
+                    del self.subscriptions[subscription.user_id]
+
+    def publish(self, user_id, event, data=None):
+        """Send `event` with JSON-serializable `data` to `user_id`'s streams, or to every stream if user_id is None."""
+        self.deliver(next(self.ids), user_id, event, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+
+    def deliver(self, event_id, user_id, event, data):
+        with self.lock:
+            if user_id is None:
+                targets = [subscription for streams in self.subscriptions.values() for subscription in streams]
+            else:
+                targets = list(self.subscriptions.get(user_id, ()))
+            self.published += 1
+        for subscription in targets:
+            subscription.put((event_id, event, data))
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'backend': self.name,
+                'users': len(self.subscriptions),
+                'streams': sum(len(streams) for streams in self.subscriptions.values()),
+                'published': self.published,
+            }
+
+
+class SQLiteBroker(MemoryBroker):
+    """Pub/sub through a local SQLite file, shared by every worker process on the host.
+
+    publish() appends to the file; once a process has had a stream open, it polls the file every `poll_interval`
+    seconds and delivers new rows to its streams, so events published by the scheduler or another worker reach
+    every stream. Rows are kept for `retention` seconds.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, queue_size=100, poll_interval=0.5, retention=60):
+        super().__init__(queue_size)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.local = threading.local()
+        self.poller = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(path, timeout=5, isolation_level=None)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, event TEXT NOT NULL, data TEXT NOT NULL, '
+                'created_at REAL NOT NULL)'
+            )
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def subscribe(self, user_id):
+        subscription = super().subscribe(user_id)
+        with self.lock:
+            # 进程中第一次有连接时才开始轮询（gunicorn --preload 时线程不会随 fork 复制）
+            if self.poller is None or not self.poller.is_alive():
+                self.poller = threading.Thread(target=self._poll, name='event-poller', daemon=True)
+                self.poller.start()
+        return subscription
+
+    def publish(self, user_id, event, data=None):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('INSERT INTO events (user_id, event, data, created_at) VALUES (?, ?, ?, ?)',
+                     (user_id, event, json.dumps(data, ensure_ascii=False, separators=(',', ':')), now))
+        conn.execute('DELETE FROM events WHERE created_at < ?', (now - self.retention,))
+
+    def _poll(self):
+        conn = self._conn()
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        while True:
+            time.sleep(self.poll_interval)
+            with self.lock:
+                idle = not self.subscriptions
+            if idle:
+                # 没有连接时只跳过已有事件，不投递
+                last_id = conn.execute('SELECT COALESCE(MAX(id), ?) FROM events', (last_id,)).fetchone()[0]
+                continue
+            for event_id, user_id, event, data in conn.execute(
+                    'SELECT id, user_id, event, data FROM events WHERE id > ? ORDER BY id', (last_id,)).fetchall():
+                self.deliver(event_id, user_id, event, data)
+                last_id = event_id
+
+
+def build_broker(config):
+    if config['EVENTS_BACKEND'] == 'sqlite':
+        return SQLiteBroker(config['EVENTS_PATH'], config['EVENTS_QUEUE_SIZE'], config['EVENTS_POLL_INTERVAL'])
+    return MemoryBroker(config['EVENTS_QUEUE_SIZE'])
@@ -0,0 +1,40 @@
+import re
+
+import numpy as np
+
+CURRENCY_CODE = re.compile(r'^[A-Z]{3}$')
+
+
+class FxRateTable:
+    """One day's exchange rates against `base`; any two of its currencies convert through the cross rate.
+
+    `rates` is {currency: units of currency per unit of base}, as in the exchange-rate API's response.
+    """
+
+    def __init__(self, base, day, rates):
+        self.base = base
+        self.day = day
+        self.currencies = sorted({base, *rates})
+        self.index = {currency: position for position, currency in enumerate(self.currencies)}
+        self.values = np.array([1.0 if currency == base else float(rates[currency]) for currency in self.currencies])
+
+    def has(self, currency):
+        return currency in self.index
+
+    def rate(self, source, target):
+        """Units of `target` per unit of `source`."""
+        return float(self.values[self.index[target]] / self.values[self.index[source]])
+
+    def rates(self, sources, targets):
+        """rate() for each pair of the parallel sequences `sources` and `targets`, as one array."""
+        source_index = np.fromiter((self.index[currency] for currency in sources), dtype=np.intp)
+        target_index = np.fromiter((self.index[currency] for currency in targets), dtype=np.intp)
+        return self.values[target_index] / self.values[source_index]
+
+
+def parse_currency(value):
+    """Upper-cased ISO 4217 code, or ValueError."""
+    code = str(value or '').strip().upper()
+    if not CURRENCY_CODE.match(code):
+        raise ValueError(f'无效的币种: {value}')
+    return code
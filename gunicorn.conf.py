@@ -0,0 +1,39 @@
+"""gunicorn settings, read from the same variables that size the database pool in config.py.
+
+    WEB_CONCURRENCY=4 WEB_THREADS=8 gunicorn
+
+The app is built once by create_app() in the master and forked into the workers (GUNICORN_PRELOAD=0 builds
+it in every worker instead, the default with gevent). The master starts no threads or processes; each worker starts
+its password hashing pool in post_worker_init. Workers only serve requests; run the scheduled jobs in a separate
+`flask run-scheduler` process.
+
+Each open /api/events stream occupies a thread of a gthread worker for as long as the page is open, so the
+default is gthread with WEB_THREADS=8 threads; a sync worker would spend its only thread on the first stream. To
+hold many streams, run GUNICORN_WORKER_CLASS=gevent. With WEB_CONCURRENCY above 1 the events go through the
+sqlite broker (EVENTS_BACKEND) so every worker's streams receive them.
+"""
+import os
+
+wsgi_app = 'app:create_app(forked=True)'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# gevent 要在应用导入前打补丁，因此默认不预加载
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0' if worker_class == 'gevent' else '1') == '1'
+
+
+def post_fork(server, worker):
+    # 预加载时，主进程创建应用时打开的连接不能在子进程间共用
+    if server.cfg.preload_app:
+        from app import app, db
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # 应用已加载、请求线程尚未启动时创建本 worker 的密码哈希进程池；主进程不创建，fork 前保持单线程
+    from app import password_hasher
+    password_hasher.start()
@@ -0,0 +1,111 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+
+LEDGER_COLUMNS = ('id', 'accountId', 'change', 'previousBalance', 'newBalance', 'timestamp', 'createdAt', 'updatedAt',
+                  'reason')
+MONEY_COLUMNS = ('change', 'previousBalance', 'newBalance')
+DATETIME_COLUMNS = ('timestamp', 'createdAt', 'updatedAt')
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+PARTITION_NAME = re.compile(r'^p(\d{4})(\d{2})$')
+
+
+def next_month(month):
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    """MySQL partition of Transactions holding `month` (and, for the oldest partition, everything before it)."""
+    return f'p{month:%Y%m}'
+
+
+def partition_month(name):
+    """The month of a partition_name(), or None for 'pmax' and other names."""
+    match = PARTITION_NAME.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def partition_definitions(months):
+    """RANGE partition clauses for Transactions, one per month, bounded by the first day of the next month."""
+    return ', '.join(
+        f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{next_month(month):%Y-%m-%d}'))"
+        for month in months
+    )
+
+
+def encode_row(row):
+    """A ledger row (mapping or Row) as a JSON-safe dict: amounts as strings, datetimes with microseconds."""
+    row = row if isinstance(row, dict) else row._mapping
+    encoded = {column: row[column] for column in LEDGER_COLUMNS}
+    for column in MONEY_COLUMNS:
+        encoded[column] = str(encoded[column])
+    for column in DATETIME_COLUMNS:
+        if encoded[column] is not None:
+            encoded[column] = encoded[column].strftime(DATETIME_FORMAT)
+    return encoded
+
+
+def decode_row(encoded):
+    row = dict(encoded)
+    for column in MONEY_COLUMNS:
+        row[column] = Decimal(row[column])
+    for column in DATETIME_COLUMNS:
+        if row[column] is not None:
+            row[column] = datetime.strptime(row[column], DATETIME_FORMAT)
+    return row
+
+
+class LedgerFiles:
+    """Archived ledger rows as gzip-compressed NDJSON files in `root`, one per archived month or compaction batch.
+
+    Files are written to a temporary name and renamed into place, so a reader never sees a partial file and
+    writing the same name again replaces it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, f'{name}.ndjson.gz')
+
+    def write(self, name, rows):
+        """Write encode_row() of each of `rows`; returns (row count, sha256 of the file)."""
+        count = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=f'.{name}-')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as compressed:
+                for row in rows:
+                    compressed.write(json.dumps(encode_row(row), ensure_ascii=False).encode() + b'\n')
+                    count += 1
+            os.replace(temp_path, self.path(name))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return count, self.sha256(name)
+
+    def sha256(self, name):
+        digest = hashlib.sha256()
+        with open(self.path(name), 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def read(self, name):
+        """Yield the decoded rows of file `name`, in the order they were written."""
+        with gzip.open(self.path(name), 'rt', encoding='utf-8') as file:
+            for line in file:
+                yield decode_row(json.loads(line))
+
+    def names(self, prefix):
+        """Names of the files starting with `prefix`, sorted."""
+        suffix = '.ndjson.gz'
+        return sorted(
+            entry[:-len(suffix)] for entry in os.listdir(self.root)
+            if entry.startswith(prefix) and entry.endswith(suffix)
+        )
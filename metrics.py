@@ -0,0 +1,207 @@
+import sys
+import threading
+import time
+from collections import Counter as Tally, deque
+from contextlib import contextmanager
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            for values, series in sorted(self.series.items()):
+                lines.extend(self.render_series(values, series))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render_series(self, values, total):
+        return [f'{self.name}_total{format_labels(self.labelnames, values)} {total}']
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram in the Prometheus exposition format."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render_series(self, values, series):
+        counts, count, total = series
+        lines = [
+            f'{self.name}_bucket{format_labels(self.labelnames, values, [("le", bound)])} {bucket}'
+            for bound, bucket in zip(self.buckets, counts)
+        ]
+        lines.append(f'{self.name}_bucket{format_labels(self.labelnames, values, [("le", "+Inf")])} {count}')
+        lines.append(f'{self.name}_count{format_labels(self.labelnames, values)} {count}')
+        lines.append(f'{self.name}_sum{format_labels(self.labelnames, values)} {total}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+class RequestStats:
+    """Time and SQL statements attributed to one request, split by where the time went."""
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.status = 500
+        self.started = time.perf_counter()
+        self.phases = {'db': 0.0, 'upstream': 0.0, 'serialization': 0.0}
+        self.statements = Tally()
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def repeated_statements(self, threshold):
+        """Statements executed at least `threshold` times, the signature of an N+1 query pattern."""
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+_current = threading.local()
+
+
+def current_stats():
+    return getattr(_current, 'stats', None)
+
+
+def begin_request(endpoint, method):
+    _current.stats = RequestStats(endpoint, method)
+    return _current.stats
+
+
+def end_request():
+    _current.stats = None
+
+
+@contextmanager
+def timed(phase):
+    """Add the wall time of the block to `phase` of the current request, if there is one."""
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.phases[phase] += time.perf_counter() - started
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of requests that run longer than `threshold` seconds.
+
+    Requests register their thread; one sampler thread wakes every `interval` seconds and records the
+    stack of each request past the threshold, so fast requests cost only the registration. Profiles of
+    the last `keep` slow requests are kept as folded stacks ("frame;frame;frame count"), the input
+    format of flame graph tools.
+    """
+
+    def __init__(self, threshold, interval=0.01, keep=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.active = {}
+        self.profiles = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, stats):
+        with self.lock:
+            self.active[threading.get_ident()] = (stats, Tally())
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='slow-request-profiler', daemon=True)
+                self.thread.start()
+
+    def finish(self, stats):
+        with self.lock:
+            entry = self.active.pop(threading.get_ident(), None)
+        if entry is None or not entry[1]:
+            return None
+        profile = {
+            'endpoint': stats.endpoint,
+            'method': stats.method,
+            'status': stats.status,
+            'duration': round(stats.elapsed(), 3),
+            'phases': {phase: round(seconds, 3) for phase, seconds in stats.phases.items()},
+            'samples': sum(entry[1].values()),
+            'stacks': [f'{stack} {count}' for stack, count in entry[1].most_common()],
+        }
+        self.profiles.append(profile)
+        return profile
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, (stats, samples) in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None and stats.elapsed() >= self.threshold:
+                        samples[fold(frame)] += 1
+
+
+def fold(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
@@ -0,0 +1,53 @@
+"""job leases
+
+Revision ID: 0a8533249584
+Revises: 33bbc41095e3
+Create Date: 2026-10-18 20:44:06.354658
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0a8533249584'
+down_revision = '33bbc41095e3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('JobLeases',
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('holder', sa.String(length=255), nullable=True),
+    sa.Column('token', sa.Integer(), nullable=False),
+    sa.Column('expiresAt', sa.DateTime(), nullable=True),
+    sa.Column('heartbeatAt', sa.DateTime(), nullable=True),
+    sa.Column('lastScheduledFor', sa.DateTime(), nullable=False),
+    sa.Column('lastDuration', sa.Float(), nullable=True),
+    sa.Column('lastStatus', sa.String(length=20), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('JobRuns',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('token', sa.Integer(), nullable=False),
+    sa.Column('holder', sa.String(length=255), nullable=False),
+    sa.Column('scheduledFor', sa.DateTime(), nullable=False),
+    sa.Column('startedAt', sa.DateTime(), nullable=False),
+    sa.Column('finishedAt', sa.DateTime(), nullable=True),
+    sa.Column('duration', sa.Float(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('error', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('JobRuns', schema=None) as batch_op:
+        batch_op.create_index('ix_JobRuns_name_startedAt', ['name', 'startedAt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('JobRuns', schema=None) as batch_op:
+        batch_op.drop_index('ix_JobRuns_name_startedAt')
+
+    op.drop_table('JobRuns')
+    op.drop_table('JobLeases')
@@ -0,0 +1,58 @@
+"""per-user monthly snapshots
+
+Revision ID: 12ec7764e589
+Revises: 8bff3e6135f6
+Create Date: 2026-10-18 20:33:26.591108
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '12ec7764e589'
+down_revision = '8bff3e6135f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('MonthlyTypeMarketValues',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('type', sa.String(length=50), nullable=False),
+    sa.Column('totalMarketValue', sa.DECIMAL(precision=14, scale=2), nullable=False),
+    sa.Column('updatedAt', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['Users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'month', 'type')
+    )
+    with op.batch_alter_table('MonthlyMarketValues', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+
+    # Existing rows are global totals. On a single-user install they belong to that user;
+    # otherwise they stay unassigned and per-user history is rebuilt with backfill-monthly-snapshots.
+    bind = op.get_bind()
+    users = sa.table('Users', sa.column('id'))
+    values = sa.table('MonthlyMarketValues', sa.column('id'), sa.column('user_id'), sa.column('month'))
+    user_ids = [row.id for row in bind.execute(sa.select(users.c.id))]
+    if len(user_ids) == 1:
+        # The old job could run twice in a month; keep the latest row per month
+        keep = sa.select(sa.func.max(values.c.id)).group_by(values.c.month).scalar_subquery()
+        duplicate_ids = [row.id for row in bind.execute(sa.select(values.c.id).where(values.c.id.not_in(keep)))]
+        if duplicate_ids:
+            bind.execute(values.delete().where(values.c.id.in_(duplicate_ids)))
+        bind.execute(values.update().values(user_id=user_ids[0]))
+
+    with op.batch_alter_table('MonthlyMarketValues', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_MonthlyMarketValues_user_id_month', ['user_id', 'month'])
+        batch_op.create_foreign_key('fk_MonthlyMarketValues_user_id_Users', 'Users', ['user_id'], ['id'])
+
+
+def downgrade():
+    naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+    with op.batch_alter_table('MonthlyMarketValues', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_MonthlyMarketValues_user_id_Users', type_='foreignkey')
+        batch_op.drop_constraint('uq_MonthlyMarketValues_user_id_month', type_='unique')
+        batch_op.drop_column('user_id')
+
+    op.drop_table('MonthlyTypeMarketValues')
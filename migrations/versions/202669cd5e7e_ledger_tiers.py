@@ -0,0 +1,78 @@
+"""ledger tiers
+
+Revision ID: 202669cd5e7e
+Revises: 79ba63991da8
+Create Date: 2026-10-18 21:33:51.986996
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+from ledger_tiers import next_month, partition_definitions
+
+
+# revision identifiers, used by Alembic.
+revision = '202669cd5e7e'
+down_revision = '79ba63991da8'
+branch_labels = None
+depends_on = None
+
+PARTITIONS_AHEAD = 3
+
+
+def upgrade():
+    op.create_table('ArchivedLedgerMonths',
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('rowCount', sa.Integer(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('month')
+    )
+    op.execute('UPDATE Transactions SET timestamp = createdAt WHERE timestamp IS NULL')
+
+    naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+    with op.batch_alter_table('Transactions', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('fk_Transactions_accountId_Accounts', type_='foreignkey')
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DATETIME(),
+               nullable=False)
+        batch_op.create_index('ix_Transactions_timestamp', ['timestamp'], unique=False)
+
+    bind = op.get_bind()
+    if bind.dialect.name == 'mysql':
+        # 分区列必须出现在每个唯一键中；第一个分区同时容纳更早的行
+        first = bind.execute(sa.text('SELECT MIN(timestamp) FROM Transactions')).scalar()
+        month = first.date().replace(day=1) if first else date.today().replace(day=1)
+        last = date.today().replace(day=1)
+        for _ in range(PARTITIONS_AHEAD):
+            last = next_month(last)
+        months = [month]
+        while months[-1] < last:
+            months.append(next_month(months[-1]))
+        op.execute('ALTER TABLE Transactions DROP PRIMARY KEY, ADD PRIMARY KEY (id, timestamp)')
+        op.execute(
+            f'ALTER TABLE Transactions PARTITION BY RANGE (TO_DAYS(timestamp)) '
+            f'({partition_definitions(months)}, PARTITION pmax VALUES LESS THAN MAXVALUE)'
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'mysql':
+        op.execute('ALTER TABLE Transactions REMOVE PARTITIONING')
+        op.execute('ALTER TABLE Transactions DROP PRIMARY KEY, ADD PRIMARY KEY (id)')
+        op.execute('SET FOREIGN_KEY_CHECKS=0')
+
+    naming_convention = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+    with op.batch_alter_table('Transactions', schema=None, naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_Transactions_timestamp')
+        batch_op.alter_column('timestamp',
+               existing_type=sa.DATETIME(),
+               nullable=True)
+        batch_op.create_foreign_key('fk_Transactions_accountId_Accounts', 'Accounts', ['accountId'], ['id'])
+    if bind.dialect.name == 'mysql':
+        op.execute('SET FOREIGN_KEY_CHECKS=1')
+
+    op.drop_table('ArchivedLedgerMonths')
@@ -0,0 +1,40 @@
+"""idempotency keys
+
+Revision ID: 23586646a01e
+Revises: 52bb4ab7ab26
+Create Date: 2026-10-18 20:51:39.412030
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '23586646a01e'
+down_revision = '52bb4ab7ab26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('IdempotencyKeys',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('requestHash', sa.String(length=64), nullable=False),
+    sa.Column('statusCode', sa.Integer(), nullable=True),
+    sa.Column('responseBody', sa.Text(), nullable=True),
+    sa.Column('mimetype', sa.String(length=100), nullable=True),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.Column('expiresAt', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['Users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'key')
+    )
+    with op.batch_alter_table('IdempotencyKeys', schema=None) as batch_op:
+        batch_op.create_index('ix_IdempotencyKeys_expiresAt', ['expiresAt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('IdempotencyKeys', schema=None) as batch_op:
+        batch_op.drop_index('ix_IdempotencyKeys_expiresAt')
+
+    op.drop_table('IdempotencyKeys')
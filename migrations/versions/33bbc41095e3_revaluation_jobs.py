@@ -0,0 +1,43 @@
+"""revaluation jobs
+
+Revision ID: 33bbc41095e3
+Revises: fd085f1c351b
+Create Date: 2026-10-18 20:42:38.418993
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '33bbc41095e3'
+down_revision = 'fd085f1c351b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('RevaluationJobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('accountId', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('provisionalValue', sa.DECIMAL(precision=12, scale=2), nullable=False),
+    sa.Column('marketValue', sa.DECIMAL(precision=12, scale=2), nullable=True),
+    sa.Column('error', sa.String(length=255), nullable=True),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.Column('updatedAt', sa.DateTime(), nullable=False),
+    sa.Column('finishedAt', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['accountId'], ['Accounts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['Users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('RevaluationJobs', schema=None) as batch_op:
+        batch_op.create_index('ix_RevaluationJobs_status_updatedAt', ['status', 'updatedAt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('RevaluationJobs', schema=None) as batch_op:
+        batch_op.drop_index('ix_RevaluationJobs_status_updatedAt')
+
+    op.drop_table('RevaluationJobs')
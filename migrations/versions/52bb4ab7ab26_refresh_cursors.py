@@ -0,0 +1,54 @@
+"""refresh cursors
+
+Revision ID: 52bb4ab7ab26
+Revises: 0a8533249584
+Create Date: 2026-10-18 20:45:46.912559
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '52bb4ab7ab26'
+down_revision = '0a8533249584'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('RefreshCursors',
+    sa.Column('name', sa.String(length=100), nullable=False),
+    sa.Column('runDate', sa.Date(), nullable=False),
+    sa.Column('shardStart', sa.Integer(), nullable=True),
+    sa.Column('shardEnd', sa.Integer(), nullable=True),
+    sa.Column('lastAccountId', sa.Integer(), nullable=False),
+    sa.Column('processed', sa.Integer(), nullable=False),
+    sa.Column('updated', sa.Integer(), nullable=False),
+    sa.Column('failed', sa.Integer(), nullable=False),
+    sa.Column('startedAt', sa.DateTime(), nullable=False),
+    sa.Column('updatedAt', sa.DateTime(), nullable=False),
+    sa.Column('finishedAt', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.create_table('RefreshDeadLetters',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('runDate', sa.Date(), nullable=False),
+    sa.Column('cursorName', sa.String(length=100), nullable=False),
+    sa.Column('accountId', sa.Integer(), nullable=False),
+    sa.Column('stockSymbol', sa.String(length=10), nullable=True),
+    sa.Column('error', sa.String(length=255), nullable=True),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['accountId'], ['Accounts.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('RefreshDeadLetters', schema=None) as batch_op:
+        batch_op.create_index('ix_RefreshDeadLetters_runDate', ['runDate'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('RefreshDeadLetters', schema=None) as batch_op:
+        batch_op.drop_index('ix_RefreshDeadLetters_runDate')
+
+    op.drop_table('RefreshDeadLetters')
+    op.drop_table('RefreshCursors')
@@ -0,0 +1,27 @@
+"""user data version
+
+Revision ID: 6cb7dd32e08c
+Revises: 23586646a01e
+Create Date: 2026-10-18 20:53:11.695083
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6cb7dd32e08c'
+down_revision = '23586646a01e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('Users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('dataVersion', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('Users', schema=None) as batch_op:
+        batch_op.drop_column('dataVersion')
+
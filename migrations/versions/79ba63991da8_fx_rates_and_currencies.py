@@ -0,0 +1,52 @@
+"""fx rates and currencies
+
+Revision ID: 79ba63991da8
+Revises: 6cb7dd32e08c
+Create Date: 2026-10-18 21:21:34.919744
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '79ba63991da8'
+down_revision = '6cb7dd32e08c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('FxRates',
+    sa.Column('base', sa.String(length=3), nullable=False),
+    sa.Column('quote', sa.String(length=3), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('rate', sa.DECIMAL(precision=20, scale=10), nullable=False),
+    sa.Column('createdAt', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('base', 'quote', 'day')
+    )
+    with op.batch_alter_table('FxRates', schema=None) as batch_op:
+        batch_op.create_index('ix_FxRates_base_day', ['base', 'day'], unique=False)
+
+    with op.batch_alter_table('Accounts', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('currency', sa.String(length=3), nullable=True))
+
+    with op.batch_alter_table('Users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('reportingCurrency', sa.String(length=3), server_default='CNY', nullable=False))
+
+    # Existing stock accounts were all valued as USD-quoted
+    accounts = sa.table('Accounts', sa.column('type'), sa.column('currency'))
+    op.execute(accounts.update().where(accounts.c.type == '股票账户').values(currency='USD'))
+
+
+def downgrade():
+    with op.batch_alter_table('Users', schema=None) as batch_op:
+        batch_op.drop_column('reportingCurrency')
+
+    with op.batch_alter_table('Accounts', schema=None) as batch_op:
+        batch_op.drop_column('currency')
+
+    with op.batch_alter_table('FxRates', schema=None) as batch_op:
+        batch_op.drop_index('ix_FxRates_base_day')
+
+    op.drop_table('FxRates')
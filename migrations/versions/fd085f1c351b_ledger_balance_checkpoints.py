@@ -0,0 +1,43 @@
+"""ledger balance checkpoints
+
+Revision ID: fd085f1c351b
+Revises: 12ec7764e589
+Create Date: 2026-10-18 20:37:22.150378
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'fd085f1c351b'
+down_revision = '12ec7764e589'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('DailyBalances',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('totalMarketValue', sa.DECIMAL(precision=14, scale=2), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['Users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+    op.create_table('BalanceCheckpoints',
+    sa.Column('accountId', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Date(), nullable=False),
+    sa.Column('balance', sa.DECIMAL(precision=12, scale=2), nullable=False),
+    sa.ForeignKeyConstraint(['accountId'], ['Accounts.id'], ),
+    sa.PrimaryKeyConstraint('accountId', 'month')
+    )
+    with op.batch_alter_table('BalanceCheckpoints', schema=None) as batch_op:
+        batch_op.create_index('ix_BalanceCheckpoints_month', ['month'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('BalanceCheckpoints', schema=None) as batch_op:
+        batch_op.drop_index('ix_BalanceCheckpoints_month')
+
+    op.drop_table('BalanceCheckpoints')
+    op.drop_table('DailyBalances')
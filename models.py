@@ -1,5 +1,34 @@
-from app import db
-from datetime import datetime
+from flask import url_for
+from flask_login import UserMixin
+from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime, timezone
+from db_engine import RoutingSession
+
+# 未绑定应用，create_app() 中调用 db.init_app() 后才创建数据库引擎
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+class User(UserMixin, db.Model):
+    __tablename__ = 'Users'
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(255), unique=True, nullable=False)
+    password = db.Column(db.String(255), nullable=False)
+    dataVersion = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped by every write to the user's data
+    reportingCurrency = db.Column(db.String(3), nullable=False, default='CNY', server_default='CNY')  # currency of every stored amount
+    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'reportingCurrency': self.reportingCurrency,
+            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+def default_account_currency(context):
+    # 股票默认以美元计价；其他账户为空，表示以用户的报告币种记账
+    return 'USD' if context.get_current_parameters().get('type') == '股票账户' else None
 
 class Account(db.Model):
     __tablename__ = 'Accounts'
@@ -8,12 +37,18 @@ class Account(db.Model):
     details = db.Column(db.String(100), nullable=False)
     stockSymbol = db.Column(db.String(10), nullable=True)
     shares = db.Column(db.Integer, nullable=True)
-    marketValue = db.Column(db.Float, nullable=True)
+    currency = db.Column(db.String(3), nullable=True, default=default_account_currency)  # quote currency of a stock account
+    marketValue = db.Column(db.DECIMAL(12, 2), nullable=True)  # in the owner's reporting currency
     createdAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
     updatedAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), nullable=False)
+    deletedAt = db.Column(db.DateTime, nullable=True)
     user = db.relationship('User', backref=db.backref('accounts', lazy=True))
 
+    __table_args__ = (
+        db.Index('ix_Accounts_user_id_type', 'user_id', 'type'),
+    )
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -21,44 +56,268 @@ class Account(db.Model):
             'details': self.details,
             'stockSymbol': self.stockSymbol,
             'shares': self.shares,
-            'marketValue': self.marketValue,
+            'currency': self.currency,
+            'marketValue': float(self.marketValue) if self.marketValue is not None else 0,
             'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
             'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S'),
             'user_id': self.user_id
         }
 
+class AccountTypeBalance(db.Model):
+    __tablename__ = 'AccountTypeBalances'
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True)
+    type = db.Column(db.String(50), primary_key=True)
+    totalMarketValue = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+    accountCount = db.Column(db.Integer, nullable=False, default=0)
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
 class MonthlyMarketValue(db.Model):
     __tablename__ = 'MonthlyMarketValues'
     id = db.Column(db.Integer, primary_key=True)
-    totalMarketValue = db.Column(db.Float, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), nullable=True)
+    totalMarketValue = db.Column(db.DECIMAL(12, 2), nullable=False)
     month = db.Column(db.Date, nullable=False)
+    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'month', name='uq_MonthlyMarketValues_user_id_month'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'totalMarketValue': float(self.totalMarketValue),
+            'month': self.month.strftime('%Y-%m-%d'),
+            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+class MonthlyTypeMarketValue(db.Model):
+    __tablename__ = 'MonthlyTypeMarketValues'
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    type = db.Column(db.String(50), primary_key=True)
+    totalMarketValue = db.Column(db.DECIMAL(14, 2), nullable=False)
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+
+    def to_dict(self):
+        return {
+            'month': self.month.strftime('%Y-%m-%d'),
+            'type': self.type,
+            'totalMarketValue': float(self.totalMarketValue)
+        }
+
+class BalanceCheckpoint(db.Model):
+    __tablename__ = 'BalanceCheckpoints'
+    accountId = db.Column(db.Integer, db.ForeignKey('Accounts.id'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)
+    balance = db.Column(db.DECIMAL(12, 2), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_BalanceCheckpoints_month', 'month'),
+    )
+
+class DailyBalance(db.Model):
+    __tablename__ = 'DailyBalances'
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    totalMarketValue = db.Column(db.DECIMAL(14, 2), nullable=False)
+
+class FxRate(db.Model):
+    __tablename__ = 'FxRates'
+    base = db.Column(db.String(3), primary_key=True)
+    quote = db.Column(db.String(3), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    rate = db.Column(db.DECIMAL(20, 10), nullable=False)  # units of quote per unit of base
+    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('ix_FxRates_base_day', 'base', 'day'),
+    )
+
+class RevaluationJob(db.Model):
+    __tablename__ = 'RevaluationJobs'
+    id = db.Column(db.Integer, primary_key=True)
+    accountId = db.Column(db.Integer, db.ForeignKey('Accounts.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, done, failed
+    provisionalValue = db.Column(db.DECIMAL(12, 2), nullable=False)
+    marketValue = db.Column(db.DECIMAL(12, 2), nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    finishedAt = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_RevaluationJobs_status_updatedAt', 'status', 'updatedAt'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'accountId': self.accountId,
+            'status': self.status,
+            'provisionalValue': float(self.provisionalValue),
+            'marketValue': float(self.marketValue) if self.marketValue is not None else None,
+            'error': self.error,
+            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'finishedAt': self.finishedAt.strftime('%Y-%m-%d %H:%M:%S') if self.finishedAt else None,
+            'url': url_for('main.get_revaluation_job', id=self.id)
+        }
+
+class JobLease(db.Model):
+    __tablename__ = 'JobLeases'
+    name = db.Column(db.String(100), primary_key=True)
+    holder = db.Column(db.String(255), nullable=True)
+    token = db.Column(db.Integer, nullable=False, default=0)  # fencing token, incremented on every acquisition
+    expiresAt = db.Column(db.DateTime, nullable=True)  # while held: lease expiry; after a failed run: when it is retried
+    heartbeatAt = db.Column(db.DateTime, nullable=True)
+    lastScheduledFor = db.Column(db.DateTime, nullable=False)  # newest fire time that has been run (UTC)
+    lastDuration = db.Column(db.Float, nullable=True)
+    lastStatus = db.Column(db.String(20), nullable=True)
+
+class JobRun(db.Model):
+    __tablename__ = 'JobRuns'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    token = db.Column(db.Integer, nullable=False)
+    holder = db.Column(db.String(255), nullable=False)
+    scheduledFor = db.Column(db.DateTime, nullable=False)
+    startedAt = db.Column(db.DateTime, nullable=False)
+    finishedAt = db.Column(db.DateTime, nullable=True)
+    duration = db.Column(db.Float, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, success, failed, fenced
+    error = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_JobRuns_name_startedAt', 'name', 'startedAt'),
+    )
 
     def to_dict(self):
         return {
             'id': self.id,
-            'totalMarketValue': self.totalMarketValue,
-            'month': self.month.strftime('%Y-%m-%d')
+            'token': self.token,
+            'holder': self.holder,
+            'scheduledFor': self.scheduledFor.strftime('%Y-%m-%d %H:%M:%S'),
+            'startedAt': self.startedAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'finishedAt': self.finishedAt.strftime('%Y-%m-%d %H:%M:%S') if self.finishedAt else None,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error
         }
 
+class RefreshCursor(db.Model):
+    __tablename__ = 'RefreshCursors'
+    name = db.Column(db.String(100), primary_key=True)  # 'daily-refresh', 'daily-refresh:<shard>/<shards>', 'daily-refresh:bounds/<shards>' or 'manual-refresh'
+    runDate = db.Column(db.Date, nullable=False)
+    shardStart = db.Column(db.Integer, nullable=True)
+    shardEnd = db.Column(db.Integer, nullable=True)
+    lastAccountId = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    startedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    updatedAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    finishedAt = db.Column(db.DateTime, nullable=True)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'runDate': self.runDate.strftime('%Y-%m-%d'),
+            'shardStart': self.shardStart,
+            'shardEnd': self.shardEnd,
+            'lastAccountId': self.lastAccountId,
+            'processed': self.processed,
+            'updated': self.updated,
+            'failed': self.failed,
+            'startedAt': self.startedAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'finishedAt': self.finishedAt.strftime('%Y-%m-%d %H:%M:%S') if self.finishedAt else None
+        }
+
+class RefreshDeadLetter(db.Model):
+    __tablename__ = 'RefreshDeadLetters'
+    id = db.Column(db.Integer, primary_key=True)
+    runDate = db.Column(db.Date, nullable=False)
+    cursorName = db.Column(db.String(100), nullable=False)
+    accountId = db.Column(db.Integer, db.ForeignKey('Accounts.id'), nullable=False)
+    stockSymbol = db.Column(db.String(10), nullable=True)
+    error = db.Column(db.String(255), nullable=True)
+    createdAt = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('ix_RefreshDeadLetters_runDate', 'runDate'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'runDate': self.runDate.strftime('%Y-%m-%d'),
+            'cursorName': self.cursorName,
+            'accountId': self.accountId,
+            'stockSymbol': self.stockSymbol,
+            'error': self.error,
+            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S')
+        }
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'IdempotencyKeys'
+    user_id = db.Column(db.Integer, db.ForeignKey('Users.id'), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    requestHash = db.Column(db.String(64), nullable=False)
+    statusCode = db.Column(db.Integer, nullable=True)  # NULL while the first request is still running
+    responseBody = db.Column(db.Text, nullable=True)
+    mimetype = db.Column(db.String(100), nullable=True)
+    createdAt = db.Column(db.DateTime, nullable=False)
+    expiresAt = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_IdempotencyKeys_expiresAt', 'expiresAt'),
+    )
+
 class Transaction(db.Model):
     __tablename__ = 'Transactions'
+    # MySQL 上按月分区（主键为 id, timestamp），分区表不支持外键；账户只做软删除，不会留下悬空的 accountId
     id = db.Column(db.Integer, primary_key=True)
     accountId = db.Column(db.Integer, nullable=False)
-    change = db.Column(db.Float, nullable=False)
-    previousBalance = db.Column(db.Float, nullable=False)
-    newBalance = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    change = db.Column(db.DECIMAL(12, 2), nullable=False)
+    previousBalance = db.Column(db.DECIMAL(12, 2), nullable=False)
+    newBalance = db.Column(db.DECIMAL(12, 2), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     createdAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
     updatedAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc), nullable=False)
+    reason = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_Transactions_accountId_timestamp', 'accountId', 'timestamp'),
+        db.Index('ix_Transactions_timestamp', 'timestamp'),
+    )
 
     def to_dict(self):
         return {
             'id': self.id,
             'accountId': self.accountId,
-            'change': self.change,
-            'previousBalance': self.previousBalance,
-            'newBalance': self.newBalance,
+            'change': float(self.change),
+            'previousBalance': float(self.previousBalance),
+            'newBalance': float(self.newBalance),
             'timestamp': self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
             'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S'),
-            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S')
+            'updatedAt': self.updatedAt.strftime('%Y-%m-%d %H:%M:%S'),
+            'reason': self.reason
+        }
+
+class ArchivedLedgerMonth(db.Model):
+    """A month of Transactions moved to the compressed file transactions-YYYY-MM under LEDGER_ARCHIVE_PATH."""
+    __tablename__ = 'ArchivedLedgerMonths'
+    month = db.Column(db.Date, primary_key=True)
+    rowCount = db.Column(db.Integer, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    createdAt = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+
+    def to_dict(self):
+        return {
+            'month': self.month.strftime('%Y-%m'),
+            'rowCount': self.rowCount,
+            'sha256': self.sha256,
+            'createdAt': self.createdAt.strftime('%Y-%m-%d %H:%M:%S')
         }
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """No hashing slot was free, or the hash did not finish within the timeout."""
+
+
+def hash_method(stored):
+    """The method and cost a werkzeug hash was made with, e.g. 'pbkdf2:sha256:1000000'."""
+    return stored.split('$', 1)[0]
+
+
+def check_method(method):
+    name, _, cost = method.partition(':')
+    parts = cost.split(':') if cost else []
+    if not ((name == 'pbkdf2' and len(parts) == 2) or (name == 'scrypt' and len(parts) == 3)):
+        raise ValueError(f'PASSWORD_HASH_METHOD must name its cost, e.g. pbkdf2:sha256:1000000 or scrypt:32768:8:1: {method}')
+    return method
+
+
+def hash_password(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def verify_password(stored, password, method):
+    """(matches, new hash): the new hash when `stored` matches but was made with another method or cost, else None."""
+    if not check_password_hash(stored, password):
+        return False, None
+    return True, None if hash_method(stored) == method else generate_password_hash(password, method=method)
+
+
+def init_process(nice, parent):
+    os.nice(nice)
+
+    # web worker 被强制结束时随之退出，不留下孤儿进程
+    def watch_parent():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+
+class PasswordHasher:
+    """Password hashing in a pool of `workers` processes instead of on the request threads.
+
+    At most `workers` hashes run at once and `queue_size` more wait for a process; a request beyond that, or
+    one whose hash takes longer than `timeout` seconds, gets HasherBusy instead of tying up its thread. The
+    processes run `nice` steps below the web workers, so a burst of logins does not take the CPU from other
+    requests. Call start() while the process has no other threads: the pool processes are forked, and a
+    fork taken while another thread holds a lock can hang, so a server that forks workers starts it in each
+    worker, not before the fork. A process that did not start its own pool starts one on first use. With workers=0 the hashing runs on the calling thread.
+    """
+
+    def __init__(self, method, workers=1, queue_size=16, timeout=10, nice=10, on_hash=None):
+        self.method = check_method(method)
+        self.workers = workers
+        self.timeout = timeout
+        self.nice = nice
+        self.on_hash = on_hash
+        self.slots = threading.BoundedSemaphore(workers + queue_size) if workers else None
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def start(self):
+        if self.workers:
+            self._pool().submit(os.getpid).result()
+
+    def hash(self, password):
+        return self._run('hash', hash_password, password, self.method)
+
+    def verify(self, stored, password):
+        """(matches, new hash or None), as verify_password()."""
+        return self._run('verify', verify_password, stored, password, self.method)
+
+    def _pool(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # fork：spawn/forkserver 会在子进程重新导入 __main__（gunicorn 或压测脚本）
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                    initializer=init_process, initargs=(self.nice, os.getpid()))
+                self.pid = os.getpid()
+            return self.executor
+
+    def _run(self, operation, function, *args):
+        started = time.perf_counter()
+        outcome = 'ok'
+        try:
+            if not self.workers:
+                return function(*args)
+            if not self.slots.acquire(blocking=False):
+                outcome = 'busy'
+                raise HasherBusy()
+            try:
+                future = self._pool().submit(function, *args)
+            except BaseException:
+                self.slots.release()
+                raise
+            # 超时返回后任务仍在进程中运行，直到它结束才释放名额
+            future.add_done_callback(lambda _: self.slots.release())
+            try:
+                return future.result(self.timeout)
+            except FutureTimeoutError:
+                outcome = 'timeout'
+                raise HasherBusy()
+            except BrokenProcessPool:
+                outcome = 'broken'
+                with self.lock:
+                    self.executor = None
+                raise HasherBusy()
+        finally:
+            if self.on_hash:
+                self.on_hash(operation, time.perf_counter() - started, outcome)
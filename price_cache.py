@@ -0,0 +1,213 @@
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
+
+MARKET_TZ = ZoneInfo('America/New_York')
+MARKET_OPEN = dt_time(9, 30)
+MARKET_CLOSE = dt_time(16, 0)
+
+
+def market_session(now=None):
+    """'open' during regular US trading hours, 'closed' otherwise (weekends, nights)."""
+    now = (now or datetime.now(MARKET_TZ)).astimezone(MARKET_TZ)
+    if now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE:
+        return 'open'
+    return 'closed'
+
+
+class MemoryCache:
+    """In-process LRU cache with a per-entry TTL."""
+
+    name = 'memory'
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value, expires_at
+
+    def set(self, key, value, expires_at):
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+class SQLiteCache:
+    """Cache tier in a local SQLite file, shared by every worker process on the host.
+
+    A hit records its access time for the LRU eviction only when the stored one is more than `touch_interval`
+    seconds old, so hot keys are not rewritten on every read. Expired and least recently used entries are
+    evicted every `evict_every` writes of a process, in the same transaction as the write, so the table can
+    briefly hold more than `maxsize` entries.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, maxsize=10000, touch_interval=60, evict_every=64):
+        self.path = path
+        self.maxsize = maxsize
+        self.touch_interval = touch_interval
+        self.evict_every = evict_every
+        self.writes = itertools.count(1)
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 建表用的连接随即关闭，gunicorn --preload 时 fork 出的 worker 各自打开连接
+        with closing(sqlite3.connect(self.path, timeout=5, isolation_level=None)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)')
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        row = conn.execute('SELECT value, expires_at, accessed_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] <= now:
+            return None
+        if now - row[2] >= self.touch_interval:
+            conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, expires_at):
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires_at, now)
+            )
+            if next(self.writes) % self.evict_every == 0:
+                self._evict(conn, now)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn, now):
+        # 过期条目先删除，超出容量时按最近访问时间淘汰最旧的条目；两者都走索引
+        conn.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+        excess = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.maxsize
+        if excess > 0:
+            conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)', (excess,))
+
+
+class TieredCache:
+    """Read-through cache over one or more tiers, fastest first, with hit/miss counters.
+
+    get_or_fetch() lets only one thread per key fetch a missing value; the dedupe is within this process, so
+    worker processes sharing the SQLite tier can each fetch the same key once.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.stats = {'misses': 0, **{f'{tier.name}_hits': 0 for tier in tiers}}
+        self.stats_lock = threading.Lock()
+        self.key_locks = {}  # key -> [lock, threads holding or waiting for it]
+        self.key_locks_lock = threading.Lock()
+
+    def _count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    @contextmanager
+    def _key_lock(self, key):
+        """Hold `key`'s fill lock; it is dropped once no thread holds or waits for it."""
+        with self.key_locks_lock:
+            entry = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.key_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.key_locks[key]
+
+    def _lookup(self, key):
+        for index, tier in enumerate(self.tiers):
+            entry = tier.get(key)
+            if entry is not None:
+                self._count(f'{tier.name}_hits')
+                for upper in self.tiers[:index]:
+                    upper.set(key, *entry)
+                return entry[0]
+        return None
+
+    def peek(self, key):
+        """The cached value for `key`, or None; never fetches."""
+        value = self._lookup(key)
+        if value is None:
+            self._count('misses')
+        return value
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        for tier in self.tiers:
+            tier.set(key, value, expires_at)
+
+    def get_or_fetch(self, key, ttl, fetch):
+        value = self._lookup(key)
+        if value is not None:
+            return value
+        # 同一进程内同一 key 只允许一个线程回源
+        with self._key_lock(key):
+            value = self._lookup(key)
+            if value is not None:
+                return value
+            self._count('misses')
+            value = fetch()
+            expires_at = time.time() + ttl
+            for tier in self.tiers:
+                tier.set(key, value, expires_at)
+            return value
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        hits = lookups - stats['misses']
+        stats['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def build_cache(config):
+    tiers = [MemoryCache(config['PRICE_CACHE_MAXSIZE'])]
+    if config['PRICE_CACHE_BACKEND'] == 'sqlite':
+        tiers.append(SQLiteCache(config['PRICE_CACHE_PATH'], config['PRICE_CACHE_MAXSIZE']))
+    return TieredCache(tiers)
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+RECORD = np.dtype([('day', '<i4'), ('close', '<f8')])
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def to_day_number(day):
+    return day.toordinal() - EPOCH
+
+
+def from_day_number(number):
+    return date.fromordinal(int(number) + EPOCH)
+
+
+class PriceStore:
+    """Daily closes kept as one sorted (day, close) array per symbol in `root`, read through memory maps.
+
+    Writes merge new closes into the symbol's array and atomically replace the file, so readers in
+    other processes always see a complete array. Existing days are only overwritten by newer data.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.arrays = {}
+        self.lock = threading.Lock()
+
+    def _path(self, symbol):
+        return os.path.join(self.root, re.sub(r'[^A-Za-z0-9.-]', '_', symbol) + '.npy')
+
+    def _load(self, symbol):
+        path = self._path(symbol)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return np.empty(0, dtype=RECORD)
+        with self.lock:
+            cached = self.arrays.get(symbol)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            # Windows cannot replace a file that is still memory-mapped
+            array = np.load(path, mmap_mode=None if os.name == 'nt' else 'r')
+            self.arrays[symbol] = (mtime, array)
+            return array
+
+    def append(self, symbol, days, closes):
+        """Merge {day: close} pairs for `symbol`; returns the number of stored days."""
+        incoming = np.empty(len(days), dtype=RECORD)
+        incoming['day'] = [to_day_number(day) for day in days]
+        incoming['close'] = closes
+        merged = np.concatenate((incoming, np.asarray(self._load(symbol))))
+        # np.unique keeps the first occurrence, so incoming values win over stored ones
+        _, first = np.unique(merged['day'], return_index=True)
+        merged = merged[first]
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, merged)
+        os.replace(tmp_path, self._path(symbol))
+        return len(merged)
+
+    def first_day(self, symbol):
+        array = self._load(symbol)
+        return from_day_number(array['day'][0]) if len(array) else None
+
+    def last_day(self, symbol):
+        array = self._load(symbol)
+        return from_day_number(array['day'][-1]) if len(array) else None
+
+    def get_closes(self, symbol, days):
+        """Close on or before each day (the last trading day), or nan where there is no earlier data."""
+        array = self._load(symbol)
+        numbers = np.array([to_day_number(day) for day in days], dtype='<i4')
+        if not len(array):
+            return np.full(len(numbers), np.nan)
+        index = np.searchsorted(array['day'], numbers, side='right') - 1
+        closes = np.asarray(array['close'])[np.clip(index, 0, None)]
+        return np.where(index >= 0, closes, np.nan)
+
+    def get_close(self, symbol, day):
+        close = self.get_closes(symbol, [day])[0]
+        return None if np.isnan(close) else float(close)
+
+    def symbols(self):
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith('.npy'))
+
+
+class FixtureProvider:
+    """Offline stand-in for Polygon range aggregates, reading {symbol: {YYYY-MM-DD: close}} from a JSON file."""
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.data = json.load(f)
+
+    def get_daily_closes(self, symbol, start, end):
+        points = sorted(
+            (datetime.strptime(day, '%Y-%m-%d').date(), close)
+            for day, close in self.data.get(symbol, {}).items()
+        )
+        return [(day, close) for day, close in points if start <= day <= end]
+
+
+def polygon_bars_to_closes(results):
+    return [
+        (datetime.fromtimestamp(bar['t'] / 1000, tz=timezone.utc).date(), bar['c'])
+        for bar in results
+    ]
+
+
+def backfill_prices(store, provider, symbols, start, end):
+    """Fetch the daily closes in [start, end] that each symbol's stored range does not already cover.
+
+    Returns ({symbol: closes stored}, {symbol: error}); one failing symbol does not stop the others.
+    """
+    stored, errors = {}, {}
+    for symbol in symbols:
+        first_day, last_day = store.first_day(symbol), store.last_day(symbol)
+        if first_day is None:
+            ranges = [(start, end)]
+        else:
+            ranges = [
+                (start, date.fromordinal(first_day.toordinal() - 1)),
+                (date.fromordinal(last_day.toordinal() + 1), end)
+            ]
+        points = []
+        try:
+            for since, until in ranges:
+                if since <= until:
+                    points.extend(provider.get_daily_closes(symbol, since, until))
+        except (ValueError, OSError) as e:
+            logging.error(f"Error backfilling prices for {symbol}: {e}")
+            errors[symbol] = str(e)
+            continue
+        if points:
+            days, closes = zip(*points)
+            store.append(symbol, days, closes)
+            stored[symbol] = len(points)
+    return stored, errors
@@ -0,0 +1,21 @@
+def explain(connection, stmt):
+    """Run the dialect's EXPLAIN for a SQLAlchemy statement and return the raw plan rows."""
+    compiled = stmt.compile(dialect=connection.dialect)
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.dialect.name == 'sqlite' else 'EXPLAIN '
+    return connection.exec_driver_sql(prefix + str(compiled), params).mappings().all()
+
+
+def find_full_scans(connection, stmt):
+    """Return a description of every table the statement would read with a full scan."""
+    plan = explain(connection, stmt)
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        return [row['detail'] for row in plan if row['detail'].startswith('SCAN ') and 'INDEX' not in row['detail']]
+    if dialect == 'mysql':
+        # type=ALL with no candidate key means no index could serve the query at all
+        return [f"{row['table']} (type=ALL)" for row in plan if row['type'] == 'ALL' and not row['possible_keys']]
+    raise NotImplementedError(f'Query plan checks are not supported for {dialect}')
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from price_cache import market_session
+from price_store import polygon_bars_to_closes
+
+
+class RateLimiter:
+    """Thread-safe token bucket: `rate` requests per second with bursts up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def with_retries(fetch, retries=0, backoff=1.0):
+    """Call `fetch`, retrying quote errors up to `retries` times with exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            return fetch()
+        except (ValueError, requests.RequestException):
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+class QuoteFetcher:
+    """Fetches quotes over pooled keep-alive sessions, one session and rate limit per provider."""
+
+    def __init__(self, polygon_api_key, exchange_rate_url, max_workers=8, polygon_rate=5, fx_rate=1, timeout=10,
+                 cache=None, quote_ttls=None, polygon_url='https://api.polygon.io', on_call=None):
+        self.polygon_api_key = polygon_api_key
+        self.polygon_url = polygon_url.rstrip('/')
+        self.exchange_rate_url = exchange_rate_url
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self.cache = cache
+        # TTL per market session: quotes move while the market is open and are stable otherwise
+        self.quote_ttls = quote_ttls or {'open': 60, 'closed': 3600}
+        # on_call(call, seconds, outcome) is told about every upstream HTTP call, e.g. to record latency
+        self.on_call = on_call
+        self.sessions = {
+            'polygon': self._make_session(self.max_workers),
+            'fx': self._make_session(2),
+        }
+        self.limiters = {
+            'polygon': RateLimiter(polygon_rate),
+            'fx': RateLimiter(fx_rate),
+        }
+
+    @staticmethod
+    def _make_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _get_json(self, provider, url, call):
+        self.limiters[provider].acquire()
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            data = self.sessions[provider].get(url, timeout=self.timeout).json()
+            outcome = 'ok'
+            return data
+        finally:
+            if self.on_call:
+                self.on_call(call, time.perf_counter() - started, outcome)
+
+    def _cached(self, key, ttl, fetch):
+        if self.cache is None:
+            return fetch()
+        return self.cache.get_or_fetch(key, ttl, fetch)
+
+    def get_stock_price(self, symbol):
+        return self._cached(f'quote:{symbol}', self.quote_ttls[market_session()],
+                            lambda: self._fetch_stock_price(symbol))
+
+    def get_cached_stock_price(self, symbol):
+        return self.cache.peek(f'quote:{symbol}') if self.cache is not None else None
+
+    def _fetch_stock_price(self, symbol):
+        url = f'{self.polygon_url}/v2/aggs/ticker/{symbol}/prev?adjusted=true&apiKey={self.polygon_api_key}'
+        data = self._get_json('polygon', url, 'stock_price')
+        if 'results' not in data:
+            logging.error(f"Error fetching stock price for {symbol}: {data}")
+            raise ValueError(f"Error fetching stock price for {symbol}: {data}")
+        return data['results'][0]['c']
+
+    def get_exchange_rates(self):
+        """The whole rate table in one call: (base currency, {currency: units per unit of base})."""
+        data = self._get_json('fx', self.exchange_rate_url, 'exchange_rate')
+        if not data.get('rates'):
+            logging.error(f"Error fetching exchange rates: {data}")
+            raise ValueError(f"Error fetching exchange rates: {data}")
+        return data.get('base', 'USD'), data['rates']
+
+    def get_daily_closes(self, symbol, start, end):
+        """[(day, close)] from Polygon's daily range aggregates, following pagination."""
+        url = (f'{self.polygon_url}/v2/aggs/ticker/{symbol}/range/1/day/{start.isoformat()}/{end.isoformat()}'
+               f'?adjusted=true&sort=asc&limit=50000&apiKey={self.polygon_api_key}')
+        closes = []
+        while url:
+            data = self._get_json('polygon', url, 'daily_closes')
+            if data.get('status') not in ('OK', 'DELAYED'):
+                raise ValueError(f"Error fetching daily closes for {symbol}: {data}")
+            closes.extend(polygon_bars_to_closes(data.get('results', [])))
+            url = f"{data['next_url']}&apiKey={self.polygon_api_key}" if data.get('next_url') else None
+        return closes
+
+    def get_stock_prices(self, symbols, retries=0, backoff=1.0, on_progress=None):
+        """Fetch each distinct symbol once, concurrently. Returns (prices, errors) keyed by symbol.
+
+        `on_progress(done, total)` is called after each symbol, in the calling thread.
+        """
+        unique_symbols = sorted({symbol for symbol in symbols if symbol})
+        prices, errors = {}, {}
+        if not unique_symbols:
+            return prices, errors
+
+        def fetch(symbol):
+            try:
+                return symbol, with_retries(lambda: self.get_stock_price(symbol), retries, backoff), None
+            except (ValueError, requests.RequestException) as e:
+                return symbol, None, e
+
+        workers = min(self.max_workers, len(unique_symbols))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='quotes') as executor:
+            for symbol, price, error in executor.map(fetch, unique_symbols):
+                if error is None:
+                    prices[symbol] = price
+                else:
+                    errors[symbol] = str(error)
+                if on_progress is not None:
+                    on_progress(len(prices) + len(errors), len(unique_symbols))
+        if errors:
+            logging.warning(f"Failed to fetch {len(errors)} of {len(unique_symbols)} symbols: {sorted(errors)}")
+        return prices, errors
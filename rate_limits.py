@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+
+class MemoryRateLimits:
+    """Token buckets by key, kept in this process; the least recently used beyond `maxsize` are dropped."""
+
+    name = 'memory'
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Spend a token from `key`'s bucket, which holds up to `burst` and refills at `rate` per second.
+
+        Returns 0 when there was a token, otherwise the seconds until there is one.
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        return 0 if allowed else (1 - tokens) / rate
+
+
+class SQLiteRateLimits:
+    """Token buckets in a local SQLite file, shared by every worker process on the host.
+
+    Buckets untouched for `retention` seconds are deleted, which is the same as full.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path, retention=86400):
+        self.path = path
+        self.retention = retention
+        self.local = threading.local()
+        self.takes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(sqlite3.connect(path, timeout=5, isolation_level=None)) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)', (key, tokens, now))
+            self.takes += 1
+            if self.takes % 1000 == 0:
+                conn.execute('DELETE FROM buckets WHERE updated_at < ?', (now - self.retention,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return 0 if allowed else (1 - tokens) / rate
+
+
+def build_rate_limits(config):
+    if config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        return SQLiteRateLimits(config['RATE_LIMIT_PATH'])
+    return MemoryRateLimits()
@@ -0,0 +1,64 @@
+import json
+
+from sqlalchemy import Float, String, select, type_coerce
+
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """Compact UTF-8 JSON bytes, through orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+# Dates are read without a result type, so SQLite hands back its stored text unparsed and MySQL drivers
+# their native date objects; str() of either starts with 'YYYY-MM-DD HH:MM:SS' / 'YYYY-MM-DD'.
+CONVERTERS = {
+    'datetime': lambda value: str(value)[:19],
+    'date': str,
+    'money': lambda value: 0 if value is None else value,
+}
+RESULT_TYPES = {
+    'datetime': String,
+    'date': String,
+    'money': Float,
+}
+
+
+class Projection:
+    """A list endpoint's columns, selected as plain row tuples and written straight to JSON.
+
+    `fields` is [(key, column, kind)] in output order, kind being None or a key of CONVERTERS. Money
+    columns are read as floats and dates as text, so no Decimal or datetime is built per row, and each
+    column's converter is looked up once rather than per row.
+    """
+
+    def __init__(self, fields):
+        self.keys = [key for key, _, _ in fields]
+        self.columns = [
+            type_coerce(column, RESULT_TYPES[kind]).label(key) if kind else column
+            for key, column, kind in fields
+        ]
+        spec = [(key, index, CONVERTERS[kind] if kind else None) for index, (key, _, kind) in enumerate(fields)]
+
+        def to_dict(row):
+            return {key: convert(row[index]) if convert else row[index] for key, index, convert in spec}
+        self.to_dict = to_dict
+
+    def select(self, *where):
+        return select(*self.columns).where(*where)
+
+    def execute(self, session, statement):
+        """Serialize `statement`'s rows, executed on the session's connection to skip ORM result handling."""
+        return self.serialize(session.connection().execute(statement).all())
+
+    def serialize(self, rows):
+        to_dict = self.to_dict
+        with timed('serialization'):
+            return dumps([to_dict(row) for row in rows])
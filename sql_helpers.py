@@ -0,0 +1,65 @@
+from sqlalchemy import func, insert
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+
+def upsert(session, table, rows, key_columns, set_columns=(), increment_columns=()):
+    """Bulk INSERT ... ON CONFLICT/ON DUPLICATE KEY UPDATE for the session's dialect.
+
+    On conflict, `set_columns` take the new row's value and `increment_columns` are added to the stored value.
+    """
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(table)
+        new = stmt.inserted
+    elif dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(table)
+        new = stmt.excluded
+    else:
+        raise NotImplementedError(f'Upsert is not supported for {dialect}')
+
+    values = {column: new[column] for column in set_columns}
+    values.update({column: table.c[column] + new[column] for column in increment_columns})
+    if dialect == 'mysql':
+        stmt = stmt.on_duplicate_key_update(**values)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=values)
+    session.execute(stmt, rows)
+
+
+
+def insert_returning_ids(session, entity, rows):
+    """Bulk INSERT `rows` and return their new auto-increment primary keys in row order, in one statement per batch.
+
+    Each statement assigns its rows increasing keys in VALUES order, so the keys sorted are the keys in row
+    order; asking RETURNING for that order instead (sort_by_parameter_order) falls back to one INSERT per row
+    without a sentinel column. MySQL has no RETURNING: there the rows go in as one multi-row INSERT, for which
+    InnoDB allocates consecutive values in every lock mode, counted from the first one (LAST_INSERT_ID()).
+    """
+    if not rows:
+        return []
+    key = entity.__table__.primary_key.columns[0]
+    if session.get_bind().dialect.insert_executemany_returning:
+        return sorted(session.execute(insert(entity).returning(key), rows).scalars())
+    first = session.execute(insert(entity).values(rows)).lastrowid
+    return list(range(first, first + len(rows)))
+
+
+PERIOD_FORMATS = {
+    'day': ('%Y-%m-%d', 'YYYY-MM-DD'),
+    'month': ('%Y-%m', 'YYYY-MM'),
+}
+
+
+def period_key(session, column, interval):
+    """SQL expression rendering a datetime column as 'YYYY-MM-DD' (day) or 'YYYY-MM' (month)."""
+    strftime_format, to_char_format = PERIOD_FORMATS[interval]
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        return func.date_format(column, strftime_format)
+    if dialect == 'sqlite':
+        return func.strftime(strftime_format, column)
+    if dialect == 'postgresql':
+        return func.to_char(column, to_char_format)
+    raise NotImplementedError(f'Period bucketing is not supported for {dialect}')
@@ -2,6 +2,7 @@ document.addEventListener('DOMContentLoaded', () => {
     fetchAccounts();
     fetchMonthlyMarketValues();
     fetchTypeMarketValues();
+    connectEvents();
 
     document.getElementById('accountType').addEventListener('change', handleTypeChange);
     document.getElementById('incomeButton').addEventListener('click', showIncomeModal);
@@ -25,6 +26,66 @@ document.addEventListener('DOMContentLoaded', () => {
 
 let editAccountId = null;
 let deleteAccountId = null;
+let liveUpdates = false;
+let reloadTimer = null;
+let typeMarketValuesTimer = null;
+
+// 通过 /api/events 接收余额变化和刷新进度，连接正常时操作后不再重新拉取整个列表
+function connectEvents() {
+    if (!window.EventSource) {
+        return;
+    }
+    const source = new EventSource('/api/events');
+    let connected = false;
+    source.onopen = () => {
+        // 断线期间的变化无法补发，重连后重新加载一次
+        if (connected) {
+            scheduleReload();
+        }
+        connected = true;
+        liveUpdates = true;
+    };
+    source.onerror = () => {
+        liveUpdates = false;
+    };
+    source.addEventListener('balance', event => updateAccountBalance(JSON.parse(event.data)));
+    source.addEventListener('accounts', scheduleReload);
+    source.addEventListener('resync', scheduleReload);
+    source.addEventListener('refresh', event => showRefreshProgress(JSON.parse(event.data)));
+}
+
+function reloadAccounts() {
+    if (!liveUpdates) {
+        fetchAccounts();
+        fetchTypeMarketValues();
+    }
+}
+
+function scheduleReload() {
+    clearTimeout(reloadTimer);
+    reloadTimer = setTimeout(() => {
+        fetchAccounts();
+        fetchTypeMarketValues();
+    }, 200);
+}
+
+function updateAccountBalance(change) {
+    const cell = document.querySelector(`#accountList tr[data-account-id="${change.accountId}"] .market-value`);
+    if (!cell) {
+        scheduleReload();
+        return;
+    }
+    cell.textContent = change.marketValue;
+    const total = document.getElementById('totalMarketValue');
+    total.textContent = ((parseFloat(total.textContent) || 0) + change.change).toFixed(2);
+    clearTimeout(typeMarketValuesTimer);
+    typeMarketValuesTimer = setTimeout(fetchTypeMarketValues, 200);
+}
+
+function showRefreshProgress(progress) {
+    const button = document.getElementById('refreshButton');
+    button.textContent = progress.finished ? '刷新市值' : `刷新中 ${progress.fetched}/${progress.total}`;
+}
 
 function handleTypeChange() {
     const type = document.getElementById('accountType').value;
@@ -59,12 +120,13 @@ function fetchAccounts() {
             data.forEach(account => {
                 totalMarketValue += parseFloat(account.marketValue) || 0;
                 const row = document.createElement('tr');
+                row.dataset.accountId = account.id;
                 row.innerHTML = `
                     <td>${account.type}</td>
                     <td>${account.details}</td>
                     <td>${account.stockSymbol || ''}</td>
                     <td>${account.shares || ''}</td>
-                    <td>${account.marketValue != null ? account.marketValue : 'N/A'}</td>
+                    <td class="market-value">${account.marketValue != null ? account.marketValue : 'N/A'}</td>
                     <td>
                         <button onclick="editAccount(${account.id})">编辑</button>
                         <button onclick="showDeleteConfirmModal(${account.id})">删除</button>
@@ -119,8 +181,8 @@ function addAccount() {
         })
             .then(response => response.json())
             .then(data => {
-                fetchAccounts();
-                fetchTypeMarketValues();
+                reloadAccounts();
+                waitForRevaluation(data.revaluation);
                 clearForm();
                 editAccountId = null;
                 document.getElementById('addAccountButton').textContent = '添加账户';
@@ -140,8 +202,8 @@ function addAccount() {
         })
             .then(response => response.json())
             .then(data => {
-                fetchAccounts();
-                fetchTypeMarketValues();
+                reloadAccounts();
+                waitForRevaluation(data.revaluation);
                 clearForm();
                 //showInfoModal('账户添加成功');
             })
@@ -152,6 +214,24 @@ function addAccount() {
     }
 }
 
+// 股票账户先以缓存价格保存，后台重新估值完成后刷新列表
+function waitForRevaluation(revaluation, attempts = 30) {
+    if (!revaluation || attempts <= 0 || liveUpdates) {
+        return;
+    }
+    if (revaluation.status === 'done' || revaluation.status === 'failed') {
+        fetchAccounts();
+        fetchTypeMarketValues();
+        return;
+    }
+    setTimeout(() => {
+        fetch(revaluation.url)
+            .then(response => response.json())
+            .then(job => waitForRevaluation(job, attempts - 1))
+            .catch(error => console.error('Error fetching revaluation status:', error));
+    }, 1000);
+}
+
 function editAccount(id) {
     fetch(`/api/accounts/${id}`)
         .then(response => response.json())
@@ -185,8 +265,7 @@ function confirmDeleteAccount() {
         })
             .then(response => response.json())
             .then(data => {
-                fetchAccounts();
-                fetchTypeMarketValues();
+                reloadAccounts();
                 hideDeleteConfirmModal();
                 alert('账户删除成功');
             })
@@ -203,8 +282,7 @@ function refreshMarketValues() {
     })
         .then(response => response.json())
         .then(data => {
-            fetchAccounts();
-            fetchTypeMarketValues();
+            reloadAccounts();
             alert('市值刷新成功');
         })
         .catch(error => {
@@ -313,8 +391,7 @@ function transferFunds() {
     .then(response => response.json())
     .then(data => {
         hideTransferModal();
-        fetchAccounts();
-        fetchTypeMarketValues();
+        reloadAccounts();
         if (data.message) {
             alert(data.message);
         } else {
@@ -351,8 +428,7 @@ function addIncome() {
     .then(response => response.json())
     .then(data => {
         hideIncomeModal();
-        fetchAccounts();
-        fetchTypeMarketValues();
+        reloadAccounts();
         if (data.message) {
             alert(data.message);
         } else {
@@ -389,8 +465,7 @@ function addExpense() {
     .then(response => response.json())
     .then(data => {
         hideExpenseModal();
-        fetchAccounts();
-        fetchTypeMarketValues();
+        reloadAccounts();
         if (data.message) {
             alert(data.message);
         } else {